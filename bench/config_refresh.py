@@ -0,0 +1,153 @@
+"""Benchmark: the background config refresher against a local config server.
+
+Serves a config for every guild from a local aiohttp server that honours
+ETags, like GitHub and most static hosts do, and runs the real refresher
+and HttpClient against it for a few intervals. Partway through, some of
+the configs change and some of the URLs start failing. Some guilds were
+set up before config hashes were kept, and must not be set up again just
+for that. Reports how many requests were full downloads and how many were
+304s, how many guilds were set up again (and how many at once at most),
+and how the failing URLs backed off.
+
+    poetry run python -m bench.config_refresh --guilds 200 --interval 2 --intervals 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+from dragonpaw_bot import http, refresh
+
+PORT = 18082
+# How long a reconfigure takes, in seconds.
+APPLY_TIME = 0.05
+
+
+class ConfigServer:
+    def __init__(self, guilds: int):
+        self.configs = {
+            g: f"# guild {g}\n[lobby]\nchannel = 'lobby'\n" for g in range(guilds)
+        }
+        self.failing: set[int] = set()
+        self.responses: collections.Counter[int] = collections.Counter()
+        self.requests: collections.defaultdict[
+            int, list[float]
+        ] = collections.defaultdict(list)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        guild_id = int(request.match_info["guild_id"])
+        self.requests[guild_id].append(time.monotonic())
+        if guild_id in self.failing:
+            self.responses[500] += 1
+            raise web.HTTPInternalServerError()
+        text = self.configs[guild_id]
+        etag = '"%s"' % hashlib.sha256(text.encode()).hexdigest()[:16]
+        if request.headers.get("If-None-Match") == etag:
+            self.responses[304] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        self.responses[200] += 1
+        return web.Response(text=text, headers={"ETag": etag})
+
+
+async def run(args: argparse.Namespace) -> int:
+    server = ConfigServer(args.guilds)
+    app = web.Application()
+    app.router.add_get("/config/{guild_id}", server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    client = http.HttpClient(cache_dir=Path(tempfile.mkdtemp()))
+    applied: list[int] = []
+    running = peak = 0
+
+    async def poll(guild_id: int) -> str | None:
+        return await client.get_text(f"http://127.0.0.1:{PORT}/config/{guild_id}")
+
+    async def apply(guild_id: int, text: str) -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(APPLY_TIME)
+        running -= 1
+        applied.append(guild_id)
+
+    refresher = refresh.ConfigRefresher(poll=poll, apply=apply, interval=args.interval)
+    # As if every guild had just been set up from its config, some of them
+    # by an older version, which didn't keep its hash.
+    legacy = set(range(3, args.guilds, 10))
+    for guild_id, text in server.configs.items():
+        refresher.track(
+            guild_id, None if guild_id in legacy else refresh.config_hash(text)
+        )
+
+    start = time.monotonic()
+    await asyncio.sleep(args.interval * 1.5)
+    changed = set(range(0, args.guilds, 10))
+    failing = set(range(5, args.guilds, 10))
+    for guild_id in changed:
+        server.configs[guild_id] += "# changed\n"
+    server.failing = failing
+    failing_from = time.monotonic()
+    await asyncio.sleep(args.interval * (args.intervals - 1.5))
+
+    refresher.stop()
+    await client.close()
+    await runner.cleanup()
+
+    first = [min(r) - start for r in server.requests.values()]
+    total = sum(server.responses.values())
+    print(
+        f"{args.guilds} guilds, checked every {args.interval}s for {args.intervals} intervals"
+    )
+    print(
+        f"First checks spread over {min(first):.2f}s .. {max(first):.2f}s"
+        f" of a {args.interval}s interval"
+    )
+    print(
+        f"Requests: {total}, full downloads: {server.responses[200]},"
+        f" 304s: {server.responses[304]}, errors: {server.responses[500]}"
+    )
+    print(
+        f"Changed configs: {len(changed)}, set up again: {len(applied)}"
+        f" ({len(set(applied) - changed)} that hadn't changed,"
+        f" {len(set(applied) & legacy)} of {len(legacy)} with no hash),"
+        f" at most {peak} at once"
+    )
+    healthy = [
+        len([t for t in server.requests[g] if t >= failing_from])
+        for g in range(args.guilds)
+        if g not in failing
+    ]
+    broken = [
+        len([t for t in server.requests[g] if t >= failing_from]) for g in failing
+    ]
+    print(
+        f"Checks per guild after the errors started: healthy"
+        f" {sum(healthy) / len(healthy):.1f}, failing {sum(broken) / len(broken):.1f}"
+    )
+    ok = set(applied) == changed and peak <= refresh.RECONFIGURE_WORKERS
+    return 0 if ok else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.config_refresh")
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=2.0, help="Seconds")
+    parser.add_argument("--intervals", type=float, default=5.0, help="How long to run")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
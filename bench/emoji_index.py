@@ -0,0 +1,47 @@
+"""Micro-benchmark: emoji lookup tables per role-menu configure.
+
+Compares rebuilding the whole alias table on every configure (the old way)
+against the shared unicode index plus the cached per-guild overlay.
+
+    poetry run python -m bench.emoji_index
+"""
+import asyncio
+import timeit
+from types import SimpleNamespace
+
+import hikari
+from emojis.db.db import EMOJI_DB
+
+from dragonpaw_bot import utils
+
+ROUNDS = 20
+GUILD = SimpleNamespace(id=hikari.Snowflake(1))
+
+
+def rebuild_every_time() -> dict:
+    emoji_map = {}
+    for u in EMOJI_DB:
+        for alias in u.aliases:
+            emoji_map[alias] = hikari.UnicodeEmoji.parse(u.emoji)
+    return emoji_map
+
+
+def main() -> None:
+    bot = SimpleNamespace(custom_emojis={GUILD.id: {}})
+    loop = asyncio.new_event_loop()
+
+    def shared_index():
+        return loop.run_until_complete(utils.guild_emojis(bot=bot, guild=GUILD))
+
+    first = timeit.timeit(shared_index, number=1)
+    old = timeit.timeit(rebuild_every_time, number=ROUNDS) / ROUNDS
+    new = timeit.timeit(shared_index, number=ROUNDS) / ROUNDS
+    print(f"aliases:            {len(utils.unicode_emojis())}")
+    print(f"rebuild per config: {old * 1000:9.3f} ms")
+    print(f"index first build:  {first * 1000:9.3f} ms")
+    print(f"shared index:       {new * 1000:9.3f} ms")
+    print(f"speedup:            {old / new:9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,462 @@
+"""Benchmark: replay synthetic gateway events through the real listeners.
+
+Streams of reactions, member joins and rules clicks go straight into the
+listeners from the role_menus and lobby plugins. Behind them is a fake REST
+client that records every call, and simulates Discord's latency and
+per-route rate limit buckets. Reports events/sec, handler latency and REST
+calls per event for each combination of guild count and menu size.
+
+    poetry run python -O -m bench.event_replay --guilds 1,10,100 --options 5,20
+
+--bulk N has every guild seed N reactions at the same time, as if they were
+all running /config, to see how much that slows down the members clicking.
+--no-priority does that without the outbound REST scheduler's priorities.
+--join-wave N starts with N members joining the first guild at once.
+
+It has to be run with -O, like the bot is: the listeners assert on a class
+that is only imported for type checking.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import logging
+import random
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Iterator
+
+import hikari
+
+from dragonpaw_bot import routing, structs
+from dragonpaw_bot.joins import JoinAggregator
+from dragonpaw_bot.kicks import KickScheduler
+from dragonpaw_bot.members import MemberCache
+from dragonpaw_bot.mutations import RoleMutator
+from dragonpaw_bot.outbound import RestScheduler
+from dragonpaw_bot.plugins import lobby, role_menus
+from dragonpaw_bot.reconcile import Reconciler
+
+# How often each kind of event shows up. Most reactions in a busy guild are
+# on ordinary messages, not role menus.
+EVENT_MIX = {
+    "reaction_add": 45,
+    "reaction_remove": 15,
+    "reaction_other": 30,
+    "member_join": 5,
+    "rules_agreed": 5,
+}
+EMOJIS = [chr(0x1F600 + n) for n in range(80)]
+BOT_USER_ID = hikari.Snowflake(1)
+
+Handler = Callable[[Any], Awaitable[None]]
+
+
+# ---------------------------------------------------------------------------- #
+#                               A fake Discord                                 #
+# ---------------------------------------------------------------------------- #
+
+
+class FakeRest:
+    """Just enough of hikari's REST client for the listeners.
+
+    Every call counts against the global bucket, and one for its route and
+    major parameter, and waits when either is empty, like hikari does. Then it
+    takes `latency` seconds to answer."""
+
+    def __init__(self, latency: float, limit: int, window: float, global_limit: int):
+        self.latency = latency
+        self.limit = limit
+        self.window = window
+        self.global_limit = global_limit
+        self.calls: collections.Counter[str] = collections.Counter()
+        self.rate_limit_wait = 0.0
+        self.roles: dict[tuple[int, int], set[int]] = collections.defaultdict(set)
+        self._buckets: dict[tuple[str, int], list[float]] = {}
+        self._ids = iter(range(10**15, 10**16))
+
+    async def _take(self, key: tuple[str, int], limit: int, window: float) -> None:
+        loop = asyncio.get_running_loop()
+        # [when the window resets, calls left in it]
+        bucket = self._buckets.setdefault(key, [0.0, 0])
+        while True:
+            now = loop.time()
+            if now >= bucket[0]:
+                bucket[0], bucket[1] = now + window, limit
+            if bucket[1] > 0:
+                bucket[1] -= 1
+                return
+            self.rate_limit_wait += bucket[0] - now
+            await asyncio.sleep(bucket[0] - now)
+
+    async def _call(self, route: str, major: int) -> None:
+        self.calls[route] += 1
+        await self._take((route, major), self.limit, self.window)
+        await self._take(("global", 0), self.global_limit, 1.0)
+        await asyncio.sleep(self.latency)
+
+    def member(self, guild: int, user: int) -> FakeMember:
+        return FakeMember(rest=self, guild_id=guild, user_id=user)
+
+    async def add_role_to_member(self, guild, user, role, *, reason=None):
+        await self._call("PUT /guilds/{guild}/members/{user}/roles/{role}", guild)
+        self.roles[(guild, user)].add(role)
+
+    async def remove_role_from_member(self, guild, user, role, *, reason=None):
+        await self._call("DELETE /guilds/{guild}/members/{user}/roles/{role}", guild)
+        self.roles[(guild, user)].discard(role)
+
+    async def edit_member(self, guild, user, *, roles, reason=None):
+        await self._call("PATCH /guilds/{guild}/members/{user}", guild)
+        self.roles[(guild, user)] = set(roles)
+        return self.member(guild, user)
+
+    async def fetch_member(self, guild, user):
+        await self._call("GET /guilds/{guild}/members/{user}", guild)
+        return self.member(guild, user)
+
+    async def create_message(self, channel, content=None, **kwargs):
+        await self._call("POST /channels/{channel}/messages", channel)
+        return SimpleNamespace(id=hikari.Snowflake(next(self._ids)))
+
+    async def create_interaction_response(self, interaction, token, *args, **kwargs):
+        await self._call("POST /interactions/{interaction}/{token}/callback", 0)
+
+    async def kick_user(self, guild, user, *, reason=None):
+        await self._call("DELETE /guilds/{guild}/members/{user}", guild)
+
+    async def add_reaction(self, channel, message, emoji):
+        await self._call(
+            "PUT /channels/{channel}/messages/{message}/reactions/{emoji}/@me", channel
+        )
+
+
+class FakeMember:
+    def __init__(self, rest: FakeRest, guild_id: int, user_id: int):
+        self.rest = rest
+        self.guild_id = guild_id
+        self.id = hikari.Snowflake(user_id)
+        self.display_name = f"Member {user_id}"
+        self.mention = f"<@{user_id}>"
+        self.username = self.display_name
+
+    @property
+    def user(self) -> FakeMember:
+        return self
+
+    @property
+    def role_ids(self) -> list[int]:
+        return list(self.rest.roles[(self.guild_id, self.id)])
+
+    async def add_role(self, role, *, reason=None) -> None:
+        await self.rest.add_role_to_member(self.guild_id, self.id, role, reason=reason)
+
+
+class FakeBot:
+    """The in-memory side of DragonpawBot, with no store behind it."""
+
+    def __init__(
+        self,
+        rest: FakeRest,
+        states: list[structs.GuildState],
+        outbound: RestScheduler,
+    ):
+        self.rest = rest
+        self.outbound = outbound
+        self.members = MemberCache()
+        self.reconciler = Reconciler()
+        self.user_id = BOT_USER_ID
+        self._state: dict[int, structs.GuildState] = {}
+        self._routes: dict[int, routing.GuildRoutes] = {}
+        self.menu_message_ids: set[int] = set()
+        for state in states:
+            self.state_update(state)
+
+    def state(self, guild_id):
+        return self._state.get(guild_id)
+
+    def routes(self, guild_id):
+        return self._routes.get(guild_id)
+
+    def is_menu_reaction(self, guild_id, message_id) -> bool:
+        return message_id in self.menu_message_ids
+
+    def state_update(self, state: structs.GuildState) -> None:
+        routes = routing.GuildRoutes.from_state(state)
+        old = self._routes.get(state.id)
+        if old:
+            self.menu_message_ids -= old.message_ids
+        self.menu_message_ids |= routes.message_ids
+        self._state[state.id] = state
+        self._routes[state.id] = routes
+
+
+# ---------------------------------------------------------------------------- #
+#                                Synthetic guilds                              #
+# ---------------------------------------------------------------------------- #
+
+
+def make_state(n: int, menus: int, options: int) -> structs.GuildState:
+    base = (n + 1) * 1_000_000
+    roles = [hikari.Snowflake(base + r) for r in range(menus * options + 1)]
+    lobby_role_id = roles.pop()
+    role_emojis = {}
+    for m in range(menus):
+        menu = roles[m * options : (m + 1) * options]
+        for o, role_id in enumerate(menu):
+            # The first menu of each guild is a pick-1 menu.
+            role_emojis[
+                (hikari.Snowflake(base + 900_000 + m), EMOJIS[o % len(EMOJIS)])
+            ] = structs.RoleMenuOptionState(
+                add_role_id=role_id,
+                remove_role_ids=[r for r in menu if r != role_id] if m == 0 else [],
+            )
+    return structs.GuildState(
+        id=hikari.Snowflake(base),
+        name=f"Guild {n}",
+        config_url="https://gist.github.com/example/abc",
+        config_last=datetime.datetime.now(),
+        lobby_role_id=lobby_role_id,
+        lobby_channel_id=hikari.Snowflake(base + 800_000),
+        lobby_welcome_message="Welcome to our server {name}!",
+        lobby_kick_days=7,
+        lobby_click_for_rules=True,
+        lobby_rules="Be excellent to each other.",
+        role_channel_id=hikari.Snowflake(base + 800_001),
+        role_names={r: f"Role {r}" for r in [*roles, lobby_role_id]},
+        role_emojis=role_emojis,
+        role_message_ids=[hikari.Snowflake(base + 900_000 + m) for m in range(menus)],
+    )
+
+
+def event_stream(
+    bot: FakeBot, count: int, members: int, rng: random.Random
+) -> Iterator[tuple[str, Handler, Any]]:
+    """Events made up on the spot, so they see the roles members have now."""
+
+    states = list(bot._state.values())
+    menu_options = {s.id: list(s.role_emojis) for s in states}
+    kinds = list(EVENT_MIX)
+    weights = list(EVENT_MIX.values())
+
+    for n in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        state = rng.choice(states)
+        user_id = hikari.Snowflake(state.id + 1 + rng.randrange(members))
+        member = bot.rest.member(state.id, user_id)
+
+        if kind in ("reaction_add", "reaction_remove", "reaction_other"):
+            message_id, emoji = rng.choice(menu_options[state.id])
+            if kind == "reaction_other":
+                message_id = hikari.Snowflake(state.id + 700_000 + n)
+            event = SimpleNamespace(
+                guild_id=state.id,
+                channel_id=state.role_channel_id,
+                message_id=message_id,
+                emoji_name=emoji,
+                user_id=user_id,
+                member=member,
+            )
+            if kind == "reaction_remove":
+                yield kind, role_menus.on_reaction_remove, event
+            else:
+                yield kind, role_menus.on_reaction_add, event
+
+        elif kind == "member_join":
+            event = SimpleNamespace(
+                guild_id=state.id, user_id=user_id, user=member, member=member
+            )
+            yield kind, lobby.on_member_join, event
+
+        else:
+            interaction = hikari.ComponentInteraction(
+                app=bot,  # type: ignore
+                id=hikari.Snowflake(n + 1),
+                application_id=BOT_USER_ID,
+                type=hikari.InteractionType.MESSAGE_COMPONENT,
+                token="token",
+                version=1,
+                channel_id=state.lobby_channel_id,  # type: ignore
+                component_type=hikari.ComponentType.BUTTON,
+                custom_id=lobby.RULES_AGREED_ID,
+                values=(),
+                resolved=None,
+                guild_id=state.id,
+                guild_locale="en-US",
+                message=None,  # type: ignore
+                member=None,
+                user=member,  # type: ignore
+                locale="en-US",
+                app_permissions=None,
+            )
+            yield kind, lobby.on_interaction, SimpleNamespace(interaction=interaction)
+
+
+def join_wave(bot: FakeBot, count: int) -> Iterator[tuple[str, Handler, Any]]:
+    """A raid: `count` new members all joining the first guild at once."""
+
+    state = next(iter(bot._state.values()))
+    for n in range(count):
+        member = bot.rest.member(state.id, hikari.Snowflake(state.id + 600_000 + n))
+        event = SimpleNamespace(
+            guild_id=state.id, user_id=member.id, user=member, member=member
+        )
+        yield "join_wave", lobby.on_member_join, event
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Replay                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def replay(args: argparse.Namespace, guilds: int, options: int) -> dict:
+    rest = FakeRest(
+        latency=args.latency,
+        limit=args.bucket_limit,
+        window=args.window,
+        global_limit=args.global_limit,
+    )
+    if args.no_priority:
+        # As good as no scheduler at all.
+        outbound = RestScheduler(slots=sys.maxsize, bulk_slots=sys.maxsize)
+    else:
+        outbound = RestScheduler()
+    bot = FakeBot(
+        rest=rest,
+        states=[make_state(n, args.menus, options) for n in range(guilds)],
+        outbound=outbound,
+    )
+
+    role_menus.plugin.app = bot  # type: ignore
+    lobby.plugin.app = bot  # type: ignore
+    role_menus.mutator = RoleMutator(
+        apply=role_menus.apply_pending_roles, delay=args.debounce
+    )
+    lobby.kick_scheduler = KickScheduler(kick=lobby.kick_lobby_members)
+    lobby.joins = JoinAggregator(
+        add_role=lobby.add_lobby_role,
+        welcome=lobby.welcome_members,
+        window=args.debounce,
+    )
+
+    latencies: dict[str, list[float]] = collections.defaultdict(list)
+
+    async def run(kind: str, handler: Handler, event: Any) -> None:
+        start = time.perf_counter()
+        await handler(event)
+        latencies[kind].append(time.perf_counter() - start)
+
+    # Each listener call is its own task, like hikari's event manager does.
+    start = time.perf_counter()
+    tasks = []
+    bulk = [
+        asyncio.create_task(
+            role_menus.seed_reactions(
+                bot=bot,  # type: ignore
+                guild_id=state.id,
+                channel_id=state.role_channel_id,  # type: ignore
+                message_id=state.role_message_ids[0],
+                emojis=[EMOJIS[n % len(EMOJIS)] for n in range(args.bulk)],
+                limit=asyncio.Semaphore(role_menus.REACTION_CONCURRENCY),
+            )
+        )
+        for state in bot._state.values()
+        if args.bulk
+    ]
+    rng = random.Random(args.seed)
+    stream = event_stream(bot, args.events, args.members, rng)
+    if args.join_wave:
+        stream = itertools.chain(join_wave(bot, args.join_wave), stream)
+    for kind, handler, event in stream:
+        tasks.append(asyncio.create_task(run(kind, handler, event)))
+        if len(tasks) % args.burst == 0:
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    await role_menus.mutator.flush()
+    await lobby.joins.flush()
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*bulk)
+    lobby.kick_scheduler.stop()
+    lobby.joins.stop()
+
+    everything = [t for times in latencies.values() for t in times]
+    return {
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "p50": percentile(everything, 0.50),
+        "p99": percentile(everything, 0.99),
+        "calls": rest.calls,
+        "rate_limit_wait": rest.rate_limit_wait,
+    }
+
+
+def report(args: argparse.Namespace, guilds: int, options: int, r: dict) -> None:
+    calls = sum(r["calls"].values())
+    print(
+        f"{guilds:>7} {args.menus:>6} {options:>8} "
+        f"{args.events / r['elapsed']:>10.0f} "
+        f"{r['p50'] * 1000:>8.3f} {r['p99'] * 1000:>8.3f} "
+        f"{calls / args.events:>10.3f} {r['rate_limit_wait']:>8.2f}"
+    )
+    if args.verbose:
+        for kind, times in sorted(r["latencies"].items()):
+            print(
+                f"    {kind:<16} {len(times):>7} events"
+                f"  p50 {percentile(times, 0.5) * 1000:8.3f} ms"
+                f"  p99 {percentile(times, 0.99) * 1000:8.3f} ms"
+            )
+        for route, count in r["calls"].most_common():
+            print(f"    {count:>7}  {route}")
+
+
+def int_list(text: str) -> list[int]:
+    return [int(x) for x in text.split(",")]
+
+
+def main() -> None:
+    if __debug__:
+        sys.exit("Run this with python -O, see the docstring.")
+
+    parser = argparse.ArgumentParser(prog="python -O -m bench.event_replay")
+    parser.add_argument("--guilds", type=int_list, default=[1, 10, 100])
+    parser.add_argument("--menus", type=int, default=5)
+    parser.add_argument("--options", type=int_list, default=[5, 20])
+    parser.add_argument("--events", type=int, default=5_000)
+    parser.add_argument("--members", type=int, default=500, help="Per guild")
+    parser.add_argument("--burst", type=int, default=50, help="Events per tick")
+    parser.add_argument("--latency", type=float, default=0.02, help="REST, in s")
+    parser.add_argument("--bucket-limit", type=int, default=50)
+    parser.add_argument("--window", type=float, default=1.0, help="Bucket, in s")
+    parser.add_argument("--global-limit", type=int, default=50, help="Per second")
+    parser.add_argument("--bulk", type=int, default=0, help="Reactions per guild")
+    parser.add_argument("--no-priority", action="store_true")
+    parser.add_argument("--join-wave", type=int, default=0, help="Joins at once")
+    parser.add_argument("--debounce", type=float, default=0.05, help="In s")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # Logging every click would swamp whatever we're trying to measure.
+    logging.getLogger("dragonpaw_bot").setLevel(logging.WARNING)
+
+    print(
+        f"{'guilds':>7} {'menus':>6} {'options':>8} {'events/s':>10} "
+        f"{'p50 ms':>8} {'p99 ms':>8} {'REST/evt':>10} {'RL wait':>8}"
+    )
+    for guilds in args.guilds:
+        for options in args.options:
+            r = asyncio.run(replay(args, guilds, options))
+            report(args, guilds, options, r)
+
+
+if __name__ == "__main__":
+    main()
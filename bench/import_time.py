@@ -0,0 +1,76 @@
+"""Check: how long `import dragonpaw_bot.bot` takes, against a budget.
+
+Imports the bot in fresh interpreters with -X importtime, like the restart
+loop does, and fails if the best run is over budget, or if anything that
+should only load on first use got imported at startup.
+
+    poetry run python -m bench.import_time [--budget 2.0] [--runs 3]
+
+Exits with 1 on a regression, so it can be used in CI.
+"""
+from __future__ import annotations
+
+import argparse
+import re
+import subprocess
+import sys
+
+MODULE = "dragonpaw_bot.bot"
+# Seconds, for the whole import, hikari and lightbulb included.
+BUDGET = 2.0
+# Loaded when first needed, never at startup.
+LAZY_MODULES = ("palettable", "setuptools", "emojis", "toml")
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_times() -> dict[str, tuple[float, int]]:
+    """Module -> (cumulative seconds, nesting depth), for one cold import."""
+    stderr = subprocess.run(
+        [sys.executable, "-OO", "-X", "importtime", "-c", f"import {MODULE}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    times = {}
+    for match in LINE.finditer(stderr):
+        _, cumulative, indent, name = match.groups()
+        times[name] = (int(cumulative) / 1e6, (len(indent) - 1) // 2)
+    return times
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.import_time")
+    parser.add_argument("--budget", type=float, default=BUDGET, help="Seconds")
+    parser.add_argument("--runs", type=int, default=3, help="Best of this many")
+    parser.add_argument("--top", type=int, default=10, help="Slowest to show")
+    args = parser.parse_args(argv)
+
+    runs = [import_times() for _ in range(max(args.runs, 1))]
+    best = min(runs, key=lambda t: t[MODULE][0])
+    total = best[MODULE][0]
+
+    print(f"Slowest imports under {MODULE}:")
+    direct = [(s, name) for name, (s, depth) in best.items() if depth == 1]
+    for seconds, name in sorted(direct, reverse=True)[: args.top]:
+        print(f"  {seconds * 1000:9.1f} ms  {name}")
+    print(f"{MODULE}: {total * 1000:.1f} ms (budget {args.budget * 1000:.0f} ms)")
+
+    failed = False
+    eager = sorted(
+        name
+        for name in best
+        if name.split(".")[0] in LAZY_MODULES
+        and "." not in name  # Just the top of each package.
+    )
+    if eager:
+        print(f"Imported at startup, should be lazy: {', '.join(eager)}")
+        failed = True
+    if total > args.budget:
+        print(f"Over budget by {(total - args.budget) * 1000:.1f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""Benchmark: memory used per guild and per member, for each cache profile.
+
+Feeds synthetic GUILD_CREATE payloads and member events through hikari's
+own entity factory and cache, the way the gateway would, and measures RSS
+after the guilds and again after the members. "full" is hikari's default
+cache, with every member chunked in. "bot" is the bot's: hikari keeps only
+members.CACHE_COMPONENTS, roles and text channels go in the GuildIndexes,
+and members go through the bounded MemberCache.
+Both hold a guild state and its routes for every guild, like after warm-up.
+
+    poetry run python -m bench.memory --guilds 1000 --members 100000
+
+Each profile runs in its own process, so one can't bloat the other's RSS.
+"""
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import resource
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Iterator
+
+import hikari
+from hikari.impl import cache as cache_impl
+from hikari.impl import config as config_impl
+from hikari.impl import entity_factory as entity_factory_impl
+
+from bench.state_store import make_state
+from dragonpaw_bot import indexes, members, routing
+
+PROC_STATM = Path("/proc/self/statm")
+PROFILES = ("full", "bot")
+BOT_USER_ID = hikari.Snowflake(1)
+JOINED_AT = "2021-01-01T00:00:00+00:00"
+
+
+def rss() -> int:
+    gc.collect()
+    pages = int(PROC_STATM.read_text().split()[1])
+    return pages * resource.getpagesize()
+
+
+# ---------------------------------------------------------------------------- #
+#                               Synthetic payloads                             #
+# ---------------------------------------------------------------------------- #
+
+
+def member_payload(user_id: int, role_ids: list[str]) -> dict[str, Any]:
+    return {
+        "user": {
+            "id": str(user_id),
+            "username": f"member{user_id}",
+            "discriminator": "0",
+            "global_name": f"Member {user_id}",
+            "avatar": None,
+        },
+        "roles": role_ids,
+        "joined_at": JOINED_AT,
+        "nick": None,
+        "deaf": False,
+        "mute": False,
+    }
+
+
+def guild_payload(n: int, roles: int, channels: int, emojis: int) -> dict[str, Any]:
+    base = (n + 1) * 1_000_000
+    return {
+        "id": str(base),
+        "name": f"Guild {n}",
+        "owner_id": str(BOT_USER_ID),
+        "icon": None,
+        "splash": None,
+        "discovery_splash": None,
+        "banner": None,
+        "description": None,
+        "afk_channel_id": None,
+        "afk_timeout": 300,
+        "verification_level": 0,
+        "default_message_notifications": 0,
+        "explicit_content_filter": 0,
+        "features": [],
+        "mfa_level": 0,
+        "application_id": None,
+        "system_channel_id": None,
+        "system_channel_flags": 0,
+        "rules_channel_id": None,
+        "public_updates_channel_id": None,
+        "vanity_url_code": None,
+        "premium_tier": 0,
+        "preferred_locale": "en-US",
+        "nsfw_level": 0,
+        "joined_at": JOINED_AT,
+        "large": True,
+        "member_count": 0,
+        "roles": [
+            {
+                "id": str(base + r),
+                "name": f"Role {r}",
+                "color": 0,
+                "hoist": False,
+                "position": r,
+                "permissions": "0",
+                "managed": False,
+                "mentionable": False,
+            }
+            for r in range(roles)
+        ],
+        "channels": [
+            {
+                "id": str(base + 100_000 + c),
+                "guild_id": str(base),
+                "name": f"channel-{c}",
+                "type": 0,
+                "position": c,
+                "permission_overwrites": [],
+                "topic": None,
+                "nsfw": False,
+                "last_message_id": None,
+                "rate_limit_per_user": 0,
+                "parent_id": None,
+            }
+            for c in range(channels)
+        ],
+        "emojis": [
+            {
+                "id": str(base + 200_000 + e),
+                "name": f"emoji{e}",
+                "roles": [],
+                "require_colons": True,
+                "managed": False,
+                "animated": False,
+                "available": True,
+            }
+            for e in range(emojis)
+        ],
+        "members": [],
+        "voice_states": [],
+        "presences": [],
+        "threads": [],
+        "stickers": [],
+    }
+
+
+def member_events(
+    guild_ids: list[int], count: int, roles: int
+) -> Iterator[tuple[int, dict[str, Any]]]:
+    for m in range(count):
+        guild_id = guild_ids[m % len(guild_ids)]
+        role_ids = [str(guild_id + r) for r in range(m % 4)]
+        yield guild_id, member_payload(guild_id + 500_000 + m, role_ids[:roles])
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Profiles                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def measure(profile: str, args: argparse.Namespace) -> dict[str, Any]:
+    app = SimpleNamespace()
+    factory = entity_factory_impl.EntityFactoryImpl(app)  # type: ignore
+    if profile == "full":
+        settings = config_impl.CacheSettings()
+    else:
+        settings = config_impl.CacheSettings(components=members.CACHE_COMPONENTS)
+    cache = cache_impl.CacheImpl(app, settings)  # type: ignore
+    member_cache = members.MemberCache(size=args.member_cache_size)
+    guild_indexes = indexes.GuildIndexes()
+    states = {}
+    routes = {}
+
+    start = rss()
+    guild_ids = []
+    for n in range(args.guilds):
+        definition = factory.deserialize_gateway_guild(
+            guild_payload(n, args.roles, args.channels, args.emojis),
+            user_id=BOT_USER_ID,
+        )
+        guild = definition.guild()
+        guild_ids.append(int(guild.id))
+        cache.update_guild(guild)
+        for channel in definition.channels().values():
+            cache.set_guild_channel(channel)
+        for emoji in definition.emojis().values():
+            cache.set_emoji(emoji)
+        for role in definition.roles().values():
+            cache.set_role(role)
+        if profile == "bot":
+            guild_indexes.guild_set(
+                guild.id,
+                roles=definition.roles().values(),
+                channels=definition.channels().values(),
+            )
+        state = make_state(n)
+        states[state.id] = state
+        routes[state.id] = routing.GuildRoutes.from_state(state)
+    after_guilds = rss()
+
+    for guild_id, payload in member_events(guild_ids, args.members, args.roles):
+        member = factory.deserialize_member(
+            payload, guild_id=hikari.Snowflake(guild_id)
+        )
+        if profile == "full":
+            cache.set_member(member)
+        else:
+            member_cache.put(member)
+    after_members = rss()
+
+    return {
+        "profile": profile,
+        "guilds": args.guilds,
+        "members": args.members,
+        "cached_members": (
+            sum(len(m) for m in cache.get_members_view().values()) + len(member_cache)
+        ),
+        "rss": after_members,
+        "guild_bytes": after_guilds - start,
+        "member_bytes": after_members - after_guilds,
+    }
+
+
+def report(results: list[dict[str, Any]]) -> None:
+    print(
+        f"{'profile':>8} {'guilds':>7} {'members':>8} {'cached':>8}"
+        f" {'RSS MiB':>8} {'MiB/1k guilds':>14} {'MiB/100k members':>17}"
+    )
+    for r in results:
+        per_guilds = r["guild_bytes"] / max(r["guilds"], 1) * 1000 / 2**20
+        per_members = r["member_bytes"] / max(r["members"], 1) * 100_000 / 2**20
+        print(
+            f"{r['profile']:>8} {r['guilds']:>7} {r['members']:>8}"
+            f" {r['cached_members']:>8} {r['rss'] / 2**20:>8.1f}"
+            f" {per_guilds:>14.2f} {per_members:>17.2f}"
+        )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.memory")
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--members", type=int, default=100_000, help="In total")
+    parser.add_argument("--roles", type=int, default=40, help="Per guild")
+    parser.add_argument("--channels", type=int, default=30, help="Per guild")
+    parser.add_argument("--emojis", type=int, default=20, help="Per guild")
+    parser.add_argument(
+        "--member-cache-size", type=int, default=members.MEMBER_CACHE_SIZE
+    )
+    parser.add_argument("--profile", choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        # We're one of the children, started below.
+        print(json.dumps(measure(args.profile, args)))
+        return 0
+
+    argv = sys.argv[1:] if argv is None else argv
+    results = []
+    for profile in PROFILES:
+        output = subprocess.run(
+            [sys.executable, "-m", "bench.memory", *argv, "--profile", profile],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output))
+    report(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""Benchmark: catching up on role menu reactions missed while offline.
+
+Sets up a guild whose members have reacted to its menus, with roles to
+match, and runs a first reconciliation pass, which should change nothing.
+Then, as if the bot were down, some members react to new options, some
+take reactions off, and a moderator hands some roles out by hand. The
+second pass is interrupted partway through, and resumed from its
+checkpoint by a fresh reconciler, like after a restart. Reports how long
+each pass took, its REST calls, and checks every member ends up with the
+roles their reactions say, and keeps the ones given by hand.
+
+    poetry run python -O -m bench.reconcile --members 2000 --menus 3 --options 5
+
+It has to be run with -O, like the bot is: the listeners assert on a class
+that is only imported for type checking.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import collections
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import hikari
+
+from bench.event_replay import FakeBot, FakeRest, make_state
+from dragonpaw_bot import reconcile
+from dragonpaw_bot.outbound import RestScheduler
+from dragonpaw_bot.plugins import role_menus
+
+REACTIONS_ROUTE = "GET /channels/{channel}/messages/{message}/reactions/{emoji}"
+MEMBERS_ROUTE = "GET /guilds/{guild}/members"
+
+
+class ReactionRest(FakeRest):
+    """FakeRest, plus who reacted to what, and the member list."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reactions: dict[tuple[int, str], set[int]] = collections.defaultdict(set)
+
+    async def fetch_reactions_for_emoji(
+        self, channel, message, emoji
+    ) -> AsyncIterator[SimpleNamespace]:
+        users = sorted(self.reactions[(message, str(emoji))])
+        for n in range(0, len(users) + 1, role_menus.REACTIONS_PAGE):
+            await self._call(REACTIONS_ROUTE, channel)
+            for user_id in users[n : n + role_menus.REACTIONS_PAGE]:
+                yield SimpleNamespace(id=hikari.Snowflake(user_id))
+
+    async def fetch_members(self, guild) -> AsyncIterator[SimpleNamespace]:
+        members = sorted(u for g, u in self.roles if g == guild)
+        for n in range(0, len(members) + 1, role_menus.MEMBERS_PAGE):
+            await self._call(MEMBERS_ROUTE, guild)
+            for user_id in members[n : n + role_menus.MEMBERS_PAGE]:
+                yield self.member(guild, user_id)
+
+
+def setup(args: argparse.Namespace, rng: random.Random):
+    rest = ReactionRest(latency=args.latency, limit=50, window=1.0, global_limit=50)
+    state = make_state(0, args.menus, args.options)
+    bot = FakeBot(rest=rest, states=[state], outbound=RestScheduler())
+    bot.custom_emojis = {}
+    bot.cache = SimpleNamespace(
+        get_guild=lambda guild_id: SimpleNamespace(member_count=args.members)
+    )
+    role_menus.plugin.app = bot  # type: ignore
+
+    menus = collections.defaultdict(list)
+    for (message_id, emoji), option in state.role_emojis.items():
+        menus[message_id].append((message_id, emoji, option))
+    users = [state.id + 1 + n for n in range(args.members)]
+    for user_id in users:
+        rest.roles[(state.id, user_id)] = set()
+        for options in menus.values():
+            # Pick-1 menus get at most one reaction, the others any number.
+            single = any(o.remove_role_ids for _, _, o in options)
+            picks = rng.sample(options, 1) if single else options
+            for message_id, emoji, option in picks:
+                if rng.random() < args.react:
+                    rest.reactions[(message_id, emoji)].add(user_id)
+                    rest.roles[(state.id, user_id)].add(option.add_role_id)
+    return rest, bot, state, menus, users
+
+
+def miss_some(args, rng, rest: ReactionRest, state, menus, users) -> set[tuple]:
+    """What happens while the bot is down. Returns the roles given by hand."""
+    by_hand = set()
+    for user_id in rng.sample(users, int(len(users) * args.missed)):
+        message_id, options = rng.choice(list(menus.items()))
+        single = any(o.remove_role_ids for _, _, o in options)
+        mine = [(m, e) for m, e, _ in options if user_id in rest.reactions[(m, e)]]
+        if mine and rng.random() < 0.5:
+            rest.reactions[rng.choice(mine)].discard(user_id)
+        elif not single or not mine:
+            _, emoji, _ = rng.choice(options)
+            rest.reactions[(message_id, emoji)].add(user_id)
+    for user_id in rng.sample(users, int(len(users) * args.missed / 4)):
+        _, _, option = rng.choice(rng.choice(list(menus.values())))
+        if option.add_role_id not in rest.roles[(state.id, user_id)]:
+            rest.roles[(state.id, user_id)].add(option.add_role_id)
+            by_hand.add((user_id, option.add_role_id))
+    return by_hand
+
+
+def wrong_members(rest, state, menus, users, by_hand) -> int:
+    wrong = 0
+    for user_id in users:
+        expected = {r for u, r in by_hand if u == user_id}
+        for options in menus.values():
+            for message_id, emoji, option in options:
+                if user_id in rest.reactions[(message_id, emoji)]:
+                    expected.add(option.add_role_id)
+        if rest.roles[(state.id, user_id)] != expected:
+            wrong += 1
+    return wrong
+
+
+async def run_pass(
+    bot, state, checkpoint_dir: Path, interrupt_after: int | None = None
+) -> tuple[reconcile.ReconcileStats, float]:
+    reconciler = bot.reconciler = reconcile.Reconciler(checkpoint_dir=checkpoint_dir)
+    stats_seen = []
+
+    async def run(checkpoint, stats):
+        stats_seen.append(stats)
+        await role_menus.reconcile_guild(bot, checkpoint, stats)
+
+    start = time.perf_counter()
+    reconciler.submit(state.id, state.name, run)
+    task = reconciler._tasks[state.id]
+    if interrupt_after is not None:
+        while len(reconciler.checkpoint(state.id).fetched or ()) < interrupt_after:
+            await asyncio.sleep(0.001)
+        reconciler.stop()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return stats_seen[0], time.perf_counter() - start
+
+
+async def bench(args: argparse.Namespace) -> int:
+    rng = random.Random(args.seed)
+    rest, bot, state, menus, users = setup(args, rng)
+    checkpoint_dir = Path(tempfile.mkdtemp())
+
+    def report(label: str, stats: reconcile.ReconcileStats, elapsed: float):
+        print(
+            f"{label:<22} {elapsed:>7.2f}s {stats.rest_calls:>6} calls"
+            f" {stats.reactors:>6} reactors {stats.added:>5} added"
+            f" {stats.removed:>5} removed"
+        )
+
+    stats, elapsed = await run_pass(bot, state, checkpoint_dir)
+    report("first pass", stats, elapsed)
+    changed = stats.added + stats.removed
+
+    by_hand = miss_some(args, rng, rest, state, menus, users)
+    before = wrong_members(rest, state, menus, users, by_hand)
+    stats, elapsed = await run_pass(
+        bot, state, checkpoint_dir, interrupt_after=len(state.role_emojis) // 2
+    )
+    report("interrupted", stats, elapsed)
+    stats, elapsed = await run_pass(bot, state, checkpoint_dir)
+    report("resumed", stats, elapsed)
+    after = wrong_members(rest, state, menus, users, by_hand)
+
+    print(
+        f"{args.members} members, {len(state.role_emojis)} options:"
+        f" {before} members out of step before, {after} after,"
+        f" {len(by_hand)} roles given by hand"
+    )
+    return 0 if after == 0 and changed == 0 else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.reconcile")
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--menus", type=int, default=3)
+    parser.add_argument("--options", type=int, default=5)
+    parser.add_argument("--react", type=float, default=0.3, help="Odds per option")
+    parser.add_argument("--missed", type=float, default=0.1, help="Of the members")
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    return asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Benchmark: loading and saving guild state, pickle files vs SQLite.
+
+    poetry run python -m bench.state_store [guild counts...]
+"""
+import datetime
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import hikari
+
+from dragonpaw_bot import store, structs
+
+MENUS = 5
+OPTIONS = 6
+
+
+def make_state(n: int) -> structs.GuildState:
+    base = n * 1000
+    roles = [hikari.Snowflake(base + r) for r in range(MENUS * OPTIONS)]
+    role_emojis = {}
+    for m in range(MENUS):
+        menu = roles[m * OPTIONS : (m + 1) * OPTIONS]
+        for o, role_id in enumerate(menu):
+            role_emojis[
+                (hikari.Snowflake(base + 900 + m), f"emoji{o}")
+            ] = structs.RoleMenuOptionState(
+                add_role_id=role_id,
+                remove_role_ids=[r for r in menu if r != role_id],
+            )
+    return structs.GuildState(
+        id=hikari.Snowflake(n + 1),
+        name=f"Guild {n}",
+        config_url="https://gist.github.com/example/abc",
+        config_last=datetime.datetime.now(),
+        lobby_welcome_message="Welcome to our server {name}!",
+        lobby_rules="Be excellent to each other.",
+        role_names={r: f"Role {r}" for r in roles},
+        role_emojis=role_emojis,
+        role_message_ids=[hikari.Snowflake(base + 900 + m) for m in range(MENUS)],
+    )
+
+
+def timed(f) -> float:
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def bench(name: str, make_store, states: list[structs.GuildState]) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        s = make_store(Path(tmp))
+        save_all = timed(lambda: [s.save(state) for state in states])
+        # Now a typical update: one guild, one role renamed.
+        one = states[len(states) // 2]
+        one.role_names[next(iter(one.role_names))] = "Renamed"
+        save_one = timed(lambda: s.save(one))
+        s.close()
+
+        s = make_store(Path(tmp))
+        load_all = timed(s.load_all)
+        load_one = timed(lambda: s.load(one.id))
+        s.close()
+
+    print(
+        f"{name:>7} {len(states):>6} guilds: "
+        f"save all {save_all * 1000:9.1f} ms, "
+        f"save one {save_one * 1000:7.2f} ms, "
+        f"load all {load_all * 1000:9.1f} ms, "
+        f"load one {load_one * 1000:7.2f} ms"
+    )
+
+
+def main() -> None:
+    counts = [int(n) for n in sys.argv[1:]] or [1, 100, 5000]
+    for count in counts:
+        states = [make_state(n) for n in range(count)]
+        bench("pickle", lambda d: store.PickleStore(d), states)
+        bench("sqlite", lambda d: store.SqliteStore(d / "state.sqlite3"), states)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
-from dragonpaw_bot.bot import bot
+from dragonpaw_bot.bot import main
 
-bot.run()
+main()
@@ -1,20 +1,35 @@
 #!/usr/bin/env python
+import asyncio
 import datetime
 import logging
-import pickle
+import time
 from os import environ
 from pathlib import Path
+from typing import Mapping
 
 import dotenv
 import hikari
 import hikari.messages
 import lightbulb
-import safer
-import toml
 import uvloop
 
-from dragonpaw_bot import http, structs, utils
-from dragonpaw_bot.plugins.lobby import configure_lobby
+from dragonpaw_bot import (
+    cluster,
+    http,
+    indexes,
+    members,
+    metrics,
+    outbound,
+    persist,
+    reconcile,
+    refresh,
+    routing,
+    store,
+    structs,
+    utils,
+)
+from dragonpaw_bot.compile import ConfigSyntaxError, config_parse_toml
+from dragonpaw_bot.plugins.lobby import configure_lobby, lobby_deadlines_keep
 from dragonpaw_bot.plugins.role_menus import configure_role_menus
 
 dotenv.load_dotenv()
@@ -22,10 +37,21 @@ dotenv.load_dotenv()
 logging.getLogger("dragonpaw_bot").setLevel(logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-uvloop.install()
-
 ROOT_DIR = Path(__file__).resolve().parent.parent
 STATE_DIR = ROOT_DIR / "state"
+HTTP_CACHE_DIR = STATE_DIR / "http-cache"
+RECONCILE_DIR = STATE_DIR / "reconcile"
+STATE_BACKEND = environ.get("STATE_BACKEND", "sqlite")
+# Where the state server is, for the "remote" backend. See cluster.py.
+STATE_URL = environ.get("STATE_URL")
+# How many guilds to load at startup: "all", "off", or a number.
+STATE_WARMUP = environ.get("STATE_WARMUP", "all")
+STATE_WARMUP_WORKERS = 8
+# Port for /metrics, /healthz and /readyz. No port, no server.
+METRICS_PORT = int(environ.get("METRICS_PORT", 0))
+# How often to check configs for changes, in minutes. 0 to only use /config.
+CONFIG_REFRESH_MINUTES = float(environ.get("CONFIG_REFRESH_MINUTES", 0))
+MEMBER_CACHE_SIZE = int(environ.get("MEMBER_CACHE_SIZE", members.MEMBER_CACHE_SIZE))
 
 # ACTIVITY = "Doing bot things, thinking bot thoughts..."
 VALIDATION_ERROR = (
@@ -36,17 +62,15 @@ VALIDATION_ERROR = (
 OAUTH_PERMISSIONS = (
     hikari.Permissions.SEND_MESSAGES
     | hikari.Permissions.MANAGE_ROLES
-    # | hikari.Permissions.MANAGE_MESSAGES
+    | hikari.Permissions.MANAGE_MESSAGES  # Needed to bulk delete my old messages
     | hikari.Permissions.READ_MESSAGE_HISTORY  # Needed to find own old messages
     | hikari.Permissions.ADD_REACTIONS
     | hikari.Permissions.KICK_MEMBERS
     | hikari.Permissions.USE_APPLICATION_COMMANDS
 ).value
-CLIENT_ID = environ["CLIENT_ID"]
 OAUTH_URL = "https://discord.com/api/oauth2/authorize?client_id={CLIENT_ID}&permissions={OAUTH_PERMISSIONS}&scope=applications.commands%20bot"
 INTENTS = (
-    hikari.Intents.GUILD_MESSAGES
-    | hikari.Intents.GUILD_MESSAGE_REACTIONS
+    hikari.Intents.GUILD_MESSAGE_REACTIONS
     | hikari.Intents.GUILDS
     | hikari.Intents.GUILD_MEMBERS
     | hikari.Intents.GUILD_EMOJIS
@@ -64,95 +88,361 @@ class DragonpawBot(lightbulb.BotApp):
             token=environ["BOT_TOKEN"],
             default_enabled_guilds=TEST_GUILDS,
             intents=INTENTS,
+            cache_settings=hikari.impl.CacheSettings(
+                components=members.CACHE_COMPONENTS
+            ),
+            # Nothing would keep the members, so don't ask for them.
+            auto_chunk_members=False,
             force_color=True,
         )
         self._state: dict[hikari.Snowflake, structs.GuildState] = {}
+        self._routes: dict[hikari.Snowflake, routing.GuildRoutes] = {}
+        # Guilds we know have no state, so we don't keep asking the store.
+        self._no_state: set[hikari.Snowflake] = set()
+        # Once everything was warmed up, any guild not in memory has no state.
+        self._state_complete = False
+        # Every role menu message, across all guilds.
+        self.menu_message_ids: set[int] = set()
         self.user_id: hikari.Snowflake | None
+        self.http = http.HttpClient(cache_dir=HTTP_CACHE_DIR)
+        # Which shards we run, and so which guilds are ours. Not `shards`:
+        # that is hikari's, the running shards themselves.
+        self.shard_range = cluster.Shards.from_env()
+        self.store = store.open_store(STATE_DIR, backend=STATE_BACKEND, url=STATE_URL)
+        self.persister = persist.StatePersister(self.store)
+        self.persister.start()
+        metrics.instrument_rest(self.rest)
+        # REST calls take a slot from here, interactive ones first.
+        self.outbound = outbound.RestScheduler()
+        self.metrics_server = (
+            metrics.MetricsServer(self, METRICS_PORT) if METRICS_PORT else None
+        )
+        self.custom_emojis: dict[
+            hikari.Snowflake, Mapping[str, hikari.KnownCustomEmoji]
+        ] = {}
+        self.members = members.MemberCache(size=MEMBER_CACHE_SIZE)
+        # Every guild's roles and text channels, by name.
+        self.indexes = indexes.GuildIndexes()
+        # Catches up on role menu reactions made while we were away.
+        self.reconciler = reconcile.Reconciler(checkpoint_dir=RECONCILE_DIR)
+        # Other processes can change our guilds' states, if they're shared.
+        self.watcher = (
+            cluster.StateWatcher(
+                self.store.url,
+                client_id=self.store.client_id,
+                shards=self.shard_range,
+                on_change=self.state_changed,
+            )
+            if isinstance(self.store, store.RemoteStore)
+            else None
+        )
+        self.refresher = (
+            refresh.ConfigRefresher(
+                poll=lambda guild_id: config_poll(self, guild_id),
+                apply=lambda guild_id, text: config_apply(self, guild_id, text),
+                interval=CONFIG_REFRESH_MINUTES * 60,
+            )
+            if CONFIG_REFRESH_MINUTES
+            else None
+        )
 
     def state(self, guild_id: hikari.Snowflake) -> structs.GuildState | None:
         # If we don't have a state in-memory, maybe there is one on disk?
         if guild_id not in self._state:
-            state = state_load_pickle(guild_id=guild_id)
+            if self._state_complete or guild_id in self._no_state:
+                return None
+            state = self.store.load(guild_id=guild_id)
             if state:
                 # If that returned a state, cache it.
-                self._state[guild_id] = state
+                self._state_set(state, routing.GuildRoutes.from_state(state))
+            else:
+                self._no_state.add(guild_id)
 
         # And return whatever is cached, if any...
         return self._state.get(guild_id)
 
-    def state_update(self, state: structs.GuildState):
+    def _state_set(
+        self, state: structs.GuildState, routes: routing.GuildRoutes
+    ) -> None:
+        old = self._routes.get(state.id)
+        if old:
+            self.menu_message_ids -= old.message_ids
+        self.menu_message_ids |= routes.message_ids
         self._state[state.id] = state
-        state_save_pickle(state=state)
-
-
-bot = DragonpawBot()
-
-# ---------------------------------------------------------------------------- #
-#                                 File handling                                #
-# ---------------------------------------------------------------------------- #
-
-
-def state_path(guild_id: hikari.Snowflake, extention="toml"):
-    return Path(STATE_DIR, str(guild_id) + "." + extention)
-
-
-def state_save_pickle(state: structs.GuildState):
-    filename = state_path(state.id, extention="pickle")
-    logger.info("G=%r Saving state to: %s", state.name, filename)
-    with safer.open(filename, "wb") as f:
-        pickle.dump(obj=state.dict(), file=f)
-
-
-def state_load_pickle(guild_id: hikari.Snowflake) -> structs.GuildState | None:
-    filename = state_path(guild_id=guild_id, extention="pickle")
+        self._routes[state.id] = routes
+        self._no_state.discard(state.id)
+
+    def state_warm_up(self, limit: int | None = None) -> None:
+        """Load the state of (up to limit) guilds, before any events arrive."""
+
+        start = time.perf_counter()
+        # Only the guilds on our own shards, the rest are someone else's.
+        guild_ids = [g for g in self.store.guild_ids() if self.shard_range.owns(g)]
+        wanted = [g for g in guild_ids if g not in self._state][:limit]
+        states = self.store.load_many(wanted, workers=STATE_WARMUP_WORKERS)
+        routes = [routing.GuildRoutes.from_state(s) for s in states]
+        for state, r in zip(states, routes):
+            self._state_set(state, r)
+        # Only if every guild with a state really loaded. Any that didn't are
+        # loaded one at a time when they're needed, not taken to have none.
+        self._state_complete = all(g in self._state for g in guild_ids)
+        failed = [g for g in wanted if g not in self._state]
+        if failed:
+            logger.warning(
+                "%d guild(s) failed to load, will try again when needed", len(failed)
+            )
+        logger.info(
+            "Warmed up %d of %d guilds (%d reaction routes) in %.2fs",
+            len(states),
+            len(guild_ids),
+            sum(len(r.actions) for r in routes),
+            time.perf_counter() - start,
+        )
 
-    if not filename.exists():
-        logger.debug("No state file for guild: %d", guild_id)
-        return None
+    def routes(self, guild_id: hikari.Snowflake) -> routing.GuildRoutes | None:
+        """The reaction routes for a guild, loading its state if needed."""
+        if guild_id not in self._routes:
+            self.state(guild_id)
+        return self._routes.get(guild_id)
+
+    def is_menu_reaction(self, guild_id: hikari.Snowflake, message_id: int) -> bool:
+        """Could a reaction on this message possibly be for a role menu?
+
+        This is on the path of every reaction in every guild, so it answers
+        from memory whenever it can."""
+        if message_id in self.menu_message_ids:
+            return True
+        if guild_id in self._routes or guild_id in self._no_state:
+            return False
+        if self._state_complete:
+            return False
+        # A guild we haven't looked at yet, so go look.
+        self.state(guild_id)
+        return message_id in self.menu_message_ids
+
+    async def state_changed(self, guild_id: hikari.Snowflake, saved_at: float):
+        """Another process saved a guild of ours, so load it again."""
+        state = await asyncio.to_thread(self.store.load, guild_id)
+        if state:
+            self._state_set(state, routing.GuildRoutes.from_state(state))
+        else:
+            old = self._routes.pop(guild_id, None)
+            if old:
+                self.menu_message_ids -= old.message_ids
+            self._state.pop(guild_id, None)
+        logger.info(
+            "G=%r State changed elsewhere, reloaded after %.3fs",
+            state.name if state else guild_id,
+            time.time() - saved_at,
+        )
+        await self.dispatch(
+            cluster.StateChangedEvent(app=self, guild_id=guild_id, state=state)
+        )
 
-    logger.debug("Loading state from: %s", filename)
-    try:
-        with safer.open(filename, "rb") as f:
-            return structs.GuildState.parse_obj(pickle.load(f))
-    except Exception as e:
-        logger.exception("Error loading file: %r", e)
-        return None
+    def state_update(self, state: structs.GuildState):
+        self._state_set(state, routing.GuildRoutes.from_state(state))
+        self.persister.mark_dirty(state)
 
 
 # ---------------------------------------------------------------------------- #
 #                                   Handlers                                   #
 # ---------------------------------------------------------------------------- #
 
+# The bot's own listeners and commands. They're a plugin like the others, so
+# nothing needs a bot to exist just to import this module.
+plugin = lightbulb.Plugin("Dragonpaw")
+
 
-@bot.listen()
+@plugin.listener(event=hikari.ShardReadyEvent)
 async def on_ready(event: hikari.ShardReadyEvent) -> None:
     """Post-initialization for the bot."""
+    assert isinstance(plugin.bot, DragonpawBot)
     logger.info("Connected to Discord as %r", event.my_user)
     logger.info(
         "Use this URL to add this bot to a server: %s",
-        OAUTH_URL.format(CLIENT_ID=CLIENT_ID, OAUTH_PERMISSIONS=OAUTH_PERMISSIONS),
+        OAUTH_URL.format(
+            CLIENT_ID=environ["CLIENT_ID"], OAUTH_PERMISSIONS=OAUTH_PERMISSIONS
+        ),
     )
-    bot.user_id = event.my_user.id
+    plugin.bot.user_id = event.my_user.id
     # await bot.update_presence(
     #     activity=hikari.Activity(type=hikari.ActivityType.CUSTOM, name=ACTIVITY)
     # )
 
 
-@bot.listen()
+@plugin.listener(event=hikari.StartingEvent)
+async def on_starting(event: hikari.StartingEvent) -> None:
+    bot = plugin.bot
+    assert isinstance(bot, DragonpawBot)
+
+    # Up first, so the liveness probe passes while we warm up.
+    if bot.metrics_server:
+        await bot.metrics_server.start()
+
+    # Build the emoji index off the event loop, before anyone needs it.
+    await asyncio.to_thread(utils.unicode_emojis)
+
+    # The shards don't connect until this is done, so every guild that shows
+    # up is already in memory.
+    if isinstance(bot.store, store.RemoteStore):
+        # Anything not warmed up would be loaded over HTTP by bot.state(),
+        # blocking the event loop, so with a remote store it's all or nothing.
+        if STATE_WARMUP != "all":
+            logger.warning("STATE_WARMUP=%r ignored, the store is remote", STATE_WARMUP)
+        await asyncio.to_thread(bot.state_warm_up)
+    elif STATE_WARMUP == "off":
+        logger.info("Skipping state warm-up")
+    else:
+        limit = None if STATE_WARMUP == "all" else int(STATE_WARMUP)
+        await asyncio.to_thread(bot.state_warm_up, limit)
+
+    if bot.watcher:
+        bot.watcher.start()
+
+
+@plugin.listener(event=hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent) -> None:
+    assert isinstance(plugin.bot, DragonpawBot)
+    if plugin.bot.refresher:
+        plugin.bot.refresher.stop()
+    plugin.bot.reconciler.stop()
+    await plugin.bot.http.close()
+    await asyncio.to_thread(plugin.bot.persister.stop)
+    if plugin.bot.watcher:
+        await plugin.bot.watcher.stop()
+
+
+@plugin.listener(event=hikari.StoppedEvent)
+async def on_stopped(event: hikari.StoppedEvent) -> None:
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.store.close()
+    if plugin.bot.metrics_server:
+        await plugin.bot.metrics_server.stop()
+
+
+@plugin.listener(event=hikari.GuildAvailableEvent)
 async def on_guild_available(event: hikari.GuildAvailableEvent):
-    state = bot.state(guild_id=event.guild_id)
+    assert isinstance(plugin.bot, DragonpawBot)
+    utils.guild_emojis_update(
+        bot=plugin.bot, guild_id=event.guild_id, emojis=event.emojis.values()
+    )
+    plugin.bot.indexes.guild_set(
+        event.guild_id, roles=event.roles.values(), channels=event.channels.values()
+    )
+
+    state = plugin.bot.state(guild_id=event.guild_id)
     if state:
         logger.info("G=%r State loaded from disk, resuming services", state.name)
+        if plugin.bot.refresher:
+            plugin.bot.refresher.track(state.id, state.config_hash)
     else:
         guild = event.get_guild()
         name = (guild and guild.name) or event.guild_id
         logger.info("G=%r No state found, so nothing to do.", name)
 
 
-@bot.listen()
+@plugin.listener(event=hikari.EmojisUpdateEvent)
+async def on_emojis_update(event: hikari.EmojisUpdateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    utils.guild_emojis_update(
+        bot=plugin.bot, guild_id=event.guild_id, emojis=event.emojis
+    )
+
+
+@plugin.listener(event=hikari.GuildLeaveEvent)
+async def on_guild_leave(event: hikari.GuildLeaveEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.custom_emojis.pop(event.guild_id, None)
+    plugin.bot.members.discard_guild(event.guild_id)
+    plugin.bot.indexes.discard_guild(event.guild_id)
+    if plugin.bot.refresher:
+        plugin.bot.refresher.forget(event.guild_id)
+
+
+@plugin.listener(event=hikari.MemberCreateEvent)
+async def on_member_create(event: hikari.MemberCreateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.members.put(event.member)
+
+
+@plugin.listener(event=hikari.MemberUpdateEvent)
+async def on_member_update(event: hikari.MemberUpdateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.members.put(event.member)
+
+
+@plugin.listener(event=hikari.MemberDeleteEvent)
+async def on_member_delete(event: hikari.MemberDeleteEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.members.discard(event.guild_id, event.user_id)
+
+
+@plugin.listener(event=hikari.GuildJoinEvent)
 async def on_guild_join(event: hikari.GuildJoinEvent):
-    guild = await bot.rest.fetch_guild(guild=event.guild_id)
-    logger.info("G=%r Joined server.", guild.name)
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.guild_set(
+        event.guild_id, roles=event.roles.values(), channels=event.channels.values()
+    )
+    logger.info("G=%r Joined server.", event.guild.name)
+
+
+@plugin.listener(event=hikari.RoleCreateEvent)
+async def on_role_create(event: hikari.RoleCreateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.role_set(event.role)
+    role_names_update(plugin.bot, event.guild_id, event.role.id, event.role.name)
+
+
+@plugin.listener(event=hikari.RoleUpdateEvent)
+async def on_role_update(event: hikari.RoleUpdateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.role_set(event.role)
+    role_names_update(plugin.bot, event.guild_id, event.role.id, event.role.name)
+
+
+@plugin.listener(event=hikari.RoleDeleteEvent)
+async def on_role_delete(event: hikari.RoleDeleteEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.role_delete(event.guild_id, event.role_id)
+    role_names_update(plugin.bot, event.guild_id, event.role_id, None)
+
+
+@plugin.listener(event=hikari.GuildChannelCreateEvent)
+async def on_channel_create(event: hikari.GuildChannelCreateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.channel_set(event.channel)
+
+
+@plugin.listener(event=hikari.GuildChannelUpdateEvent)
+async def on_channel_update(event: hikari.GuildChannelUpdateEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.channel_set(event.channel)
+
+
+@plugin.listener(event=hikari.GuildChannelDeleteEvent)
+async def on_channel_delete(event: hikari.GuildChannelDeleteEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    plugin.bot.indexes.channel_delete(event.guild_id, event.channel_id)
+
+
+def role_names_update(
+    bot: DragonpawBot,
+    guild_id: hikari.Snowflake,
+    role_id: hikari.Snowflake,
+    name: str | None,
+) -> None:
+    """Keep the role names in a guild's state current, None for deleted."""
+    state = bot.state(guild_id)
+    if not state or state.role_names.get(role_id) == name:
+        return
+    role_names = dict(state.role_names)
+    if name is None:
+        del role_names[role_id]
+        logger.info("G=%r Role deleted: %r", state.name, state.role_names[role_id])
+    else:
+        role_names[role_id] = name
+        logger.info("G=%r Role is now called: %r", state.name, name)
+    bot.state_update(state.copy(update={"role_names": role_names}))
 
 
 # ---------------------------------------------------------------------------- #
@@ -160,8 +450,14 @@ async def on_guild_join(event: hikari.GuildJoinEvent):
 # ---------------------------------------------------------------------------- #
 
 
-@bot.command
+@plugin.command
 @lightbulb.add_checks(lightbulb.has_guild_permissions(hikari.Permissions.MANAGE_ROLES))
+@lightbulb.option(
+    "force",
+    "Set everything up again, even if the config hasn't changed",
+    type=bool,
+    default=False,
+)
 @lightbulb.option("url", "Link to the config you wish to use")
 @lightbulb.command(
     "config",
@@ -176,10 +472,20 @@ async def config(ctx: lightbulb.Context) -> None:
 
     await ctx.respond("Config loading now...")
 
-    g = await bot.rest.fetch_guild(guild=ctx.guild_id)
+    g = ctx.app.cache.get_guild(ctx.guild_id) or await ctx.app.rest.fetch_guild(
+        guild=ctx.guild_id
+    )
     logger.info("G=%r Setting up guild with file %r", g.name, ctx.options.url)
     assert isinstance(ctx.app, DragonpawBot)
-    await configure_guild(bot=ctx.app, guild=g, url=ctx.options.url)
+    changed = await configure_guild(
+        bot=ctx.app, guild=g, url=ctx.options.url, force=ctx.options.force
+    )
+    if not changed:
+        await ctx.respond(
+            "That config hasn't changed, so there's nothing to do. If you've "
+            "fixed something in Discord since, like a missing role or channel, "
+            "run `/config` again with `force` set to True."
+        )
 
 
 # ---------------------------------------------------------------------------- #
@@ -187,26 +493,66 @@ async def config(ctx: lightbulb.Context) -> None:
 # ---------------------------------------------------------------------------- #
 
 
-def config_parse_toml(guild: hikari.Guild, text: str) -> structs.GuildConfig:
-    logger.info("G=%r Loading TOML config for guild: %r", guild.name, guild)
+async def config_fetch(bot: DragonpawBot, url: str) -> str:
+    # Both of these revalidate with the cached copy, so no change is a 304.
+    if url.startswith("https://gist.github.com"):
+        return await bot.http.get_gist(url)
+    return await bot.http.get_text(url)
 
-    data = toml.loads(text)
-    return structs.GuildConfig.parse_obj(data)
 
+async def config_poll(bot: DragonpawBot, guild_id: int) -> str | None:
+    """The current text of a guild's config, for the refresher."""
+    state = bot.state(hikari.Snowflake(guild_id))
+    if not state:
+        return None
+    return await config_fetch(bot, state.config_url)
 
-async def configure_guild(bot: DragonpawBot, guild: hikari.Guild, url: str) -> None:
-    """Load the config for a guild and start setting up everything there."""
 
-    if url.startswith("https://gist.github.com"):
-        config_text = await http.get_gist(url)
+async def config_apply(bot: DragonpawBot, guild_id: int, text: str) -> None:
+    """Set a guild up again, with the changed config the refresher found."""
+    state = bot.state(hikari.Snowflake(guild_id))
+    if not state:
+        return
+    # The guild is in hikari's cache, but that's only a guess until it's ready.
+    guild = bot.cache.get_guild(guild_id) or await bot.rest.fetch_guild(guild_id)
+    await configure_guild(bot=bot, guild=guild, url=state.config_url, text=text)
+
+
+async def configure_guild(
+    bot: DragonpawBot,
+    guild: hikari.Guild,
+    url: str,
+    force: bool = False,
+    text: str | None = None,
+) -> bool:
+    """Load the config for a guild and start setting up everything there.
+
+    If the text of the config is given, it isn't fetched again. Returns
+    False if the config was the same as last time, so nothing was done."""
+
+    if text is None:
+        with utils.timed(guild.name, "Fetching config"):
+            config_text = await config_fetch(bot, url)
     else:
-        config_text = await http.get_text(url)
+        config_text = text
+
+    previous = bot.state(guild.id)
+    config_hash = refresh.config_hash(config_text)
+    if (
+        not force
+        and previous
+        and previous.config_url == url
+        and previous.config_hash == config_hash
+    ):
+        logger.info("G=%r Config hasn't changed, skipping.", guild.name)
+        return False
+
     try:
-        config = config_parse_toml(guild=guild, text=config_text)
-    except toml.decoder.TomlDecodeError as e:
+        config = config_parse_toml(guild_name=guild.name, text=config_text)
+    except ConfigSyntaxError as e:
         logger.error("Error parsing TOML file: %s", e)
         await utils.report_errors(bot=bot, guild_id=guild.id, error=str(e))
-        return
+        return True
 
     role_map = await utils.guild_roles(bot=bot, guild=guild)
 
@@ -215,19 +561,22 @@ async def configure_guild(bot: DragonpawBot, guild: hikari.Guild, url: str) -> N
         name=guild.name,
         config_url=url,
         config_last=datetime.datetime.now(),
+        config_hash=config_hash,
         role_names={r.id: r.name for r in role_map.values()},
         role_emojis={},
     )
 
     # Start setting up the guild
     if config.roles:
-        errors = await configure_role_menus(
-            bot=bot,
-            guild=guild,
-            config=config.roles,
-            state=state,
-            role_map=role_map,
-        )
+        with utils.timed(guild.name, "Configuring role menus"):
+            errors = await configure_role_menus(
+                bot=bot,
+                guild=guild,
+                config=config.roles,
+                state=state,
+                previous=previous,
+                role_map=role_map,
+            )
         for e in errors:
             logger.error("Error setting up role menus: %r", e)
             await utils.report_errors(bot=bot, guild_id=guild.id, error=e)
@@ -235,23 +584,59 @@ async def configure_guild(bot: DragonpawBot, guild: hikari.Guild, url: str) -> N
         logger.debug("No roles menus")
 
     if config.lobby:
-        errors = await configure_lobby(
-            bot=bot,
-            guild=guild,
-            config=config.lobby,
-            state=state,
-            role_map=role_map,
-        )
+        with utils.timed(guild.name, "Configuring lobby"):
+            errors = await configure_lobby(
+                bot=bot,
+                guild=guild,
+                config=config.lobby,
+                state=state,
+                previous=previous,
+                role_map=role_map,
+            )
         for e in errors:
             logger.error("Error setting up lobby: %r", e)
             await utils.report_errors(bot=bot, guild_id=guild.id, error=e)
     else:
         logger.debug("No lobby.")
 
+    # Setting up can take minutes, and members joining and roles changing
+    # don't wait for it. Take what they changed from the live state and the
+    # index, not from the copies we started with.
+    lobby_deadlines_keep(state=state, current=bot.state(guild.id))
+    roles = bot.indexes.roles(guild.id)
+    if roles is not None:
+        state.role_names = {r.id: r.name for r in roles.values()}
+
     # logger.debug("Final state: %r", state)
     bot.state_update(state)
+    if bot.refresher:
+        # Just set up, so it's a whole interval until the next check.
+        bot.refresher.track(state.id, config_hash, delay=bot.refresher.interval)
     logger.info("G=%r Configured guild.", guild.name)
+    return True
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Startup                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def make_bot() -> DragonpawBot:
+    """Build the bot, with all its plugins. Nothing connects until it's run."""
+    bot = DragonpawBot()
+    bot.add_plugin(plugin)
+    bot.load_extensions("dragonpaw_bot.plugins.lobby")
+    bot.load_extensions("dragonpaw_bot.plugins.role_menus")
+    return bot
 
 
-bot.load_extensions("dragonpaw_bot.plugins.lobby")
-bot.load_extensions("dragonpaw_bot.plugins.role_menus")
+def main() -> None:
+    uvloop.install()
+    bot = make_bot()
+    if bot.shard_range.count is None:
+        bot.run()
+    else:
+        logger.info("Running %r", bot.shard_range)
+        bot.run(
+            shard_ids=sorted(bot.shard_range.ids), shard_count=bot.shard_range.count
+        )
@@ -0,0 +1,549 @@
+"""Running the bot as several processes, each with its own range of shards.
+
+Every process connects only its own gateway shards, so it only ever sees
+events for the guilds on them. The guild states all live with one state
+server, which is the only thing that touches the database:
+
+    poetry run python -m dragonpaw_bot.cluster serve --port 8081
+
+and the bots use it with STATE_BACKEND=remote STATE_URL=http://host:8081.
+When a guild's state is saved, the server tells the process that owns
+that guild's shard, unless that's who saved it, so it can load it again.
+A process that reconnects says when it last heard from the server, and
+is told again about anything saved since.
+
+To try it all on one machine, with a state server and two bots splitting
+four shards between them:
+
+    poetry run python -m dragonpaw_bot.cluster local --processes 2 --shard-count 4
+
+With --check, the bots are stand-ins that don't need Discord: the states
+of a batch of made-up guilds are saved, and each stand-in reports which
+changes it heard about, which should be exactly those on its shards.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, Mapping
+
+import aiohttp
+import hikari
+from aiohttp import web
+
+from dragonpaw_bot import store, structs
+
+logger = logging.getLogger(__name__)
+
+STATE_PORT = 8081
+# How long to wait before reconnecting to the state server, doubling up to
+# the max while it stays down.
+WATCH_RETRY_MIN = 1.0
+WATCH_RETRY_MAX = 60.0
+
+# ---------------------------------------------------------------------------- #
+#                               Who owns which shard                           #
+# ---------------------------------------------------------------------------- #
+
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+    # https://discord.com/developers/docs/topics/gateway#sharding
+    return (int(guild_id) >> 22) % shard_count
+
+
+def parse_shard_ids(text: str) -> list[int]:
+    """'0-3,6' -> [0, 1, 2, 3, 6]"""
+    ids: set[int] = set()
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        ids.update(range(int(first), int(last or first) + 1))
+    return sorted(ids)
+
+
+class Shards:
+    """The shards this process runs. No count means all of them."""
+
+    def __init__(self, ids: Iterable[int] = (), count: int | None = None):
+        self.ids = frozenset(ids)
+        self.count = count
+
+    def __repr__(self) -> str:
+        if self.count is None:
+            return "Shards(all)"
+        return f"Shards({sorted(self.ids)} of {self.count})"
+
+    def owns(self, guild_id: int) -> bool:
+        return self.count is None or shard_of(guild_id, self.count) in self.ids
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str] = os.environ) -> Shards:
+        """Work out our shards from SHARD_COUNT, and SHARD_IDS if given.
+
+        In a StatefulSet, SHARDS_PER_PROCESS can be used instead of SHARD_IDS.
+        The pod's ordinal, from the end of its name, picks the range."""
+
+        count = int(env.get("SHARD_COUNT", 0))
+        if not count:
+            return cls()
+        if "SHARD_IDS" in env:
+            return cls(parse_shard_ids(env["SHARD_IDS"]), count)
+
+        per_process = int(env.get("SHARDS_PER_PROCESS", count))
+        name = env.get("POD_NAME") or env.get("HOSTNAME", "")
+        match = re.search(r"-(\d+)$", name)
+        ordinal = int(match.group(1)) if match else 0
+        first = ordinal * per_process
+        if first >= count:
+            raise ValueError(f"{name!r} has no shards, there are only {count}")
+        return cls(range(first, min(first + per_process, count)), count)
+
+
+# ---------------------------------------------------------------------------- #
+#                                 State changes                                #
+# ---------------------------------------------------------------------------- #
+
+
+class StateChangedEvent(hikari.Event):
+    """Someone else changed a guild's state, and we've loaded the new one."""
+
+    def __init__(
+        self,
+        app: hikari.RESTAware,
+        guild_id: hikari.Snowflake,
+        state: structs.GuildState | None,
+    ):
+        self._app = app
+        self.guild_id = guild_id
+        self.state = state
+
+    @property
+    def app(self) -> hikari.RESTAware:
+        return self._app
+
+
+ChangeFunc = Callable[[hikari.Snowflake, float], Awaitable[None]]
+
+
+class StateWatcher:
+    """Listens to the state server for changes to guilds on our shards."""
+
+    def __init__(self, url: str, client_id: str, shards: Shards, on_change: ChangeFunc):
+        self.url = url.rstrip("/")
+        self.client_id = client_id
+        self.shards = shards
+        self.on_change = on_change
+        self.connected = asyncio.Event()
+        # The server's clock as of the last thing it told us, so after a
+        # reconnect it can tell us what we missed.
+        self.since: float | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        params = {"client": self.client_id}
+        if self.shards.count is not None:
+            params["count"] = str(self.shards.count)
+            params["shards"] = ",".join(str(s) for s in sorted(self.shards.ids))
+
+        delay = WATCH_RETRY_MIN
+        async with aiohttp.ClientSession() as session:
+            while True:
+                if self.since is not None:
+                    params["since"] = repr(self.since)
+                try:
+                    async with session.ws_connect(
+                        self.url + "/watch", params=params, heartbeat=30
+                    ) as ws:
+                        logger.info("Watching %s for state changes", self.url)
+                        self.connected.set()
+                        delay = WATCH_RETRY_MIN
+                        async for message in ws:
+                            if message.type != aiohttp.WSMsgType.TEXT:
+                                break
+                            change = json.loads(message.data)
+                            if "guild_id" in change:
+                                await self._changed(change)
+                            self.since = max(self.since or 0.0, change["saved_at"])
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning("Lost the state server: %r", e)
+                self.connected.clear()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WATCH_RETRY_MAX)
+
+    async def _changed(self, change: dict) -> None:
+        guild_id = hikari.Snowflake(change["guild_id"])
+        try:
+            await self.on_change(guild_id, change["saved_at"])
+        except Exception as e:
+            logger.exception("Error handling change to guild %d: %r", guild_id, e)
+
+
+# ---------------------------------------------------------------------------- #
+#                                 State server                                 #
+# ---------------------------------------------------------------------------- #
+
+
+class Watch:
+    """One process listening for changes to the guilds on its shards."""
+
+    def __init__(self, ws: web.WebSocketResponse, client_id: str, shards: Shards):
+        self.ws = ws
+        self.client_id = client_id
+        self.shards = shards
+
+
+class StateServer:
+    """Keeps every guild's state, for all the bots, in one StateStore."""
+
+    def __init__(self, state_store: store.StateStore, port: int = STATE_PORT):
+        self.store = state_store
+        self.port = port
+        self.watches: list[Watch] = []
+        # Guild -> (when it was last saved, and who by), to catch up watchers
+        # that reconnect. Anything from before we started, we don't know.
+        self.saved: dict[int, tuple[float, str]] = {}
+        self.started = time.time()
+        self._runner: web.AppRunner | None = None
+
+    async def guild_ids(self, request: web.Request) -> web.Response:
+        ids = await asyncio.to_thread(self.store.guild_ids)
+        return web.json_response([int(g) for g in ids])
+
+    async def load(self, request: web.Request) -> web.Response:
+        guild_id = hikari.Snowflake(request.match_info["guild_id"])
+        state = await asyncio.to_thread(self.store.load, guild_id)
+        if not state:
+            raise web.HTTPNotFound()
+        return web.json_response(store.rows_json(store.state_rows(state)))
+
+    async def load_many(self, request: web.Request) -> web.Response:
+        ids = [hikari.Snowflake(g) for g in (await request.json())["ids"]]
+        states = await asyncio.to_thread(self.store.load_many, ids)
+        return web.json_response([store.rows_json(store.state_rows(s)) for s in states])
+
+    async def save(self, request: web.Request) -> web.Response:
+        guild_id = int(request.match_info["guild_id"])
+        state = store.rows_state(store.json_rows(await request.json()))
+        if state.id != guild_id:
+            raise web.HTTPBadRequest(text="Guild id doesn't match the state")
+        await asyncio.to_thread(self.store.save, state)
+        writer = request.headers.get(store.CLIENT_HEADER, "")
+        saved_at = time.time()
+        self.saved[guild_id] = (saved_at, writer)
+        await self.publish(guild_id, writer=writer, saved_at=saved_at)
+        return web.json_response({"saved": guild_id})
+
+    async def publish(self, guild_id: int, writer: str, saved_at: float) -> None:
+        """Tell whoever owns the guild it changed, unless they changed it."""
+        for watch in list(self.watches):
+            if watch.client_id != writer and watch.shards.owns(guild_id):
+                await self._tell(watch, guild_id, saved_at)
+
+    async def _tell(self, watch: Watch, guild_id: int, saved_at: float) -> None:
+        try:
+            await watch.ws.send_json({"guild_id": guild_id, "saved_at": saved_at})
+        except ConnectionError:
+            pass  # It's going away, watch() cleans up.
+
+    async def _catch_up(self, watch: Watch, since: float) -> None:
+        """Tell a watcher that's back about what it missed while it was gone."""
+        if since < self.started:
+            # We've restarted since, so we don't know: it was all of them.
+            missed = {
+                int(g): (self.started, "")
+                for g in await asyncio.to_thread(self.store.guild_ids)
+            }
+            missed.update(self.saved)
+        else:
+            missed = self.saved
+        count = 0
+        for guild_id, (saved_at, writer) in list(missed.items()):
+            if (
+                saved_at > since
+                and writer != watch.client_id
+                and watch.shards.owns(guild_id)
+            ):
+                await self._tell(watch, guild_id, saved_at)
+                count += 1
+        logger.info("Watcher %s missed %d change(s)", watch.client_id, count)
+
+    async def watch(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        if "count" in request.query:
+            shards = Shards(
+                parse_shard_ids(request.query["shards"]), int(request.query["count"])
+            )
+        else:
+            shards = Shards()
+        watch = Watch(ws, request.query.get("client", ""), shards)
+        self.watches.append(watch)
+        logger.info("Watcher %s connected for %r", watch.client_id, shards)
+        # Our clock as of now. Anything after this, they'll hear about live.
+        now = time.time()
+        if "since" in request.query:
+            await self._catch_up(watch, float(request.query["since"]))
+        await ws.send_json({"saved_at": now})
+        try:
+            async for _ in ws:
+                pass  # Nothing to hear from them, just wait for them to go.
+        finally:
+            self.watches.remove(watch)
+            logger.info("Watcher %s went away", watch.client_id)
+        return ws
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        return web.json_response({"watchers": len(self.watches)})
+
+    async def start(self) -> None:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/guilds", self.guild_ids)
+        app.router.add_post("/guilds/load", self.load_many)
+        app.router.add_get("/guilds/{guild_id:\\d+}", self.load)
+        app.router.add_put("/guilds/{guild_id:\\d+}", self.save)
+        app.router.add_get("/watch", self.watch)
+        app.router.add_get("/healthz", self.healthz)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, port=self.port).start()
+        logger.info("Serving guild states on port %d", self.port)
+
+    async def stop(self) -> None:
+        for watch in list(self.watches):
+            await watch.ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# ---------------------------------------------------------------------------- #
+#                                      CLI                                     #
+# ---------------------------------------------------------------------------- #
+
+
+async def serve(state_dir: Path, backend: str, port: int) -> None:
+    state_store = store.open_store(state_dir, backend=backend)
+    server = StateServer(state_store, port=port)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        state_store.close()
+
+
+def check_state(guild_id: int) -> structs.GuildState:
+    return structs.GuildState(
+        id=hikari.Snowflake(guild_id),
+        name=f"Guild {guild_id}",
+        config_url="https://example.com/config.toml",
+        config_last=datetime.datetime.now(),
+        role_names={hikari.Snowflake(guild_id + 1): "Role"},
+        role_emojis={},
+    )
+
+
+async def check_worker(url: str, shards: Shards, expected: int, timeout: float):
+    """Stand in for a bot: hear about changes, and load what changed."""
+
+    remote = store.RemoteStore(url)
+    heard: dict[int, float] = {}
+    done = asyncio.Event()
+
+    async def changed(guild_id: hikari.Snowflake, saved_at: float) -> None:
+        latency = time.time() - saved_at
+        state = await asyncio.to_thread(remote.load, guild_id)
+        if state and state.name == f"Guild {guild_id}":
+            heard[int(guild_id)] = latency
+        if len(heard) >= expected:
+            done.set()
+
+    watcher = StateWatcher(url, remote.client_id, shards, on_change=changed)
+    watcher.start()
+    if not expected:
+        done.set()
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(done.wait(), timeout=timeout)
+    await watcher.stop()
+    print(json.dumps({"shards": sorted(shards.ids), "heard": heard}))
+
+
+async def local(args: argparse.Namespace) -> int:
+    per_process = -(-args.shard_count // args.processes)
+    ranges = [
+        range(n * per_process, min((n + 1) * per_process, args.shard_count))
+        for n in range(args.processes)
+    ]
+    url = f"http://127.0.0.1:{args.port}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        state_dir = args.state_dir or Path(tmp)
+        state_store = store.open_store(state_dir, backend="sqlite")
+        server = StateServer(state_store, port=args.port)
+        await server.start()
+
+        # Made up guilds, spread over every shard.
+        guild_ids = [n << 22 for n in range(args.guilds)]
+        children = []
+        for shard_range in ranges:
+            shard_ids = f"{shard_range.start}-{shard_range.stop - 1}"
+            if args.check:
+                expected = sum(
+                    1 for g in guild_ids if shard_of(g, args.shard_count) in shard_range
+                )
+                command = [
+                    sys.executable,
+                    "-m",
+                    "dragonpaw_bot.cluster",
+                    "check-worker",
+                    "--url",
+                    url,
+                    "--shards",
+                    shard_ids,
+                    "--shard-count",
+                    str(args.shard_count),
+                    "--expected",
+                    str(expected),
+                ]
+            else:
+                command = [sys.executable, "-OO", "-m", "dragonpaw_bot"]
+            env = dict(
+                os.environ,
+                SHARD_COUNT=str(args.shard_count),
+                SHARD_IDS=shard_ids,
+                STATE_BACKEND="remote",
+                STATE_URL=url,
+            )
+            logger.info("Starting shards %s: %s", shard_ids, " ".join(command))
+            children.append(
+                await asyncio.create_subprocess_exec(
+                    *command,
+                    env=env,
+                    stdout=subprocess.PIPE if args.check else None,
+                )
+            )
+
+        try:
+            if not args.check:
+                await asyncio.gather(*(c.wait() for c in children))
+                return 0
+            return await run_check(args, server, children, guild_ids)
+        finally:
+            for child in children:
+                if child.returncode is None:
+                    child.terminate()
+                    await child.wait()
+            await server.stop()
+            state_store.close()
+
+
+async def run_check(
+    args: argparse.Namespace,
+    server: StateServer,
+    children: list[asyncio.subprocess.Process],
+    guild_ids: list[int],
+) -> int:
+    # Wait for everyone to be listening before changing anything.
+    deadline = time.monotonic() + args.timeout
+    while len(server.watches) < len(children) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+    remote = store.RemoteStore(f"http://127.0.0.1:{args.port}")
+    start = time.perf_counter()
+    for guild_id in guild_ids:
+        await asyncio.to_thread(remote.save, check_state(guild_id))
+    elapsed = time.perf_counter() - start
+
+    failed = False
+    latencies = []
+    for child in children:
+        assert child.stdout
+        result = json.loads(await child.stdout.read())
+        await child.wait()
+        shards = Shards(result["shards"], args.shard_count)
+        wanted = {g for g in guild_ids if shards.owns(g)}
+        heard = {int(g) for g in result["heard"]}
+        latencies += result["heard"].values()
+        print(
+            f"Shards {result['shards']}: heard about {len(heard)} "
+            f"of {len(wanted)} guild(s)"
+        )
+        if heard != wanted:
+            print(f"  Missing: {sorted(wanted - heard)[:10]}")
+            print(f"  Not theirs: {sorted(heard - wanted)[:10]}")
+            failed = True
+
+    print(
+        f"Saved {len(guild_ids)} states in {elapsed:.2f}s, change propagated in "
+        f"p50 {statistics.median(latencies or [0]) * 1000:.1f} ms, "
+        f"max {max(latencies or [0]) * 1000:.1f} ms"
+    )
+    return 1 if failed else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m dragonpaw_bot.cluster")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Run the state server")
+    serve_parser.add_argument("--state-dir", type=Path, default=Path("state"))
+    serve_parser.add_argument("--backend", default="sqlite")
+    serve_parser.add_argument("--port", type=int, default=STATE_PORT)
+
+    local_parser = commands.add_parser(
+        "local", help="A state server and bots, all on this machine"
+    )
+    local_parser.add_argument("--processes", type=int, default=2)
+    local_parser.add_argument("--shard-count", type=int, default=4)
+    local_parser.add_argument("--port", type=int, default=STATE_PORT)
+    local_parser.add_argument("--state-dir", type=Path, help="Default: a temp dir")
+    local_parser.add_argument(
+        "--check", action="store_true", help="Stand-ins instead of bots"
+    )
+    local_parser.add_argument("--guilds", type=int, default=100, help="For --check")
+    local_parser.add_argument("--timeout", type=float, default=10.0)
+
+    worker_parser = commands.add_parser("check-worker")
+    worker_parser.add_argument("--url", required=True)
+    worker_parser.add_argument("--shards", required=True)
+    worker_parser.add_argument("--shard-count", type=int, required=True)
+    worker_parser.add_argument("--expected", type=int, required=True)
+    worker_parser.add_argument("--timeout", type=float, default=10.0)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "serve":
+        asyncio.run(serve(args.state_dir, args.backend, args.port))
+        return 0
+    if args.command == "check-worker":
+        shards = Shards(parse_shard_ids(args.shards), args.shard_count)
+        asyncio.run(check_worker(args.url, shards, args.expected, args.timeout))
+        return 0
+    return asyncio.run(local(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
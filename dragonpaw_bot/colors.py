@@ -1,5 +1,4 @@
 import hikari
-import palettable
 
 SOLARIZED_BASE03 = hikari.Color.from_hex_code("#002b36")
 SOLARIZED_BASE02 = hikari.Color.from_hex_code("#073642")
@@ -19,11 +18,305 @@ SOLARIZED_CYAN = hikari.Color.from_hex_code("#2aa198")
 SOLARIZED_GREEN = hikari.Color.from_hex_code("#859900")
 
 COLORS = "Cube1_{}"  # https://jiffyclub.github.io/palettable/
+COLORS_MIN = 3
+COLORS_MAX = 20
 
+RGB = tuple[int, int, int]
 
-def rainbow(n: int) -> list[tuple[int, int, int]]:
+# ---------------------------------------------------------------------------- #
+#                                   Rainbows                                   #
+# ---------------------------------------------------------------------------- #
+
+# Every size of the palettable map, so palettable (and the setuptools it
+# drags in) never has to be imported. `python -m dragonpaw_bot.colors`
+# prints this table again, if the palette ever changes.
+RAINBOWS: dict[int, tuple[RGB, ...]] = {
+    3: (
+        (120, 0, 133),
+        (73, 208, 126),
+        (249, 150, 91),
+    ),
+    4: (
+        (120, 0, 133),
+        (76, 158, 217),
+        (133, 235, 80),
+        (249, 150, 91),
+    ),
+    5: (
+        (120, 0, 133),
+        (98, 125, 246),
+        (73, 208, 126),
+        (182, 236, 87),
+        (249, 150, 91),
+    ),
+    6: (
+        (120, 0, 133),
+        (110, 98, 253),
+        (56, 182, 184),
+        (92, 227, 73),
+        (204, 236, 90),
+        (249, 150, 91),
+    ),
+    7: (
+        (120, 0, 133),
+        (119, 81, 242),
+        (76, 158, 217),
+        (73, 208, 126),
+        (133, 235, 80),
+        (213, 230, 91),
+        (249, 150, 91),
+    ),
+    8: (
+        (120, 0, 133),
+        (125, 69, 228),
+        (89, 140, 236),
+        (59, 190, 169),
+        (86, 222, 82),
+        (162, 236, 85),
+        (220, 221, 92),
+        (249, 150, 91),
+    ),
+    9: (
+        (120, 0, 133),
+        (127, 59, 220),
+        (98, 125, 246),
+        (60, 174, 197),
+        (73, 208, 126),
+        (104, 231, 74),
+        (182, 236, 87),
+        (224, 215, 92),
+        (249, 150, 91),
+    ),
+    10: (
+        (120, 0, 133),
+        (129, 45, 210),
+        (104, 111, 251),
+        (76, 158, 217),
+        (62, 194, 160),
+        (83, 219, 93),
+        (133, 235, 80),
+        (195, 236, 89),
+        (230, 210, 93),
+        (249, 150, 91),
+    ),
+    11: (
+        (120, 0, 133),
+        (129, 38, 205),
+        (110, 98, 253),
+        (86, 145, 232),
+        (56, 182, 184),
+        (73, 208, 126),
+        (92, 227, 73),
+        (152, 236, 83),
+        (204, 236, 90),
+        (234, 205, 93),
+        (249, 150, 91),
+    ),
+    12: (
+        (120, 0, 133),
+        (130, 28, 197),
+        (115, 89, 249),
+        (92, 135, 240),
+        (64, 170, 202),
+        (65, 197, 154),
+        (81, 216, 101),
+        (111, 232, 76),
+        (169, 236, 86),
+        (210, 234, 91),
+        (237, 201, 94),
+        (249, 150, 91),
+    ),
+    13: (
+        (120, 0, 133),
+        (131, 22, 192),
+        (119, 81, 242),
+        (98, 125, 246),
+        (76, 158, 217),
+        (57, 187, 176),
+        (73, 208, 126),
+        (88, 225, 76),
+        (133, 235, 80),
+        (182, 236, 87),
+        (213, 230, 91),
+        (239, 198, 94),
+        (249, 150, 91),
+    ),
+    14: (
+        (120, 0, 133),
+        (131, 19, 189),
+        (122, 75, 235),
+        (102, 115, 250),
+        (83, 148, 229),
+        (58, 177, 192),
+        (67, 199, 149),
+        (80, 215, 106),
+        (99, 230, 74),
+        (150, 236, 83),
+        (191, 236, 89),
+        (217, 225, 91),
+        (240, 196, 94),
+        (249, 150, 91),
+    ),
+    15: (
+        (120, 0, 133),
+        (131, 15, 184),
+        (125, 69, 228),
+        (106, 107, 252),
+        (89, 140, 236),
+        (67, 167, 206),
+        (59, 190, 169),
+        (73, 208, 126),
+        (86, 222, 82),
+        (117, 233, 77),
+        (162, 236, 85),
+        (198, 236, 89),
+        (220, 221, 92),
+        (242, 192, 94),
+        (249, 150, 91),
+    ),
+    16: (
+        (120, 0, 133),
+        (131, 13, 181),
+        (126, 64, 224),
+        (110, 98, 253),
+        (94, 132, 242),
+        (76, 158, 217),
+        (56, 182, 184),
+        (67, 200, 147),
+        (79, 214, 108),
+        (92, 227, 73),
+        (133, 235, 80),
+        (173, 236, 86),
+        (204, 236, 90),
+        (222, 218, 92),
+        (243, 190, 94),
+        (249, 150, 91),
+    ),
+    17: (
+        (120, 0, 133),
+        (131, 12, 178),
+        (127, 59, 220),
+        (113, 93, 252),
+        (98, 125, 246),
+        (81, 151, 226),
+        (60, 174, 197),
+        (62, 193, 163),
+        (73, 208, 126),
+        (84, 220, 90),
+        (104, 231, 74),
+        (145, 235, 82),
+        (182, 236, 87),
+        (208, 235, 90),
+        (224, 215, 92),
+        (243, 188, 94),
+        (249, 150, 91),
+    ),
+    18: (
+        (120, 0, 133),
+        (131, 11, 176),
+        (128, 52, 215),
+        (116, 87, 247),
+        (102, 117, 249),
+        (87, 143, 234),
+        (69, 165, 208),
+        (57, 185, 178),
+        (68, 201, 145),
+        (78, 213, 111),
+        (89, 225, 75),
+        (120, 234, 78),
+        (157, 236, 84),
+        (189, 236, 88),
+        (211, 233, 91),
+        (227, 213, 93),
+        (244, 186, 94),
+        (249, 150, 91),
+    ),
+    19: (
+        (120, 0, 133),
+        (131, 10, 173),
+        (129, 45, 210),
+        (119, 81, 242),
+        (104, 111, 251),
+        (91, 137, 239),
+        (76, 158, 217),
+        (57, 178, 190),
+        (62, 194, 160),
+        (73, 208, 126),
+        (83, 219, 93),
+        (97, 229, 73),
+        (133, 235, 80),
+        (167, 236, 85),
+        (195, 236, 89),
+        (213, 230, 91),
+        (230, 210, 93),
+        (244, 184, 94),
+        (249, 150, 91),
+    ),
+    20: (
+        (120, 0, 133),
+        (130, 9, 170),
+        (129, 42, 208),
+        (121, 77, 237),
+        (107, 104, 253),
+        (95, 130, 243),
+        (80, 152, 224),
+        (63, 171, 201),
+        (58, 188, 174),
+        (69, 202, 142),
+        (77, 212, 113),
+        (87, 224, 78),
+        (109, 232, 75),
+        (142, 235, 82),
+        (175, 236, 87),
+        (200, 236, 89),
+        (216, 226, 91),
+        (231, 208, 93),
+        (245, 182, 94),
+        (249, 150, 91),
+    ),
+}
+
+
+def _blend(a: RGB, b: RGB, t: float) -> RGB:
+    return (
+        round(a[0] + (b[0] - a[0]) * t),
+        round(a[1] + (b[1] - a[1]) * t),
+        round(a[2] + (b[2] - a[2]) * t),
+    )
+
+
+def rainbow(n: int) -> list[RGB]:
     # This is how to do it using only colorsys, but the colors are not as nice.
     # end = 2 / 3
     # as_float = [colorsys.hls_to_rgb(end * i / (n - 1), 0.5, 1) for i in range(n)]
     # return [(int(x[0] * 255), int(x[1] * 255), int(x[2] * 255)) for x in as_float]
-    return palettable.mycarta.get_map(COLORS.format(n)).colors
+    if n in RAINBOWS:
+        return list(RAINBOWS[n])
+    if n <= 0:
+        return []
+    if n == 1:
+        return [RAINBOWS[COLORS_MIN][0]]
+
+    # Too few or too many for the map, so walk along the biggest one.
+    colors = RAINBOWS[COLORS_MAX]
+    result = []
+    for i in range(n):
+        position = i * (len(colors) - 1) / (n - 1)
+        x = min(int(position), len(colors) - 2)
+        result.append(_blend(colors[x], colors[x + 1], position - x))
+    return result
+
+
+def rainbow_table() -> str:
+    import palettable
+
+    lines = ["RAINBOWS: dict[int, tuple[RGB, ...]] = {"]
+    for n in range(COLORS_MIN, COLORS_MAX + 1):
+        colors = palettable.mycarta.get_map(COLORS.format(n)).colors
+        lines.append(f"    {n}: ({', '.join(str(tuple(c)) for c in colors)},),")
+    lines.append("}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print(rainbow_table())
@@ -0,0 +1,283 @@
+"""Check a config against a snapshot of a guild, without talking to Discord.
+
+Runs the same validation and state building as /config, against the roles,
+channels and emojis in a JSON snapshot, and reports how long it all took.
+
+    poetry run python -m dragonpaw_bot.compile config.toml guild.json
+
+The snapshot looks like this, and anything else in it is ignored, so the
+objects can be pasted straight from Discord's API:
+
+    {
+        "id": "1234", "name": "My Server",
+        "roles": [{"id": "5678", "name": "Newb"}],
+        "channels": [{"id": "9012", "name": "roles", "type": 0}],
+        "emojis": [{"id": "3456", "name": "blobcat", "animated": false}]
+    }
+
+Exits with 1 if the config has errors, so it can be used in CI.
+"""
+from __future__ import annotations
+
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Mapping, TypeVar
+
+import hikari
+import pydantic
+
+from dragonpaw_bot import structs, utils
+from dragonpaw_bot.plugins.lobby import compile_lobby
+from dragonpaw_bot.plugins.role_menus import (
+    compile_role_menus,
+    note_digest,
+    role_note,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# ---------------------------------------------------------------------------- #
+#                                Guild snapshots                               #
+# ---------------------------------------------------------------------------- #
+class SnapshotRole(pydantic.BaseModel):
+    id: hikari.Snowflake
+    name: str
+
+
+class SnapshotChannel(pydantic.BaseModel):
+    id: hikari.Snowflake
+    name: str
+    type: int = hikari.ChannelType.GUILD_TEXT
+
+
+class SnapshotEmoji(pydantic.BaseModel):
+    id: hikari.Snowflake
+    name: str
+    animated: bool = False
+
+
+class GuildSnapshot(pydantic.BaseModel):
+    """Just enough of a guild to build its state from a config."""
+
+    id: hikari.Snowflake
+    name: str
+    roles: list[SnapshotRole] = []
+    channels: list[SnapshotChannel] = []
+    emojis: list[SnapshotEmoji] = []
+
+    def role_map(self) -> Mapping[str, hikari.PartialRole]:
+        return {
+            r.name: hikari.PartialRole(app=None, id=r.id, name=r.name)  # type: ignore
+            for r in self.roles
+        }
+
+    def emoji_map(
+        self,
+    ) -> Mapping[str, hikari.KnownCustomEmoji | hikari.UnicodeEmoji]:
+        custom = {
+            e.name: hikari.KnownCustomEmoji(
+                app=None,  # type: ignore
+                id=e.id,
+                name=e.name,
+                is_animated=e.animated,
+                guild_id=self.id,
+                role_ids=[],
+                user=None,
+                is_colons_required=True,
+                is_managed=False,
+                is_available=True,
+            )
+            for e in self.emojis
+        }
+        # Same lookup order as utils.guild_emojis.
+        return collections.ChainMap(utils.unicode_emojis(), custom)  # type: ignore
+
+    def text_channel(self, name: str) -> hikari.Snowflake | None:
+        for c in self.channels:
+            if c.name == name and c.type == hikari.ChannelType.GUILD_TEXT:
+                return c.id
+        return None
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Compiling                                  #
+# ---------------------------------------------------------------------------- #
+
+
+class ConfigSyntaxError(ValueError):
+    """The config isn't valid TOML."""
+
+
+def config_parse_toml(guild_name: str, text: str) -> structs.GuildConfig:
+    logger.info("G=%r Loading TOML config", guild_name)
+
+    # Only needed when someone runs /config, so not at startup.
+    import toml
+
+    try:
+        data = toml.loads(text)
+    except toml.TomlDecodeError as e:
+        raise ConfigSyntaxError(str(e)) from e
+    return structs.GuildConfig.parse_obj(data)
+
+
+def compile_guild(
+    guild: GuildSnapshot, config: structs.GuildConfig, url: str, config_text: str
+) -> tuple[structs.GuildState, list[str]]:
+    """Build the state /config would, for a guild that looks like the snapshot.
+
+    Nothing gets sent anywhere, so message ids are made up, counting up
+    from 1 in the order the messages would be sent."""
+
+    errors: list[str] = []
+    role_map = guild.role_map()
+    state = structs.GuildState(
+        id=guild.id,
+        name=guild.name,
+        config_url=url,
+        config_last=datetime.datetime.now(),
+        config_hash=hashlib.sha256(config_text.encode()).hexdigest(),
+        role_names={r.id: r.name for r in role_map.values()},
+        role_emojis={},
+    )
+    message_ids = (hikari.Snowflake(x) for x in range(1, 1 << 32))
+
+    if config.roles:
+        state.role_channel_id = guild.text_channel(config.roles.channel)
+        if not state.role_channel_id:
+            errors.append(
+                f"Role channel '{config.roles.channel}' doesn't seem to exist."
+            )
+        if not config.roles.menu:
+            errors.append("Role channel is set, but no role menus seem to exist.")
+
+        menus, menu_errors = compile_role_menus(
+            config=config.roles, role_map=role_map, emoji_map=guild.emoji_map()
+        )
+        errors += menu_errors
+        for menu in menus:
+            message_id = next(message_ids)
+            state.role_message_ids.append(message_id)
+            state.role_menu_hashes[message_id] = menu.digest
+            state.role_emojis.update(menu.option_states(message_id))
+            if menu.is_select:
+                state.role_select_ids.append(message_id)
+        # The note at the end.
+        state.role_message_ids.append(next(message_ids))
+        state.role_note_hash = note_digest(role_note(menus))
+
+    if config.lobby:
+        state.lobby_channel_id = guild.text_channel(config.lobby.channel)
+        if not state.lobby_channel_id:
+            errors.append(
+                f"Lobby channel {config.lobby.channel} doesn't seem to exist."
+            )
+        embed, lobby_errors = compile_lobby(
+            config=config.lobby, state=state, role_map=role_map
+        )
+        errors += lobby_errors
+        if embed:
+            state.lobby_rules_message_id = next(message_ids)
+
+    if config.log_channel:
+        state.log_channel_id = guild.text_channel(config.log_channel)
+        if not state.log_channel_id:
+            errors.append(f"Log channel {config.log_channel} doesn't seem to exist.")
+
+    return state, errors
+
+
+# ---------------------------------------------------------------------------- #
+#                                      CLI                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def timed(func: Callable[[], T], repeat: int) -> tuple[T, list[float]]:
+    """Run something `repeat` times, returning the last result and the times."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def report(phase: str, times: list[float]) -> None:
+    print(
+        f"{phase + ':':<14} best {min(times) * 1000:9.3f} ms"
+        f"  mean {statistics.mean(times) * 1000:9.3f} ms"
+        f"  ({len(times)} run(s))",
+        file=sys.stderr,
+    )
+
+
+def state_json(state: structs.GuildState) -> str:
+    data = state.dict()
+    # JSON keys have to be strings.
+    data["role_emojis"] = {
+        f"{message_id} {emoji}": option
+        for (message_id, emoji), option in data["role_emojis"].items()
+    }
+    return json.dumps(data, indent=2, default=str, ensure_ascii=False)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m dragonpaw_bot.compile",
+        description="Validate a config against a guild snapshot, offline.",
+    )
+    parser.add_argument("config", type=Path, help="The TOML config file")
+    parser.add_argument("guild", type=Path, help="JSON snapshot of the guild")
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=1, help="Time this many runs"
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="Don't print the state"
+    )
+    args = parser.parse_args(argv)
+    repeat = max(args.repeat, 1)
+
+    guild = GuildSnapshot.parse_file(args.guild)
+    text = args.config.read_text()
+
+    try:
+        config, parse_times = timed(
+            lambda: config_parse_toml(guild_name=guild.name, text=text), repeat
+        )
+    except (ConfigSyntaxError, pydantic.ValidationError) as e:
+        print(f"{args.config}: {e}", file=sys.stderr)
+        return 1
+
+    # The bot builds this once at startup, so keep it out of the compile time.
+    _, index_times = timed(utils.unicode_emojis, 1)
+    (state, errors), compile_times = timed(
+        lambda: compile_guild(
+            guild=guild, config=config, url=str(args.config), config_text=text
+        ),
+        repeat,
+    )
+
+    if not args.quiet:
+        print(state_json(state))
+    for error in errors:
+        print(f"{args.config}: {error}", file=sys.stderr)
+
+    report("Parse", parse_times)
+    report("Emoji index", index_times)
+    report("Compile", compile_times)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,44 +1,190 @@
-from typing import *
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable
 
 import aiohttp
+import pydantic
+import safer
+
+logger = logging.getLogger(__name__)
+
+# Configs are a few KB at most, anything this big is somebody's mistake.
+MAX_BODY_SIZE = 1024 * 1024
+TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+CONNECTION_LIMIT = 10
+CHUNK_SIZE = 64 * 1024
+
+GIST_API_URL = "https://api.github.com/gists/{}"
+
+
+class ResponseTooLarge(aiohttp.ClientError):
+    """The server tried to send us more than MAX_BODY_SIZE bytes."""
+
+
+class CacheEntry(pydantic.BaseModel):
+    """A cached response, and the validators needed to revalidate it."""
+
+    url: str
+    body: str
+    etag: str | None = None
+    last_modified: str | None = None
+
 
 # ---------------------------------------------------------------------------- #
-#                            HTTP utility functions                            #
+#                                  HTTP client                                 #
 # ---------------------------------------------------------------------------- #
 
 
-async def get_json(url) -> Any:
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
-        async with session.get(url) as r:
-            if r.status == 200:
-                return await r.json()
-
-
-async def get_text(url) -> str:
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
-        async with session.get(url) as r:
-            return await r.text()
-
-
-async def get_gist(url) -> str:
-    # e.x.: https://gist.github.com/dragonpaw/ed69fa12e38de27199d21bd7dde4768e
-    gist_id = url.split("/")[-1]
-    async with aiohttp.ClientSession(
-        raise_for_status=True,
-        headers={
-            "Accept": "application/vnd.github.v3+json",
-        },
-    ) as session:
-        async with session.get(f"https://api.github.com/gists/{gist_id}") as r:
-            data = await r.json()
-
-        # Try to find a specific TOML file is there is one.
-        for file in data["files"].values():
-            if (
-                file["filename"].lower().endswith(".toml")
-                or file["language"].lower() == "toml"
-            ):
-                return file["content"]
-
-        # Ok, then whatever the first file is.
-        return list(data["files"].values())[0]["content"]
+class HttpClient:
+    """One long-lived, pooled HTTP session with an on-disk response cache.
+
+    Every response is cached by URL, and re-fetches send the ETag and
+    Last-Modified validators so an unchanged config costs a single 304."""
+
+    def __init__(self, cache_dir: Path | None = None, max_body: int = MAX_BODY_SIZE):
+        self.cache_dir = cache_dir
+        self.max_body = max_body
+        self._session: aiohttp.ClientSession | None = None
+        self._cache: dict[str, CacheEntry] = {}
+
+    def _session_get(self) -> aiohttp.ClientSession:
+        # The session has to be built inside the running loop, so do it lazily.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTION_LIMIT,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    # ------------------------------- Caching -------------------------------- #
+
+    def _cache_path(self, url: str) -> Path | None:
+        if not self.cache_dir:
+            return None
+        return self.cache_dir / (hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def _cache_read(self, filename: Path) -> CacheEntry | None:
+        try:
+            return CacheEntry.parse_file(filename)
+        except Exception as e:
+            logger.warning("Ignoring broken cache file %s: %r", filename, e)
+            return None
+
+    def _cache_write(self, filename: Path, entry: CacheEntry) -> None:
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        with safer.open(filename, "w") as f:
+            f.write(entry.json())
+
+    # The files are read and written in a thread: safer fsyncs, and that
+    # can take a while on a busy disk, with every gateway event waiting.
+
+    async def _cache_get(self, url: str) -> CacheEntry | None:
+        if url in self._cache:
+            return self._cache[url]
+
+        filename = self._cache_path(url)
+        if not filename or not filename.exists():
+            return None
+        entry = await asyncio.to_thread(self._cache_read, filename)
+        if entry:
+            self._cache[url] = entry
+        return entry
+
+    async def _cache_put(self, entry: CacheEntry) -> None:
+        self._cache[entry.url] = entry
+
+        filename = self._cache_path(entry.url)
+        if filename:
+            await asyncio.to_thread(self._cache_write, filename, entry)
+
+    # ------------------------------- Fetching ------------------------------- #
+
+    async def _read(self, r: aiohttp.ClientResponse) -> str:
+        if r.content_length and r.content_length > self.max_body:
+            raise ResponseTooLarge(f"{r.url} is {r.content_length} bytes")
+
+        body = bytearray()
+        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) > self.max_body:
+                raise ResponseTooLarge(f"{r.url} is over {self.max_body} bytes")
+        return body.decode(r.get_encoding())
+
+    async def fetch(
+        self,
+        url: str,
+        headers: dict[str, str] | None = None,
+        extract: Callable[[str], str] | None = None,
+    ) -> str:
+        """GET a URL, revalidating against the cached copy if there is one.
+
+        If `extract` is given, it's applied to a freshly downloaded body and
+        the result is what gets cached, so a 304 skips the extraction too."""
+
+        entry = await self._cache_get(url)
+        request_headers = dict(headers or {})
+        if entry and entry.etag:
+            request_headers["If-None-Match"] = entry.etag
+        if entry and entry.last_modified:
+            request_headers["If-Modified-Since"] = entry.last_modified
+
+        async with self._session_get().get(url, headers=request_headers) as r:
+            if r.status == 304 and entry:
+                logger.debug("Not modified, using cached copy of: %s", url)
+                return entry.body
+            r.raise_for_status()
+            text = await self._read(r)
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+
+        body = extract(text) if extract else text
+        await self._cache_put(
+            CacheEntry(url=url, body=body, etag=etag, last_modified=last_modified)
+        )
+        return body
+
+    async def get_json(self, url: str) -> Any:
+        return json.loads(await self.fetch(url))
+
+    async def get_text(self, url: str) -> str:
+        return await self.fetch(url)
+
+    async def get_gist(self, url: str) -> str:
+        # e.x.: https://gist.github.com/dragonpaw/ed69fa12e38de27199d21bd7dde4768e
+        gist_id = url.split("/")[-1]
+        return await self.fetch(
+            GIST_API_URL.format(gist_id),
+            headers={"Accept": "application/vnd.github.v3+json"},
+            extract=gist_content,
+        )
+
+
+def gist_content(text: str) -> str:
+    """Pick the config file out of a GitHub gist API response."""
+
+    data = json.loads(text)
+
+    # Try to find a specific TOML file is there is one.
+    for file in data["files"].values():
+        if (
+            file["filename"].lower().endswith(".toml")
+            or (file["language"] or "").lower() == "toml"
+        ):
+            return file["content"]
+
+    # Ok, then whatever the first file is.
+    return list(data["files"].values())[0]["content"]
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import logging
+import types
+from typing import Iterable, Mapping
+
+import hikari
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+#                    Roles and channels of each guild, by name                 #
+# ---------------------------------------------------------------------------- #
+
+
+class GuildIndex:
+    """One guild's roles, and its text channels, by id and by name.
+
+    Discord doesn't stop two roles having the same name. Like a dict built
+    from the role list, the name goes to whichever was seen last, and if
+    that one is renamed or deleted, to any other that's still called that."""
+
+    __slots__ = ("roles", "role_names", "channels", "channel_names")
+
+    def __init__(self) -> None:
+        self.roles: dict[int, hikari.Role] = {}
+        self.role_names: dict[str, hikari.Role] = {}
+        self.channels: dict[int, hikari.GuildTextChannel] = {}
+        self.channel_names: dict[str, hikari.GuildTextChannel] = {}
+
+    def role_set(self, role: hikari.Role) -> None:
+        self.role_delete(role.id)
+        self.roles[role.id] = role
+        self.role_names[role.name] = role
+
+    def role_delete(self, role_id: int) -> hikari.Role | None:
+        role = self.roles.pop(role_id, None)
+        if role and self.role_names.get(role.name) is role:
+            del self.role_names[role.name]
+            for other in self.roles.values():
+                if other.name == role.name:
+                    self.role_names[other.name] = other
+                    break
+        return role
+
+    def channel_set(self, channel: hikari.GuildChannel) -> None:
+        self.channel_delete(channel.id)
+        # Only text channels can be a lobby, a role channel or a log channel.
+        if isinstance(channel, hikari.GuildTextChannel) and channel.name:
+            self.channels[channel.id] = channel
+            self.channel_names[channel.name] = channel
+
+    def channel_delete(self, channel_id: int) -> None:
+        channel = self.channels.pop(channel_id, None)
+        if channel and self.channel_names.get(channel.name or "") is channel:
+            del self.channel_names[channel.name or ""]
+            for other in self.channels.values():
+                if other.name == channel.name:
+                    self.channel_names[channel.name or ""] = other
+                    break
+
+
+class GuildIndexes:
+    """A GuildIndex for every guild we're in, kept current by gateway events.
+
+    Each guild's is filled from its GUILD_CREATE, and then only changes a
+    role or a channel at a time, so looking up a role or a channel by name
+    never needs a REST call, or a scan of the guild."""
+
+    def __init__(self) -> None:
+        self._guilds: dict[int, GuildIndex] = {}
+
+    def __len__(self) -> int:
+        return len(self._guilds)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._guilds
+
+    def guild_set(
+        self,
+        guild_id: int,
+        roles: Iterable[hikari.Role],
+        channels: Iterable[hikari.GuildChannel],
+    ) -> GuildIndex:
+        """Start the guild's index over, from everything it has."""
+        index = GuildIndex()
+        for role in roles:
+            index.role_set(role)
+        for channel in channels:
+            index.channel_set(channel)
+        self._guilds[guild_id] = index
+        logger.debug(
+            "Indexed %d roles and %d text channels for guild: %r",
+            len(index.roles),
+            len(index.channels),
+            guild_id,
+        )
+        return index
+
+    def discard_guild(self, guild_id: int) -> None:
+        self._guilds.pop(guild_id, None)
+
+    def role_set(self, role: hikari.Role) -> None:
+        index = self._guilds.get(role.guild_id)
+        if index:
+            index.role_set(role)
+
+    def role_delete(self, guild_id: int, role_id: int) -> hikari.Role | None:
+        index = self._guilds.get(guild_id)
+        return index.role_delete(role_id) if index else None
+
+    def channel_set(self, channel: hikari.GuildChannel) -> None:
+        index = self._guilds.get(channel.guild_id)
+        if index:
+            index.channel_set(channel)
+
+    def channel_delete(self, guild_id: int, channel_id: int) -> None:
+        index = self._guilds.get(guild_id)
+        if index:
+            index.channel_delete(channel_id)
+
+    def roles(self, guild_id: int) -> Mapping[str, hikari.Role] | None:
+        """The guild's roles by name, or None if we haven't seen the guild."""
+        index = self._guilds.get(guild_id)
+        return types.MappingProxyType(index.role_names) if index else None
+
+    def text_channel(self, guild_id: int, name: str) -> hikari.GuildTextChannel | None:
+        index = self._guilds.get(guild_id)
+        return index.channel_names.get(name) if index else None
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+from typing import Awaitable, Callable, Iterator, Sequence
+
+import hikari
+
+logger = logging.getLogger(__name__)
+
+# Joins that arrive this close together get one welcome message.
+WELCOME_WINDOW = 2.0
+# How many lobby roles can be handed out at once, across all guilds.
+ROLE_WORKERS = 4
+# Discord's limit on the length of a message.
+MESSAGE_LIMIT = 2000
+# Stands in for the names while the rest of the template is filled in.
+NAME_MARKER = "\0"
+
+# ---------------------------------------------------------------------------- #
+#                               Welcome templates                              #
+# ---------------------------------------------------------------------------- #
+
+
+class WelcomeTemplate:
+    """A welcome message with everything but the names already filled in."""
+
+    __slots__ = ("parts",)
+
+    def __init__(self, template: str, days: int | None):
+        # Raises on unknown substitutions, so compile it when configuring.
+        self.parts = template.format(name=NAME_MARKER, days=days).split(NAME_MARKER)
+
+    def render(self, mentions: Sequence[str]) -> str:
+        return ", ".join(mentions).join(self.parts)
+
+    def messages(
+        self, mentions: Sequence[str], limit: int = MESSAGE_LIMIT
+    ) -> Iterator[str]:
+        """As few messages as it takes to welcome everyone."""
+        names = len(self.parts) - 1
+        size = sum(len(p) for p in self.parts)
+        batch: list[str] = []
+        length = size
+        for mention in mentions:
+            extra = (len(mention) + (2 if batch else 0)) * names
+            if batch and length + extra > limit:
+                yield self.render(batch)
+                batch, length = [], size
+                extra = len(mention) * names
+            batch.append(mention)
+            length += extra
+        if batch:
+            yield self.render(batch)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_welcome(template: str, days: int | None) -> WelcomeTemplate:
+    return WelcomeTemplate(template, days)
+
+
+# ---------------------------------------------------------------------------- #
+#                            Batching of member joins                          #
+# ---------------------------------------------------------------------------- #
+
+RoleFunc = Callable[[int, hikari.Member], Awaitable[None]]
+WelcomeFunc = Callable[[int, Sequence[hikari.Member]], Awaitable[None]]
+
+
+class JoinAggregator:
+    """Gathers up a guild's joins, so a raid doesn't flood the lobby.
+
+    Everyone who joins a guild within `window` of the first of them is
+    welcomed together, by one call to `welcome`. Their lobby roles go
+    through a queue with a fixed number of workers, so a thousand joins
+    are a thousand queued calls, not a thousand handlers all fighting
+    over the rate limit at once."""
+
+    def __init__(
+        self,
+        add_role: RoleFunc,
+        welcome: WelcomeFunc,
+        window: float = WELCOME_WINDOW,
+        workers: int = ROLE_WORKERS,
+    ):
+        self.add_role = add_role
+        self.welcome = welcome
+        self.window = window
+        self.workers = workers
+        self._pending: dict[int, list[hikari.Member]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._roles: asyncio.Queue[tuple[int, hikari.Member]] = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+        self._flushing = asyncio.Event()
+
+    def __len__(self) -> int:
+        return sum(len(p) for p in self._pending.values()) + self._roles.qsize()
+
+    def submit(self, guild_id: int, member: hikari.Member) -> None:
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._role_worker()) for _ in range(self.workers)
+            ]
+        self._roles.put_nowait((guild_id, member))
+
+        self._pending.setdefault(guild_id, []).append(member)
+        if guild_id not in self._tasks:
+            self._tasks[guild_id] = asyncio.create_task(self._welcomer(guild_id))
+
+    async def _role_worker(self) -> None:
+        while True:
+            guild_id, member = await self._roles.get()
+            try:
+                await self.add_role(guild_id, member)
+            except Exception as e:
+                logger.exception(
+                    "G=%r U=%r Error adding lobby role: %r", guild_id, member.id, e
+                )
+            finally:
+                self._roles.task_done()
+
+    async def _wait(self) -> None:
+        try:
+            await asyncio.wait_for(self._flushing.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _welcomer(self, guild_id: int) -> None:
+        try:
+            await self._wait()
+            members = self._pending.pop(guild_id)
+            try:
+                await self.welcome(guild_id, members)
+            except Exception as e:
+                logger.exception(
+                    "G=%r Error welcoming %d member(s): %r", guild_id, len(members), e
+                )
+        finally:
+            del self._tasks[guild_id]
+
+    async def flush(self) -> None:
+        """Welcome everyone and hand out every role right away, i.e. on shutdown."""
+        self._flushing.set()
+        if self._tasks:
+            logger.info("Flushing joins for %d guild(s)", len(self._tasks))
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        if self._workers:
+            await self._roles.join()
+
+    def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
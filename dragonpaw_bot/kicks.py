@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Kicks go out in batches of this many, with a pause between batches, so a
+# big wave of joins coming due doesn't hammer the API.
+KICK_BATCH_SIZE = 10
+KICK_BATCH_INTERVAL = 5.0
+# Never sleep longer than this, in case the clock jumps.
+MAX_SLEEP = 600.0
+
+# ---------------------------------------------------------------------------- #
+#                  Deadlines for kicking members out of the lobby              #
+# ---------------------------------------------------------------------------- #
+
+Kick = tuple[int, int, datetime.datetime]  # (guild_id, member_id, deadline)
+KickFunc = Callable[[Sequence[Kick]], Awaitable[None]]
+
+
+class KickScheduler:
+    """A min-heap of (deadline, guild, member), and a task that fires them.
+
+    Nothing ever scans the members of a guild: the task sleeps until the
+    earliest deadline and hands everything that's due to `kick`. Cancelling
+    only forgets the deadline, and the heap entry is skipped when it comes
+    up. The deadlines are saved with the guild state, this is just the index
+    over them, so it's filled again after a restart."""
+
+    def __init__(
+        self,
+        kick: KickFunc,
+        batch_size: int = KICK_BATCH_SIZE,
+        interval: float = KICK_BATCH_INTERVAL,
+    ):
+        self.kick = kick
+        self.batch_size = batch_size
+        self.interval = interval
+        self._heap: list[tuple[float, int, int]] = []
+        self._deadlines: dict[tuple[int, int], datetime.datetime] = {}
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, guild_id: int, member_id: int, deadline: datetime.datetime):
+        key = (guild_id, member_id)
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        when = deadline.timestamp()
+        heapq.heappush(self._heap, (when, guild_id, member_id))
+        if self._heap[0][0] == when:
+            # It's the new earliest, so the task has to wake up sooner.
+            self._wake.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, guild_id: int, member_id: int) -> None:
+        self._deadlines.pop((guild_id, member_id), None)
+
+    def _pop_due(self, now: float) -> list[Kick]:
+        due: list[Kick] = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            when, guild_id, member_id = heapq.heappop(self._heap)
+            deadline = self._deadlines.get((guild_id, member_id))
+            if deadline is None or deadline.timestamp() != when:
+                continue  # Cancelled, or moved.
+            del self._deadlines[(guild_id, member_id)]
+            due.append((guild_id, member_id, deadline))
+        return due
+
+    async def _sleep(self, delay: float) -> None:
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=min(delay, MAX_SLEEP))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                await self._sleep(MAX_SLEEP)
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            due = self._pop_due(time.time())
+            if not due:
+                continue
+            logger.info("Kicking %d member(s) out of lobbies", len(due))
+            try:
+                await self.kick(due)
+            except Exception as e:
+                logger.exception("Error kicking lobby members: %r", e)
+            await asyncio.sleep(self.interval)
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
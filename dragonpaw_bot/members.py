@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import collections
+import logging
+from typing import NamedTuple
+
+import hikari
+
+from dragonpaw_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# Enough for everyone clicking on things at once in a busy hour, not the
+# whole membership of every guild.
+MEMBER_CACHE_SIZE = 10_000
+# What hikari caches for us: only what the plugins look at. Members go in
+# the cache below, custom emojis are kept in bot.custom_emojis, and roles
+# and channels in bot.indexes.
+CACHE_COMPONENTS = hikari.api.CacheComponents.GUILDS | hikari.api.CacheComponents.ME
+
+# ---------------------------------------------------------------------------- #
+#                        A small, bounded cache of members                     #
+# ---------------------------------------------------------------------------- #
+
+MEMBER_LOOKUPS = metrics.Counter(
+    "dragonpaw_member_cache_lookups_total",
+    "Member lookups in the bot's own member cache, by result.",
+    ("result",),
+)
+
+
+class CachedMember(NamedTuple):
+    display_name: str
+    role_ids: frozenset[int]
+
+
+class MemberCache:
+    """The members we've seen lately, least recently used ones dropped first.
+
+    hikari's member cache holds every member of every guild, which is most
+    of the bot's memory and nearly all of it never looked at. The handlers
+    only ever want a display name for the logs, or the roles of someone
+    who is clicking on things right now, and the gateway events keep the
+    recent ones up to date. A miss costs a REST call, not a wrong answer."""
+
+    def __init__(self, size: int = MEMBER_CACHE_SIZE):
+        self.size = size
+        self._members: collections.OrderedDict[
+            tuple[int, int], CachedMember
+        ] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def get(self, guild_id: int, user_id: int) -> CachedMember | None:
+        member = self._members.get((guild_id, user_id))
+        if member is None:
+            MEMBER_LOOKUPS.inc("miss")
+            return None
+        self._members.move_to_end((guild_id, user_id))
+        MEMBER_LOOKUPS.inc("hit")
+        return member
+
+    def put(self, member: hikari.Member) -> CachedMember:
+        key = (member.guild_id, member.user.id)
+        cached = CachedMember(
+            display_name=member.display_name, role_ids=frozenset(member.role_ids)
+        )
+        self._members[key] = cached
+        self._members.move_to_end(key)
+        while len(self._members) > self.size:
+            self._members.popitem(last=False)
+        return cached
+
+    def discard(self, guild_id: int, user_id: int) -> None:
+        self._members.pop((guild_id, user_id), None)
+
+    def discard_guild(self, guild_id: int) -> None:
+        for key in [k for k in self._members if k[0] == guild_id]:
+            del self._members[key]
@@ -0,0 +1,375 @@
+from __future__ import annotations
+
+import abc
+import bisect
+import contextlib
+import functools
+import logging
+import math
+import resource
+import threading
+import time
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+    TypeVar,
+    cast,
+)
+
+import hikari
+from aiohttp import web
+
+if TYPE_CHECKING:
+    from dragonpaw_bot.bot import DragonpawBot
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+# Reaction handlers take well under a millisecond, a full /config can take
+# half a minute, so the buckets have to cover all of that.
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+PROC_STATM = Path("/proc/self/statm")
+
+# ---------------------------------------------------------------------------- #
+#               Metrics, in the Prometheus text format, no libraries           #
+# ---------------------------------------------------------------------------- #
+
+Labels = tuple[str, ...]
+REGISTRY: list[Metric] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labels: Labels = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        # Observations can come from the persister's thread too.
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[str]:
+        ...
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Labels = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labels: Labels = (),
+        buckets: tuple[float, ...] = BUCKETS,
+    ):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+        # Labels -> [count in each bucket, and +Inf], sum
+        self._series: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        n = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][n] += 1
+            series[1][0] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = [(k, list(c), s[0]) for k, (c, s) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            running = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                running += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                bucket = _labels(self.labels, labels, f'le="{le}"')
+                yield f"{self.name}_bucket{bucket} {running}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {running}"
+
+
+class Gauge(Metric):
+    """A value that's worked out when we're scraped."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        func: Callable[[], Mapping[Labels, float]],
+        labels: Labels = (),
+    ):
+        super().__init__(name, doc, labels)
+        self.func = func
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self.func().items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            logger.exception("Error rendering metric %s: %r", metric.name, e)
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_SECONDS = Histogram(
+    "dragonpaw_handler_seconds", "Time spent in each event handler.", ("handler",)
+)
+CONFIGURE_SECONDS = Histogram(
+    "dragonpaw_configure_seconds", "Time spent on each phase of /config.", ("phase",)
+)
+REST_CALLS = Counter(
+    "dragonpaw_rest_calls_total", "Discord REST calls made, by route.", ("route",)
+)
+REST_SECONDS = Histogram(
+    "dragonpaw_rest_seconds",
+    "Time for Discord to answer a REST call, by route.",
+    ("route",),
+)
+RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "dragonpaw_rate_limit_wait_seconds",
+    "Time REST calls spent waiting on a rate limit, by route.",
+    ("route",),
+)
+STATE_WRITE_SECONDS = Histogram(
+    "dragonpaw_state_write_seconds", "Time to save a guild's state to the store."
+)
+
+
+def _memory() -> Mapping[Labels, float]:
+    # ru_maxrss is in KB on Linux.
+    values: dict[Labels, float] = {
+        ("peak",): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.0
+    }
+    if PROC_STATM.exists():
+        pages = int(PROC_STATM.read_text().split()[1])
+        values[("rss",)] = float(pages * resource.getpagesize())
+    return values
+
+
+Gauge("dragonpaw_memory_bytes", "Memory used by the bot process.", _memory, ("kind",))
+
+
+# ---------------------------------------------------------------------------- #
+#                                Instrumentation                               #
+# ---------------------------------------------------------------------------- #
+
+
+def timed_handler(name: str) -> Callable[[F], F]:
+    """Record how long every call to an event handler takes."""
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with HANDLER_SECONDS.time(name):
+                return await func(*args, **kwargs)
+
+        # Same signature, so lightbulb can still tell which event it takes.
+        return cast(F, wrapper)
+
+    return decorator
+
+
+class TimedBuckets:
+    """Wraps hikari's rate limit buckets, to time the REST calls going through.
+
+    hikari holds a route's bucket from before it waits on the rate limit
+    until after the response is in, so that's where both get measured.
+    Everything else is passed straight through. The bucket manager is
+    private to hikari, so whatever it's called with is passed on as is."""
+
+    def __init__(self, buckets: Any):
+        self._buckets = buckets
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._buckets, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire_bucket(self, *args: Any, **kwargs: Any) -> AsyncIterator[None]:
+        compiled_route = args[0] if args else kwargs.get("compiled_route")
+        route = str(getattr(compiled_route, "route", "unknown"))
+        start = time.perf_counter()
+        async with self._buckets.acquire_bucket(*args, **kwargs):
+            acquired = time.perf_counter()
+            RATE_LIMIT_WAIT_SECONDS.observe(acquired - start, route)
+            try:
+                yield
+            finally:
+                REST_SECONDS.observe(time.perf_counter() - acquired, route)
+                REST_CALLS.inc(route)
+
+
+def instrument_rest(rest: hikari.api.RESTClient) -> None:
+    # There's no hook for this in hikari, so swap the bucket manager. That's
+    # private, so check it still looks like it did, and do without if not.
+    buckets = getattr(rest, "_bucket_manager", None)
+    if isinstance(buckets, TimedBuckets):
+        return
+    if not callable(getattr(buckets, "acquire_bucket", None)):
+        logger.warning(
+            "hikari's REST client has changed, no REST call metrics: %r", rest
+        )
+        return
+    setattr(rest, "_bucket_manager", TimedBuckets(buckets))
+
+
+# ---------------------------------------------------------------------------- #
+#                              Metrics & health server                         #
+# ---------------------------------------------------------------------------- #
+
+
+class MetricsServer:
+    """Serves /metrics, plus /healthz and /readyz for the k8s probes."""
+
+    def __init__(self, bot: DragonpawBot, port: int):
+        self.bot = bot
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+        Gauge(
+            "dragonpaw_gateway_latency_seconds",
+            "Heartbeat latency of each gateway shard.",
+            self._gateway_latency,
+            ("shard",),
+        )
+        Gauge(
+            "dragonpaw_state_write_queue",
+            "Guild states waiting to be saved.",
+            lambda: {(): float(bot.persister.queue_depth)},
+        )
+        Gauge(
+            "dragonpaw_member_cache_size",
+            "Members in the bot's own member cache.",
+            lambda: {(): float(len(bot.members))},
+        )
+
+    def _gateway_latency(self) -> Mapping[Labels, float]:
+        return {
+            (str(shard_id),): shard.heartbeat_latency
+            for shard_id, shard in self.bot.shards.items()
+            if not math.isnan(shard.heartbeat_latency)
+        }
+
+    def problems(self) -> Iterable[str]:
+        """Anything that means we're not able to handle events."""
+        if not self.bot.is_alive:
+            yield "bot not running"
+        for shard_id, shard in self.bot.shards.items():
+            if not shard.is_alive or math.isnan(shard.heartbeat_latency):
+                yield f"shard {shard_id} not connected"
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        # Answering at all means the event loop is alive.
+        if not self.bot.persister.is_alive:
+            return web.Response(status=503, text="state persister died\n")
+        return web.Response(text="ok\n")
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        problems = list(self.problems())
+        if problems:
+            return web.Response(status=503, text="\n".join(problems) + "\n")
+        return web.Response(text="ok\n")
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, port=self.port).start()
+        logger.info("Serving metrics and health checks on port %d", self.port)
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Iterable
+
+from dragonpaw_bot.routing import GuildRoutes
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for a member to stop clicking before touching their roles.
+DEBOUNCE_SECONDS = 1.0
+
+# ---------------------------------------------------------------------------- #
+#                 Coalescing of role changes, per guild & member               #
+# ---------------------------------------------------------------------------- #
+
+
+class PendingRoles:
+    """Everything a member asked for since we last changed their roles."""
+
+    __slots__ = ("routes", "user_id", "adds", "removes", "current", "naive_calls")
+
+    def __init__(self, routes: GuildRoutes, user_id: int):
+        self.routes = routes
+        self.user_id = user_id
+        self.adds: set[int] = set()
+        self.removes: set[int] = set()
+        # The member's roles, if an event told us what they are.
+        self.current: set[int] | None = None
+        # How many REST calls doing each click on its own would have taken.
+        self.naive_calls = 0
+
+    def add(self, role_id: int) -> None:
+        self.removes.discard(role_id)
+        self.adds.add(role_id)
+
+    def remove(self, role_id: int) -> None:
+        self.adds.discard(role_id)
+        self.removes.add(role_id)
+
+    def target(self, current: set[int]) -> set[int]:
+        return (current - self.removes) | self.adds
+
+
+ApplyFunc = Callable[[PendingRoles], Awaitable[None]]
+
+
+class RoleMutator:
+    """Folds a member's rapid clicks into one role change.
+
+    Each (guild, member) gets one worker task. It waits out the debounce
+    window, applies whatever was asked for in that time, and keeps going
+    while more clicks arrive, so changes for one member never overlap or
+    land out of order."""
+
+    def __init__(self, apply: ApplyFunc, delay: float = DEBOUNCE_SECONDS):
+        self.apply = apply
+        self.delay = delay
+        self._pending: dict[tuple[int, int], PendingRoles] = {}
+        self._tasks: dict[tuple[int, int], asyncio.Task] = {}
+        self._flushing = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def submit(
+        self,
+        routes: GuildRoutes,
+        user_id: int,
+        add: Iterable[int] = (),
+        remove: Iterable[int] = (),
+        current: Iterable[int] | None = None,
+        naive_calls: int = 1,
+    ) -> None:
+        key = (routes.guild_id, user_id)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = PendingRoles(routes=routes, user_id=user_id)
+
+        # Removes first, so a click that swaps roles ends up with the new one.
+        for r in remove:
+            pending.remove(r)
+        for r in add:
+            pending.add(r)
+        if current is not None:
+            pending.current = set(current)
+        pending.routes = routes
+        pending.naive_calls += naive_calls
+
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._worker(key))
+
+    async def _wait(self) -> None:
+        try:
+            await asyncio.wait_for(self._flushing.wait(), timeout=self.delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self, key: tuple[int, int]) -> None:
+        try:
+            while key in self._pending:
+                await self._wait()
+                pending = self._pending.pop(key)
+                try:
+                    await self.apply(pending)
+                except Exception as e:
+                    logger.exception(
+                        "G=%r U=%r Error changing roles: %r",
+                        pending.routes.name,
+                        pending.user_id,
+                        e,
+                    )
+        finally:
+            del self._tasks[key]
+
+    async def flush(self) -> None:
+        """Apply everything that's waiting right away, i.e. on shutdown."""
+        self._flushing.set()
+        if self._tasks:
+            logger.info("Flushing role changes for %d member(s)", len(self._tasks))
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
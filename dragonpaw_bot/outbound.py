@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import enum
+import logging
+import time
+from typing import AsyncIterator
+
+from dragonpaw_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# How many REST calls can be in flight at once, and how many of those can be
+# bulk work. The difference is always there for members clicking on things.
+REST_SLOTS = 16
+BULK_SLOTS = 4
+
+# ---------------------------------------------------------------------------- #
+#                    Priority scheduling of outbound REST calls                 #
+# ---------------------------------------------------------------------------- #
+
+
+class Priority(enum.IntEnum):
+    # Someone is waiting on this: role menu clicks, button responses.
+    INTERACTIVE = 0
+    # Nobody is watching it happen: setting up a guild, seeding reactions.
+    BULK = 1
+
+
+OUTBOUND_WAIT_SECONDS = metrics.Histogram(
+    "dragonpaw_outbound_wait_seconds",
+    "Time REST calls waited for a slot in the scheduler, by priority.",
+    ("priority",),
+)
+
+
+class RestScheduler:
+    """Hands out slots for REST calls, interactive ones first.
+
+    Interactive calls take any free slot and go to the front of the line.
+    Bulk calls only get BULK_SLOTS of them, and only when no interactive
+    call is waiting, so they can't fill hikari's rate limit buckets up ahead
+    of a member's click. Waiting bulk calls are queued per guild and served
+    round-robin, so one guild being set up can't starve another."""
+
+    def __init__(self, slots: int = REST_SLOTS, bulk_slots: int = BULK_SLOTS):
+        self.slots = slots
+        self.bulk_slots = min(bulk_slots, slots)
+        self._running = 0
+        self._bulk_running = 0
+        self._interactive: collections.deque[asyncio.Future] = collections.deque()
+        # Guild -> its waiting bulk calls, in the order guilds get served.
+        self._bulk: collections.OrderedDict[
+            int, collections.deque[asyncio.Future]
+        ] = collections.OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._interactive) + sum(len(q) for q in self._bulk.values())
+
+    def _can_run(self, priority: Priority) -> bool:
+        if self._running >= self.slots:
+            return False
+        if priority == Priority.INTERACTIVE:
+            return True
+        return self._bulk_running < self.bulk_slots and not self._interactive
+
+    def _start(self, priority: Priority) -> None:
+        self._running += 1
+        if priority == Priority.BULK:
+            self._bulk_running += 1
+
+    def _next_bulk(self) -> asyncio.Future | None:
+        while self._bulk:
+            guild_id, queue = next(iter(self._bulk.items()))
+            future = queue.popleft()
+            if queue:
+                self._bulk.move_to_end(guild_id)
+            else:
+                del self._bulk[guild_id]
+            if not future.done():
+                return future
+        return None
+
+    def _wake(self) -> None:
+        while self._interactive and self._can_run(Priority.INTERACTIVE):
+            future = self._interactive.popleft()
+            if not future.done():
+                self._start(Priority.INTERACTIVE)
+                future.set_result(None)
+        while self._bulk and self._can_run(Priority.BULK):
+            waiting = self._next_bulk()
+            if waiting:
+                self._start(Priority.BULK)
+                waiting.set_result(None)
+
+    async def _acquire(self, guild_id: int, priority: Priority) -> None:
+        queued = self._interactive or (priority == Priority.BULK and self._bulk)
+        if not queued and self._can_run(priority):
+            self._start(priority)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        if priority == Priority.INTERACTIVE:
+            self._interactive.append(future)
+        else:
+            self._bulk.setdefault(guild_id, collections.deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed a slot just as we got cancelled.
+                self._release(priority)
+            raise
+
+    def _release(self, priority: Priority) -> None:
+        self._running -= 1
+        if priority == Priority.BULK:
+            self._bulk_running -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, guild_id: int, priority: Priority) -> AsyncIterator[None]:
+        start = time.perf_counter()
+        await self._acquire(guild_id, priority)
+        OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - start, priority.name)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def interactive(self, guild_id: int) -> contextlib.AbstractAsyncContextManager:
+        return self.slot(guild_id, Priority.INTERACTIVE)
+
+    def bulk(self, guild_id: int) -> contextlib.AbstractAsyncContextManager:
+        return self.slot(guild_id, Priority.BULK)
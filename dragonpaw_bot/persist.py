@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import threading
+import time
+
+from dragonpaw_bot import metrics, structs
+from dragonpaw_bot.store import StateStore
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+#                  Write-behind persistence of guild state                     #
+# ---------------------------------------------------------------------------- #
+
+
+class StatePersister:
+    """Saves guild states from a worker thread.
+
+    The event loop only marks a guild dirty. The worker writes the newest
+    state for each dirty guild, so a burst of updates to one guild costs one
+    write. States must not be changed after they're handed over, replace
+    them instead."""
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self._dirty: dict[int, structs.GuildState] = {}
+        self._writing = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="state-persister", daemon=True
+        )
+
+        # Stats, for anyone who wants to know how we're doing.
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.write_seconds = 0.0
+        self.last_write_seconds = 0.0
+        self.max_write_seconds = 0.0
+
+    def start(self) -> None:
+        self._thread.start()
+        # Daemon threads are killed at exit, so make sure we get to finish.
+        atexit.register(self.stop)
+
+    @property
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._dirty)
+
+    def mark_dirty(self, state: structs.GuildState) -> None:
+        if self._stopping:
+            # Too late for the worker, so this one blocks.
+            logger.warning("G=%r Saving state after shutdown", state.name)
+            self.store.save(state)
+            return
+
+        with self._cond:
+            if state.id in self._dirty:
+                self.coalesced += 1
+            self._dirty[state.id] = state
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._dirty or self._stopping)
+                if not self._dirty:
+                    return
+                guild_id = next(iter(self._dirty))
+                state = self._dirty.pop(guild_id)
+                self._writing = True
+
+            start = time.perf_counter()
+            try:
+                self.store.save(state)
+            except Exception as e:
+                self.errors += 1
+                logger.exception("G=%r Error saving state: %r", state.name, e)
+            elapsed = time.perf_counter() - start
+            metrics.STATE_WRITE_SECONDS.observe(elapsed)
+
+            with self._cond:
+                self._writing = False
+                self.writes += 1
+                self.write_seconds += elapsed
+                self.last_write_seconds = elapsed
+                self.max_write_seconds = max(self.max_write_seconds, elapsed)
+                self._cond.notify_all()
+            logger.debug(
+                "G=%r State saved in %.1fms, %d waiting",
+                state.name,
+                elapsed * 1000,
+                self.queue_depth,
+            )
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait for everything dirty to be written. False if we timed out."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._dirty and not self._writing, timeout=timeout
+            )
+
+    def stop(self, timeout: float | None = 30) -> None:
+        """Write whatever is left, then stop the worker."""
+        with self._cond:
+            if self._stopping:
+                return
+            self._stopping = True
+            if self._dirty:
+                logger.info("Writing state for %d guild(s)", len(self._dirty))
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout=timeout)
+        if self._dirty:
+            logger.error("Gave up on saving %d guild(s)", len(self._dirty))
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+import datetime
 import logging
-from typing import TYPE_CHECKING, List, Mapping
+from collections import defaultdict
+from typing import TYPE_CHECKING, Iterable, List, Mapping, Sequence
 
 import hikari
 import lightbulb
 
-from dragonpaw_bot import structs, utils
+from dragonpaw_bot import metrics, structs, utils
+from dragonpaw_bot.cluster import StateChangedEvent
 from dragonpaw_bot.colors import SOLARIZED_BLUE
+from dragonpaw_bot.joins import JoinAggregator, compile_welcome
+from dragonpaw_bot.kicks import Kick, KickScheduler
 
 if TYPE_CHECKING:
     from dragonpaw_bot.bot import DragonpawBot
@@ -17,6 +22,14 @@ plugin = lightbulb.Plugin("Lobby")
 
 RULES_AGREED_ID = "rules_agreed"
 
+# Kicks the members who never made it out of the lobby.
+kick_scheduler = KickScheduler(kick=lambda due: kick_lobby_members(due))
+# Hands out lobby roles and welcomes new members, in batches.
+joins = JoinAggregator(
+    add_role=lambda guild_id, member: add_lobby_role(guild_id, member),
+    welcome=lambda guild_id, members: welcome_members(guild_id, members),
+)
+
 
 def load(bot: lightbulb.BotApp):
     bot.add_plugin(plugin)
@@ -26,24 +39,16 @@ def unload(bot: lightbulb.BotApp):
     bot.remove_plugin(plugin)
 
 
-async def configure_lobby(
-    bot: DragonpawBot,
-    guild: hikari.Guild,
+def compile_lobby(
     config: structs.LobbyConfig,
     state: structs.GuildState,
-    role_map: Mapping[str, hikari.Role],
-) -> List[str]:
-    errors: List[str] = []
+    role_map: Mapping[str, hikari.PartialRole],
+) -> tuple[hikari.Embed | None, List[str]]:
+    """Work out the lobby settings from a config, without touching Discord.
 
-    # Where is the lobby
-    channel = await utils.guild_channel_by_name(
-        bot=bot, guild=guild, name=config.channel
-    )
-    if not channel:
-        errors.append(f"Lobby channel {config.channel} doesn't seem to exist.")
-        return errors
+    Returns the rules embed to post, if there are rules."""
 
-    state.lobby_channel_id = channel.id
+    errors: List[str] = []
 
     # Does it have an auto-join role?
     if config.role:
@@ -56,6 +61,10 @@ async def configure_lobby(
         state.lobby_kick_days = config.kick_after_days
 
     if config.welcome_message:
+        try:
+            compile_welcome(config.welcome_message, state.lobby_kick_days)
+        except (KeyError, IndexError, ValueError) as e:
+            errors.append(f"Welcome message has an unknown substitution in it: {e}")
         state.lobby_welcome_message = config.welcome_message
 
     if config.click_for_rules and not config.role:
@@ -64,20 +73,63 @@ async def configure_lobby(
             "remove when they click.."
         )
 
-    if config.rules:
-        await utils.delete_my_messages(
-            bot=bot, guild_name=guild.name, channel_id=channel.id
+    if config.kick_after_days and not config.role:
+        errors.append(
+            "The lobby kicks people after some days, but has no role to "
+            "tell who is still in the lobby."
         )
 
-        embed = hikari.Embed(
-            title="Server Rules",
-            description=config.rules,
-            color=SOLARIZED_BLUE,
-        )
+    if not config.rules:
+        return None, errors
+
+    state.lobby_rules = config.rules
+    state.lobby_click_for_rules = config.click_for_rules
+    embed = hikari.Embed(
+        title="Server Rules",
+        description=config.rules,
+        color=SOLARIZED_BLUE,
+    )
+    return embed, errors
 
-        state.lobby_rules = config.rules
-        state.lobby_click_for_rules = config.click_for_rules
 
+def lobby_deadlines_keep(
+    state: structs.GuildState, current: structs.GuildState | None
+) -> None:
+    """Anyone already waiting in the lobby keeps their deadline.
+
+    Call with the live state just before saving the new one: joins that
+    happened while the guild was being set up have saved deadlines too."""
+    if (
+        current
+        and state.lobby_kick_days
+        and current.lobby_role_id == state.lobby_role_id
+    ):
+        state.lobby_kick_deadlines = dict(current.lobby_kick_deadlines)
+
+
+async def configure_lobby(
+    bot: DragonpawBot,
+    guild: hikari.Guild,
+    config: structs.LobbyConfig,
+    state: structs.GuildState,
+    previous: structs.GuildState | None,
+    role_map: Mapping[str, hikari.Role],
+) -> List[str]:
+    errors: List[str] = []
+
+    # Where is the lobby
+    channel = await utils.guild_channel_by_name(
+        bot=bot, guild=guild, name=config.channel
+    )
+    if not channel:
+        errors.append(f"Lobby channel {config.channel} doesn't seem to exist.")
+        return errors
+
+    state.lobby_channel_id = channel.id
+    embed, errors = compile_lobby(config=config, state=state, role_map=role_map)
+
+    if embed:
+        component: hikari.api.ComponentBuilder | None = None
         if config.click_for_rules and config.role:
             row = plugin.bot.rest.build_message_action_row()
             (
@@ -86,15 +138,55 @@ async def configure_lobby(
                 .set_emoji("✅")
                 .add_to_container()
             )
-            await channel.send(embed=embed, component=row)
-        else:
-            await channel.send(embed=embed)
+            component = row
+
+        old_id = previous.lobby_rules_message_id if previous else None
+        if (
+            previous
+            and old_id
+            and previous.lobby_channel_id == channel.id
+            and previous.lobby_rules == config.rules
+            and previous.lobby_click_for_rules == config.click_for_rules
+            and previous.lobby_role_id == state.lobby_role_id
+        ):
+            logger.debug("G=%r Rules haven't changed", guild.name)
+            state.lobby_rules_message_id = old_id
+        elif previous and old_id and previous.lobby_channel_id == channel.id:
+            # Edit the rules we already posted, if they're still there.
+            try:
+                async with bot.outbound.bulk(guild.id):
+                    await bot.rest.edit_message(
+                        channel, old_id, embed=embed, component=component
+                    )
+                state.lobby_rules_message_id = old_id
+            except hikari.NotFoundError:
+                logger.info("G=%r Old rules are gone, sending new ones", guild.name)
+
+        if not state.lobby_rules_message_id:
+            if previous and previous.lobby_channel_id and old_id:
+                await utils.delete_my_messages(
+                    bot=bot,
+                    guild=guild,
+                    channel_id=previous.lobby_channel_id,
+                    message_ids=[old_id],
+                )
+            else:
+                await utils.delete_my_messages(
+                    bot=bot, guild=guild, channel_id=channel.id
+                )
+
+            async with bot.outbound.bulk(guild.id):
+                message = await channel.send(
+                    embed=embed, component=component or hikari.UNDEFINED
+                )
+            state.lobby_rules_message_id = message.id
 
     logger.info("G=%r Configured lobby channel %s", guild.name, config.channel)
     return errors
 
 
 @plugin.listener(event=hikari.MemberCreateEvent, bind=True)
+@metrics.timed_handler("on_member_join")
 async def on_member_join(plugin: lightbulb.Plugin, event: hikari.MemberCreateEvent):
     """Handle a new member joining the server."""
 
@@ -104,40 +196,65 @@ async def on_member_join(plugin: lightbulb.Plugin, event: hikari.MemberCreateEve
         logger.error("Called on an unknown guild: %r", event.guild_id)
         return
 
-    # Is there a on-join role configured
-    if c.lobby_role_id:
-        await event.member.add_role(
-            role=c.lobby_role_id,
-            reason="New member role",
+    # Is there a on-join role or a welcome message configured
+    if c.lobby_role_id or (c.lobby_welcome_message and c.lobby_channel_id):
+        joins.submit(event.guild_id, event.member)
+
+
+async def add_lobby_role(guild_id: int, member: hikari.Member) -> None:
+    assert isinstance(plugin.bot, DragonpawBot)
+    c = plugin.bot.state(hikari.Snowflake(guild_id))
+    if not c or not c.lobby_role_id:
+        return
+
+    async with plugin.bot.outbound.interactive(guild_id):
+        await member.add_role(role=c.lobby_role_id, reason="New member role")
+
+
+async def welcome_members(guild_id: int, members: Sequence[hikari.Member]) -> None:
+    """Start the clock on everyone who just joined, and say hello to them."""
+
+    assert isinstance(plugin.bot, DragonpawBot)
+    c = plugin.bot.state(hikari.Snowflake(guild_id))
+    if not c:
+        return
+
+    if c.lobby_role_id and c.lobby_kick_days:
+        deadline = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            days=c.lobby_kick_days
+        )
+        kick_deadlines_update(
+            bot=plugin.bot,
+            guild_id=c.id,
+            add={m.id: deadline for m in members},
         )
 
-    # Is there a welcome message?
-    if c.lobby_welcome_message and c.lobby_channel_id:
-        try:
-            msg = c.lobby_welcome_message.format(
-                name=event.user.mention,
-                days=c.lobby_kick_days,
-            )
-        except KeyError as e:
-            await utils.report_errors(
-                bot=plugin.bot,
-                guild_id=event.guild_id,
-                error="Welcome message has an unknown substitution in it: {}".format(
-                    str(e)
-                ),
-            )
-            return
-
-        await plugin.bot.rest.create_message(
-            channel=c.lobby_channel_id,
-            content=msg,
-            user_mentions=True,
-            role_mentions=True,
-            nonce=event.user_id,
+    if not c.lobby_welcome_message or not c.lobby_channel_id:
+        return
+    try:
+        template = compile_welcome(c.lobby_welcome_message, c.lobby_kick_days)
+    except (KeyError, IndexError, ValueError) as e:
+        await utils.report_errors(
+            bot=plugin.bot,
+            guild_id=c.id,
+            error=f"Welcome message has an unknown substitution in it: {e}",
         )
+        return
+
+    if len(members) > 1:
+        logger.info("G=%r Welcoming %d members at once", c.name, len(members))
+    for content in template.messages([m.mention for m in members]):
+        async with plugin.bot.outbound.interactive(guild_id):
+            await plugin.bot.rest.create_message(
+                channel=c.lobby_channel_id,
+                content=content,
+                user_mentions=True,
+                role_mentions=True,
+            )
 
 
 @plugin.listener(event=hikari.InteractionCreateEvent, bind=True)
+@metrics.timed_handler("on_interaction")
 async def on_interaction(
     plugin: lightbulb.Plugin, event: hikari.InteractionCreateEvent
 ):
@@ -158,17 +275,186 @@ async def on_interaction(
             "G:%s U:%s agreed to the rules, they are %s no more.",
             c.name,
             event.interaction.user.username,
-            c.role_names[c.lobby_role_id],
-        )
-        await plugin.bot.rest.remove_role_from_member(
-            guild=event.interaction.guild_id,
-            user=event.interaction.user.id,
-            role=c.lobby_role_id,
+            c.role_names.get(c.lobby_role_id, c.lobby_role_id),
         )
+        async with plugin.bot.outbound.interactive(event.interaction.guild_id):
+            await plugin.bot.rest.remove_role_from_member(
+                guild=event.interaction.guild_id,
+                user=event.interaction.user.id,
+                role=c.lobby_role_id,
+            )
+        if event.interaction.user.id in c.lobby_kick_deadlines:
+            kick_deadlines_update(
+                bot=plugin.bot,
+                guild_id=event.interaction.guild_id,
+                remove=[event.interaction.user.id],
+            )
         await event.interaction.create_initial_response(
             content="Thank you. Removing your {} role.".format(
-                c.role_names[c.lobby_role_id]
+                c.role_names.get(c.lobby_role_id, c.lobby_role_id)
             ),
             response_type=hikari.ResponseType.MESSAGE_CREATE,
             flags=hikari.MessageFlag.EPHEMERAL,
         )
+
+
+# ---------------------------------------------------------------------------- #
+#                           Kicking people from the lobby                      #
+# ---------------------------------------------------------------------------- #
+
+
+def kick_deadlines_update(
+    bot: DragonpawBot,
+    guild_id: hikari.Snowflake,
+    add: Mapping[hikari.Snowflake, datetime.datetime] | None = None,
+    remove: Iterable[hikari.Snowflake] = (),
+) -> None:
+    """Change who gets kicked from the lobby when, and save it."""
+
+    state = bot.state(guild_id)
+    if not state:
+        return
+
+    deadlines = dict(state.lobby_kick_deadlines)
+    for member_id in remove:
+        deadlines.pop(member_id, None)
+        kick_scheduler.cancel(guild_id, member_id)
+    for member_id, deadline in (add or {}).items():
+        deadlines[member_id] = deadline
+        kick_scheduler.schedule(guild_id, member_id, deadline)
+
+    # States are shared with the persister, so swap in a new one.
+    bot.state_update(state.copy(update={"lobby_kick_deadlines": deadlines}))
+
+
+async def kick_lobby_members(due: Sequence[Kick]) -> None:
+    """Kick everyone whose time in the lobby is up, if they're still there."""
+
+    assert isinstance(plugin.bot, DragonpawBot)
+
+    by_guild: dict[int, list[tuple[int, datetime.datetime]]] = defaultdict(list)
+    for guild_id, member_id, deadline in due:
+        by_guild[guild_id].append((member_id, deadline))
+
+    for guild_id, members in by_guild.items():
+        state = plugin.bot.state(hikari.Snowflake(guild_id))
+        if not state:
+            continue
+
+        done: list[hikari.Snowflake] = []
+        for member_id, deadline in members:
+            # They might have left, or made it out, since this was scheduled.
+            if state.lobby_kick_deadlines.get(hikari.Snowflake(member_id)) != deadline:
+                continue
+            done.append(hikari.Snowflake(member_id))
+            if state.lobby_role_id and state.lobby_kick_days:
+                await kick_lobby_member(
+                    bot=plugin.bot, state=state, member_id=hikari.Snowflake(member_id)
+                )
+
+        if done:
+            kick_deadlines_update(bot=plugin.bot, guild_id=state.id, remove=done)
+
+
+async def kick_lobby_member(
+    bot: DragonpawBot, state: structs.GuildState, member_id: hikari.Snowflake
+) -> None:
+    member = bot.members.get(state.id, member_id)
+    try:
+        if not member:
+            async with bot.outbound.bulk(state.id):
+                fetched = await bot.rest.fetch_member(guild=state.id, user=member_id)
+            member = bot.members.put(fetched)
+    except hikari.NotFoundError:
+        return  # Already gone
+
+    if state.lobby_role_id not in member.role_ids:
+        return
+
+    logger.info(
+        "G=%r U=%r: Still in the lobby after %d days, kicking.",
+        state.name,
+        member.display_name,
+        state.lobby_kick_days,
+    )
+    try:
+        async with bot.outbound.bulk(state.id):
+            await bot.rest.kick_user(
+                guild=state.id,
+                user=member_id,
+                reason=f"Still in the lobby after {state.lobby_kick_days} days",
+            )
+    except hikari.NotFoundError:
+        pass
+    except hikari.ForbiddenError:
+        await utils.report_errors(
+            bot=bot,
+            guild_id=state.id,
+            error=(
+                f"Unable to kick {member.display_name} from the lobby, "
+                "please check my permissions."
+            ),
+        )
+
+
+@plugin.listener(event=hikari.GuildAvailableEvent, bind=True)
+async def on_guild_available(
+    plugin: lightbulb.Plugin, event: hikari.GuildAvailableEvent
+):
+    assert isinstance(plugin.bot, DragonpawBot)
+    state = plugin.bot.state(event.guild_id)
+    if state:
+        kick_deadlines_schedule(state)
+
+
+@plugin.listener(event=StateChangedEvent)
+async def on_state_changed(event: StateChangedEvent):
+    """Another process changed the guild, e.g. a /config, so catch up."""
+    if event.state:
+        kick_deadlines_schedule(event.state)
+
+
+def kick_deadlines_schedule(state: structs.GuildState) -> None:
+    """Make sure everyone waiting in the lobby is in the kick scheduler."""
+    if not state.lobby_kick_deadlines:
+        return
+    for member_id, deadline in state.lobby_kick_deadlines.items():
+        kick_scheduler.schedule(state.id, member_id, deadline)
+    logger.debug(
+        "G=%r %d member(s) waiting in the lobby",
+        state.name,
+        len(state.lobby_kick_deadlines),
+    )
+
+
+@plugin.listener(event=hikari.MemberUpdateEvent, bind=True)
+async def on_member_update(plugin: lightbulb.Plugin, event: hikari.MemberUpdateEvent):
+    """Someone took the lobby role away by hand, so they're safe."""
+
+    assert isinstance(plugin.bot, DragonpawBot)
+    state = plugin.bot.state(event.guild_id)
+    if (
+        state
+        and event.user_id in state.lobby_kick_deadlines
+        and state.lobby_role_id not in event.member.role_ids
+    ):
+        kick_deadlines_update(
+            bot=plugin.bot, guild_id=event.guild_id, remove=[event.user_id]
+        )
+
+
+@plugin.listener(event=hikari.MemberDeleteEvent, bind=True)
+async def on_member_leave(plugin: lightbulb.Plugin, event: hikari.MemberDeleteEvent):
+    assert isinstance(plugin.bot, DragonpawBot)
+    state = plugin.bot.state(event.guild_id)
+    if state and event.user_id in state.lobby_kick_deadlines:
+        kick_deadlines_update(
+            bot=plugin.bot, guild_id=event.guild_id, remove=[event.user_id]
+        )
+
+
+@plugin.listener(event=hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent):
+    await joins.flush()
+    joins.stop()
+    kick_scheduler.stop()
@@ -1,19 +1,40 @@
 from __future__ import annotations
 
+import asyncio
+import dataclasses
+import hashlib
+import json
 import logging
-from typing import TYPE_CHECKING, List, Mapping
+from typing import TYPE_CHECKING, List, Mapping, Sequence, Set, Union
 
 import hikari
 import lightbulb
 
-from dragonpaw_bot import structs, utils
+from dragonpaw_bot import metrics, structs, utils
 from dragonpaw_bot.colors import rainbow
+from dragonpaw_bot.mutations import PendingRoles, RoleMutator
+from dragonpaw_bot.reconcile import Checkpoint, ReconcileStats, option_key
+from dragonpaw_bot.routing import GuildRoutes, RoleAction
 
 if TYPE_CHECKING:
     from dragonpaw_bot.bot import DragonpawBot
 
 logger = logging.getLogger(__name__)
 
+Emoji = Union[hikari.KnownCustomEmoji, hikari.UnicodeEmoji]
+
+# How many menus can be having their reactions added at once.
+REACTION_CONCURRENCY = 3
+# How many reactors, and members, Discord sends back per page.
+REACTIONS_PAGE = 100
+MEMBERS_PAGE = 1000
+# Select menus: what a click sends us, and Discord's limits on them.
+ROLE_SELECT_ID = "role_menu_select"
+SELECT_OPTIONS_MAX = 25
+SELECT_TEXT_MAX = 100
+# Past this, answer the click now and say what happened once it has.
+SELECT_RESPOND_WITHIN = 2.0
+
 ROLE_NOTE = (
     "**Using role menus:**\n"
     "Please click/tap on the reactions above to pick the roles you'd like. "
@@ -23,6 +44,12 @@ ROLE_NOTE = (
     "updated."
     "You do not need to re-select roles to keep them."
 )
+SELECT_ROLE_NOTE = (
+    "**Using role menus:**\n"
+    "Please pick the roles you'd like from the lists above. "
+    "Whatever you pick replaces what you had from that list, "
+    "and only you will see the confirmation."
+)
 SINGLE_ROLE_MENU = (
     "**Note:** You can only pick a single option from this list. "
     "Choosing a new one will remove all the others from your profile."
@@ -31,6 +58,9 @@ SINGLE_ROLE_MENU = (
 plugin = lightbulb.Plugin("RoleMenus")
 plugin.add_checks(lightbulb.checks.human_only)
 
+# Folds each member's rapid clicks into a single role change.
+mutator = RoleMutator(apply=lambda pending: apply_pending_roles(pending))
+
 
 def load(bot):
     bot.add_plugin(plugin)
@@ -40,43 +70,78 @@ def unload(bot):
     bot.remove_plugin(plugin)
 
 
-async def configure_role_menus(
-    bot: DragonpawBot,
-    guild: hikari.Guild,
-    config: structs.RolesConfig,
-    state: structs.GuildState,
-    role_map: Mapping[str, hikari.Role],
-) -> List[str]:
-    """Setup the role channel for the guild.
+@dataclasses.dataclass
+class CompiledMenu:
+    """A role menu, ready to be sent."""
 
-    This wipes out all old role messages I sent, and sends new ones."""
+    embed: hikari.Embed
+    single: bool
+    # The role to add and the emoji for each option, in order.
+    options: list[tuple[hikari.Snowflake, Emoji]]
+    # A select menu, instead of reactions.
+    component: hikari.api.ComponentBuilder | None = None
+    digest: str = ""
 
-    errors: list[str] = []
+    def __post_init__(self):
+        # Anything that changes how the menu looks or works changes this.
+        content = [
+            self.embed.title,
+            self.embed.description,
+            int(self.embed.color or 0),
+            [(f.name, f.value) for f in self.embed.fields],
+            self.single,
+            [(int(role_id), str(e)) for role_id, e in self.options],
+        ]
+        if self.component:
+            content.append(repr(self.component.build()))
+        self.digest = hashlib.sha256(json.dumps(content).encode()).hexdigest()
 
-    channel = await utils.guild_channel_by_name(
-        bot=bot, guild=guild, name=config.channel
-    )
-    if not channel:
-        errors.append("Role channel '%s' doesn't seem to exist.")
-        return errors
+    @property
+    def is_select(self) -> bool:
+        return self.component is not None
 
-    state.role_channel_id = channel.id
-    state.role_emojis = {}
+    @property
+    def emojis(self) -> list[Emoji]:
+        # What to react with, and there's nothing to react with on a select.
+        return [] if self.is_select else [e for _, e in self.options]
 
-    if not config.menu:
-        errors.append("Role channel is set, but no role menus seem to exist.")
-        return errors
+    def option_states(
+        self, message_id: hikari.Snowflake
+    ) -> dict[tuple[hikari.Snowflake, str], structs.RoleMenuOptionState]:
+        role_ids = [role_id for role_id, _ in self.options]
+        return {
+            (message_id, e.name): structs.RoleMenuOptionState(
+                add_role_id=role_id,
+                remove_role_ids=[r for r in role_ids if r != role_id]
+                if self.single
+                else [],
+            )
+            for role_id, e in self.options
+        }
 
-    emoji_map = await utils.guild_emojis(bot=bot, guild=guild)
 
-    logger.debug("Trying to delete old role menus...")
-    await utils.delete_my_messages(
-        bot=bot, guild_name=guild.name, channel_id=channel.id
-    )
+def role_note(menus: Sequence[CompiledMenu]) -> str:
+    """The note after all the menus, which only mentions reactions if any of
+    them has some."""
+    return SELECT_ROLE_NOTE if all(menu.is_select for menu in menus) else ROLE_NOTE
+
+
+def note_digest(note: str) -> str:
+    return hashlib.sha256(note.encode()).hexdigest()
+
+
+def compile_role_menus(
+    config: structs.RolesConfig,
+    role_map: Mapping[str, hikari.PartialRole],
+    emoji_map: Mapping[str, Emoji],
+) -> tuple[list[CompiledMenu], list[str]]:
+    """Turn the menus in a config into what we'll send, without sending it."""
+
+    errors: list[str] = []
+    menus: list[CompiledMenu] = []
 
     colors = rainbow(len(config.menu))
     for x, menu in enumerate(config.menu):
-        logger.info("G=%r Adding the menu: %s", guild.name, menu.name)
         embed = hikari.Embed(color=hikari.Color.from_rgb(*colors[x]))
         if menu.single:
             embed.title = menu.name + " (Pick 1)"
@@ -88,6 +153,24 @@ async def configure_role_menus(
             embed.title = menu.name
             embed.description = menu.description
 
+        select = None
+        if menu.style == "select":
+            select = hikari.impl.MessageActionRowBuilder()
+            picker = select.add_text_menu(
+                ROLE_SELECT_ID,
+                placeholder="Pick one" if menu.single else "Pick your roles",
+                min_values=0,
+                max_values=1
+                if menu.single
+                else min(len(menu.options), SELECT_OPTIONS_MAX),
+            )
+            if len(menu.options) > SELECT_OPTIONS_MAX:
+                errors.append(
+                    f"Menu '{menu.name}' has {len(menu.options)} options, but a "
+                    f"select menu can only have {SELECT_OPTIONS_MAX}."
+                )
+
+        options: list[tuple[hikari.Snowflake, Emoji]] = []
         for o in menu.options:
             e = emoji_map.get(o.emoji)
             if not e:
@@ -96,49 +179,372 @@ async def configure_role_menus(
             if o.role not in role_map:
                 errors.append(f"Role '{o.role}' doesn't seem to exist.")
                 continue
+            if select and len(options) == SELECT_OPTIONS_MAX:
+                continue
+            if select and any(e.name == other.name for _, other in options):
+                errors.append(f"Emoji '{o.emoji}' is in menu '{menu.name}' twice.")
+                continue
             embed.add_field(
                 name=o.role,
                 value=f"{e.mention} {o.description}\n_ _\n",
                 inline=False,
             )
-        message = await channel.send(embed=embed)
+            options.append((role_map[o.role].id, e))
+            if select:
+                # The value is what the option is keyed by, like the emoji
+                # of a reaction is.
+                picker.add_option(
+                    o.role[:SELECT_TEXT_MAX],
+                    e.name,
+                    description=o.description[:SELECT_TEXT_MAX],
+                    emoji=e,
+                )
 
-        for o in menu.options:
-            key = (message.id, emoji_map[o.emoji].name)
-
-            if menu.single:
-                s = structs.RoleMenuOptionState(
-                    add_role_id=role_map[o.role].id,
-                    remove_role_ids=[
-                        role_map[option.role].id
-                        for option in menu.options
-                        if option != o
-                    ],
+        if select and not options:
+            select = None  # Discord won't take a select with no options.
+        menus.append(
+            CompiledMenu(
+                embed=embed, single=menu.single, options=options, component=select
+            )
+        )
+
+    return menus, errors
+
+
+async def configure_role_menus(
+    bot: DragonpawBot,
+    guild: hikari.Guild,
+    config: structs.RolesConfig,
+    state: structs.GuildState,
+    previous: structs.GuildState | None,
+    role_map: Mapping[str, hikari.Role],
+) -> List[str]:
+    """Setup the role channel for the guild.
+
+    If the menus from last time are still there, only the ones that changed
+    get edited, so members keep their reactions. Otherwise, all the old role
+    messages I sent get wiped out, and new ones sent."""
+
+    errors: list[str] = []
+
+    channel = await utils.guild_channel_by_name(
+        bot=bot, guild=guild, name=config.channel
+    )
+    if not channel:
+        errors.append(f"Role channel '{config.channel}' doesn't seem to exist.")
+        return errors
+
+    state.role_channel_id = channel.id
+    state.role_emojis = {}
+
+    if not config.menu:
+        errors.append("Role channel is set, but no role menus seem to exist.")
+        return errors
+
+    emoji_map = await utils.guild_emojis(bot=bot, guild=guild)
+    menus, errors = compile_role_menus(
+        config=config, role_map=role_map, emoji_map=emoji_map
+    )
+    note = role_note(menus)
+
+    if (
+        previous
+        and previous.role_channel_id == channel.id
+        and previous.role_menu_hashes
+    ):
+        try:
+            errors += await update_role_menus(
+                bot=bot,
+                guild=guild,
+                channel_id=channel.id,
+                menus=menus,
+                note=note,
+                state=state,
+                previous=previous,
+                emoji_map=emoji_map,
+            )
+            return errors
+        except hikari.NotFoundError as e:
+            # Someone deleted one of the menus, start over.
+            logger.warning("G=%r Role menu went missing: %r", guild.name, e)
+            state.role_emojis = {}
+            state.role_menu_hashes = {}
+            state.role_select_ids = []
+
+    logger.debug("Trying to delete old role menus...")
+    with utils.timed(guild.name, "Deleting old role menus"):
+        if previous and previous.role_channel_id and previous.role_message_ids:
+            await utils.delete_my_messages(
+                bot=bot,
+                guild=guild,
+                channel_id=previous.role_channel_id,
+                message_ids=previous.role_message_ids,
+            )
+        else:
+            await utils.delete_my_messages(bot=bot, guild=guild, channel_id=channel.id)
+
+    state.role_message_ids = []
+    errors += await send_role_menus(
+        bot=bot,
+        guild=guild,
+        channel_id=channel.id,
+        menus=menus,
+        note=note,
+        state=state,
+    )
+    return errors
+
+
+async def send_role_menus(
+    bot: DragonpawBot,
+    guild: hikari.Guild,
+    channel_id: hikari.Snowflake,
+    menus: Sequence[CompiledMenu],
+    note: str,
+    state: structs.GuildState,
+) -> List[str]:
+    """Send menus to the end of the role channel, followed by the note.
+
+    The note is picked from every menu in the channel, not just these."""
+
+    # Each menu's reactions start going on as soon as it's posted, while the
+    # next menu is being sent. The menus themselves go out one at a time, as
+    # they share a channel and we want them to show up in order.
+    limit = asyncio.Semaphore(REACTION_CONCURRENCY)
+    seeding: list[asyncio.Task] = []
+
+    with utils.timed(guild.name, "Sending role menus"):
+        for menu in menus:
+            logger.info("G=%r Adding the menu: %s", guild.name, menu.embed.title)
+            async with bot.outbound.bulk(guild.id):
+                message = await bot.rest.create_message(
+                    channel_id,
+                    embed=menu.embed,
+                    component=menu.component or hikari.UNDEFINED,
+                )
+            state.role_message_ids.append(message.id)
+            state.role_menu_hashes[message.id] = menu.digest
+            state.role_emojis.update(menu.option_states(message.id))
+            if menu.is_select:
+                state.role_select_ids.append(message.id)
+                continue
+
+            # Add the starting reactions
+            seeding.append(
+                asyncio.create_task(
+                    seed_reactions(
+                        bot=bot,
+                        guild_id=guild.id,
+                        channel_id=channel_id,
+                        message_id=message.id,
+                        emojis=menu.emojis,
+                        limit=limit,
+                    )
+                )
+            )
+
+        # The big note at the end.
+        async with bot.outbound.bulk(guild.id):
+            message = await bot.rest.create_message(channel_id, content=note)
+        state.role_message_ids.append(message.id)
+        state.role_note_hash = note_digest(note)
+
+    return await wait_for_reactions(guild=guild, seeding=seeding)
+
+
+async def update_role_menus(
+    bot: DragonpawBot,
+    guild: hikari.Guild,
+    channel_id: hikari.Snowflake,
+    menus: Sequence[CompiledMenu],
+    note: str,
+    state: structs.GuildState,
+    previous: structs.GuildState,
+    emoji_map: Mapping[str, Emoji],
+) -> List[str]:
+    """Bring the menus already in the channel in line with the new ones."""
+
+    old_ids = [m for m in previous.role_message_ids if m in previous.role_menu_hashes]
+    notes = [m for m in previous.role_message_ids if m not in previous.role_menu_hashes]
+    old_emojis: dict[int, list[str]] = {m: [] for m in old_ids}
+    old_selects = set(previous.role_select_ids)
+    for message_id, emoji in previous.role_emojis:
+        # The options of a select menu aren't reactions.
+        if message_id not in old_selects:
+            old_emojis.setdefault(message_id, []).append(emoji)
+
+    limit = asyncio.Semaphore(REACTION_CONCURRENCY)
+    seeding: list[asyncio.Task] = []
+    unchanged = 0
+
+    try:
+        with utils.timed(guild.name, "Updating role menus"):
+            edited: list[tuple[hikari.Snowflake, CompiledMenu]] = []
+            for message_id, menu in zip(old_ids, menus):
+                if previous.role_menu_hashes[message_id] == menu.digest:
+                    unchanged += 1
+                else:
+                    logger.info(
+                        "G=%r Editing the menu: %s", guild.name, menu.embed.title
+                    )
+                    async with bot.outbound.bulk(guild.id):
+                        await bot.rest.edit_message(
+                            channel_id,
+                            message_id,
+                            embed=menu.embed,
+                            component=menu.component,
+                        )
+                    edited.append((message_id, menu))
+
+                state.role_message_ids.append(message_id)
+                state.role_menu_hashes[message_id] = menu.digest
+                state.role_emojis.update(menu.option_states(message_id))
+                if menu.is_select:
+                    state.role_select_ids.append(message_id)
+
+            # Only touch the reactions that changed, so members keep theirs.
+            for message_id, menu in edited:
+                if menu.is_select and old_emojis[message_id]:
+                    # It was a reaction menu, so none of them mean anything now.
+                    async with bot.outbound.bulk(guild.id):
+                        await bot.rest.delete_all_reactions(channel_id, message_id)
+                    continue
+                new = {e.name for e in menu.emojis}
+                for name in old_emojis[message_id]:
+                    if name not in new and name in emoji_map:
+                        await clear_reaction(
+                            bot=bot,
+                            guild_id=guild.id,
+                            channel_id=channel_id,
+                            message_id=message_id,
+                            emoji=emoji_map[name],
+                        )
+                seeding.append(
+                    asyncio.create_task(
+                        seed_reactions(
+                            bot=bot,
+                            guild_id=guild.id,
+                            channel_id=channel_id,
+                            message_id=message_id,
+                            emojis=[
+                                e
+                                for e in menu.emojis
+                                if e.name not in old_emojis[message_id]
+                            ],
+                            limit=limit,
+                        )
+                    )
                 )
+
+            # Menus that aren't in the config any more.
+            gone = old_ids[len(menus) :]
+            # New menus have to go after the ones already there, so the note moves.
+            added = menus[len(old_ids) :]
+            if added:
+                gone += notes
             else:
-                s = structs.RoleMenuOptionState(
-                    add_role_id=role_map[o.role].id,
-                    remove_role_ids=[],
+                state.role_message_ids += notes
+                state.role_note_hash = note_digest(note)
+                if notes and previous.role_note_hash != state.role_note_hash:
+                    # Which note goes there depends on every menu, not just
+                    # the ones that changed.
+                    logger.info("G=%r Editing the role note", guild.name)
+                    async with bot.outbound.bulk(guild.id):
+                        await bot.rest.edit_message(channel_id, notes[-1], content=note)
+            if gone:
+                await utils.delete_my_messages(
+                    bot=bot, guild=guild, channel_id=channel_id, message_ids=gone
                 )
-            state.role_emojis[key] = s
+    except Exception:
+        # Whoever catches this may delete these messages, so leave nothing
+        # still adding reactions to them.
+        for task in seeding:
+            task.cancel()
+        await asyncio.gather(*seeding, return_exceptions=True)
+        raise
 
-        # Add the starting reactions
-        for o in menu.options:
-            e = emoji_map[o.emoji]
-            logger.debug("Adding: %s = %s", e, o.role)
-            await message.add_reaction(e)
+    logger.info(
+        "G=%r Role menus: %d unchanged, %d edited, %d removed, %d added",
+        guild.name,
+        unchanged,
+        len(edited),
+        max(len(old_ids) - len(menus), 0),
+        len(added),
+    )
 
-    # The big note at the end.
-    await channel.send(content=ROLE_NOTE)
+    errors = await wait_for_reactions(guild=guild, seeding=seeding)
+    if added:
+        errors += await send_role_menus(
+            bot=bot,
+            guild=guild,
+            channel_id=channel_id,
+            menus=added,
+            note=note,
+            state=state,
+        )
     return errors
 
 
+async def seed_reactions(
+    bot: DragonpawBot,
+    guild_id: hikari.Snowflake,
+    channel_id: hikari.Snowflake,
+    message_id: hikari.Snowflake,
+    emojis: Sequence[Emoji],
+    limit: asyncio.Semaphore,
+) -> None:
+    """Add the starting reactions to a menu, in order.
+
+    The semaphore is shared by all the menus being set up, so only a few
+    messages are having reactions added at once."""
+
+    async with limit:
+        for e in emojis:
+            logger.debug("Adding: %s to %r", e, message_id)
+            async with bot.outbound.bulk(guild_id):
+                await bot.rest.add_reaction(channel_id, message_id, e)
+
+
+async def clear_reaction(
+    bot: DragonpawBot,
+    guild_id: hikari.Snowflake,
+    channel_id: hikari.Snowflake,
+    message_id: hikari.Snowflake,
+    emoji: Emoji,
+) -> None:
+    """Take an option's reaction off a menu, everyone's if we're allowed."""
+
+    logger.debug("Removing: %s from %r", emoji, message_id)
+    async with bot.outbound.bulk(guild_id):
+        try:
+            await bot.rest.delete_all_reactions_for_emoji(channel_id, message_id, emoji)
+        except hikari.ForbiddenError:
+            await bot.rest.delete_my_reaction(channel_id, message_id, emoji)
+
+
+async def wait_for_reactions(
+    guild: hikari.Guild, seeding: Sequence[asyncio.Task]
+) -> List[str]:
+    with utils.timed(guild.name, "Waiting on reactions"):
+        results = await asyncio.gather(*seeding, return_exceptions=True)
+    return [
+        f"Unable to add a reaction to a role menu: {r}"
+        for r in results
+        if isinstance(r, Exception)
+    ]
+
+
 @plugin.listener(event=hikari.GuildReactionAddEvent)
+@metrics.timed_handler("on_reaction_add")
 async def on_reaction_add(event: hikari.GuildReactionAddEvent):
     """Process a possible role addition request."""
 
     assert isinstance(plugin.bot, DragonpawBot)
 
+    # Most reactions have nothing to do with us, get rid of them quickly.
+    if not plugin.bot.is_menu_reaction(event.guild_id, event.message_id):
+        return
+
     if not event.emoji_name:
         logger.error("Reaction without an emoji?!: %r", event)
         return
@@ -147,22 +553,13 @@ async def on_reaction_add(event: hikari.GuildReactionAddEvent):
     if event.user_id == plugin.bot.user_id:
         return
 
-    assert isinstance(plugin.bot, DragonpawBot)
-
-    c = plugin.bot.state(event.guild_id)
-    if not c:
+    routes = plugin.bot.routes(event.guild_id)
+    if not routes:
         logger.error("Called on an unknown guild: %r", event.guild_id)
         return
 
-    if isinstance(event.emoji_name, hikari.UnicodeEmoji):
-        key = (event.message_id, event.emoji_name.name)
-    elif isinstance(event.emoji_name, str):
-        key = (event.message_id, event.emoji_name)
-    else:
-        logger.error("No idea what this emoji is: %r", event.emoji_name)
-        return
-
-    if key not in c.role_emojis:
+    todo = routes.get(event.message_id, event.emoji_name)
+    if not todo:
         logger.debug(
             "Unknown emoji %r... Don't care that it is being added...", event.emoji_name
         )
@@ -175,108 +572,458 @@ async def on_reaction_add(event: hikari.GuildReactionAddEvent):
         #     emoji=event.emoji_name,
         # )
 
-    todo = c.role_emojis[key]
+    # Whoever clicks once is likely to click again.
+    plugin.bot.members.put(event.member)
+    plugin.bot.reconciler.reaction(
+        event.guild_id, event.message_id, event.emoji_name, event.user_id, added=True
+    )
     logger.info(
         "G=%r U=%r: Adding role: %s, removing roles: %r",
-        c.name,
+        routes.name,
         event.member.display_name,
-        c.role_names[todo.add_role_id],
-        [c.role_names[r] for r in todo.remove_role_ids] or None,
+        routes.role_name(todo.add_role_id),
+        [routes.role_name(r) for r in todo.remove_role_ids] or None,
     )
 
-    # Add the new role
-    try:
-        await event.member.add_role(
-            role=todo.add_role_id, reason="Member clicked on role menu"
+    mutator.submit(
+        routes=routes,
+        user_id=event.user_id,
+        add=(todo.add_role_id,),
+        remove=todo.remove_role_ids,
+        current=event.member.role_ids,
+        # What adding one role and removing each sibling would have cost.
+        naive_calls=1 + len(todo.remove_role_ids),
+    )
+
+
+async def apply_pending_roles(pending: PendingRoles) -> None:
+    """Apply everything a member clicked on during the debounce window."""
+
+    assert isinstance(plugin.bot, DragonpawBot)
+
+    current = pending.current
+    if current is None:
+        current = await member_roles(bot=plugin.bot, pending=pending)
+
+    await set_member_roles(
+        bot=plugin.bot,
+        routes=pending.routes,
+        user_id=hikari.Snowflake(pending.user_id),
+        current=current,
+        target=pending.target(current),
+        naive_calls=pending.naive_calls,
+        reason="Member clicked on role menu",
+    )
+
+
+async def member_roles(bot: DragonpawBot, pending: PendingRoles) -> Set[int]:
+    """Work out a member's roles when no event handed them to us."""
+
+    cached = bot.members.get(pending.routes.guild_id, pending.user_id)
+    if cached:
+        return set(cached.role_ids)
+
+    # A lone change goes through the per-role endpoints, which don't care
+    # what else the member has, so pretend they have exactly what we remove.
+    if len(pending.adds) + len(pending.removes) <= 1:
+        return set(pending.removes)
+
+    async with bot.outbound.interactive(pending.routes.guild_id):
+        member = await bot.rest.fetch_member(
+            guild=pending.routes.guild_id, user=pending.user_id
         )
+    return set(bot.members.put(member).role_ids)
+
+
+def member_role_calls(current: Set[int], target: Set[int]) -> int:
+    """How many REST calls set_member_roles makes: one per lone change,
+    two (fetch and edit) for anything bigger."""
+    changes = len(current ^ target)
+    return changes if changes <= 1 else 2
+
+
+async def set_member_roles(
+    bot: DragonpawBot,
+    routes: GuildRoutes,
+    user_id: hikari.Snowflake,
+    current: Set[int],
+    target: Set[int],
+    naive_calls: int,
+    reason: str,
+    interactive: bool = True,
+) -> bool:
+    """Move a member from their current roles to the target ones.
+
+    A single role change uses the add/remove endpoint, so it can't clobber
+    anything else going on with that member. Anything bigger is a member
+    edit, which replaces the whole list, so it's applied to their roles as
+    fetched right then, not to `current`: that could be from before our
+    last change, or a moderator's. Nothing changing means no call at all.
+    Returns False if Discord wouldn't let us."""
+
+    added = target - current
+    removed = current - target
+    calls = member_role_calls(current, target)
+
+    logger.debug(
+        "G=%r U=%r: %d REST call(s) instead of %d, saved %d",
+        routes.name,
+        user_id,
+        calls,
+        naive_calls,
+        naive_calls - calls,
+    )
+    if not calls:
+        return True
+
+    slot = bot.outbound.interactive if interactive else bot.outbound.bulk
+    try:
+        async with slot(routes.guild_id):
+            if len(added) + len(removed) > 1:
+                member = await bot.rest.fetch_member(
+                    guild=routes.guild_id, user=user_id
+                )
+                new_roles = (set(member.role_ids) - removed) | added
+                member = await bot.rest.edit_member(
+                    guild=routes.guild_id,
+                    user=user_id,
+                    roles=list(new_roles - {routes.guild_id}),
+                    reason=reason,
+                )
+                # So the next change for them starts from this one.
+                bot.members.put(member)
+            elif added:
+                await bot.rest.add_role_to_member(
+                    guild=routes.guild_id, user=user_id, role=added.pop(), reason=reason
+                )
+            else:
+                await bot.rest.remove_role_from_member(
+                    guild=routes.guild_id,
+                    user=user_id,
+                    role=removed.pop(),
+                    reason=reason,
+                )
     except hikari.ForbiddenError:
-        role = c.role_names[todo.add_role_id]
+        roles = ", ".join(
+            f"**{routes.role_name(r)}**" for r in sorted(target ^ current)
+        )
         await utils.report_errors(
-            bot=plugin.bot,
-            guild_id=event.guild_id,
+            bot=bot,
+            guild_id=hikari.Snowflake(routes.guild_id),
             error=(
-                f"Unable to add role: **{role}**, "
-                "please check my permissions relative to that role."
+                f"Unable to change roles: {roles}, "
+                "please check my permissions relative to those roles."
             ),
         )
-
-    # And maybe remove some old ones.
-    for r_id in todo.remove_role_ids:
-        try:
-            await event.member.remove_role(
-                role=r_id, reason="Member clicked on role menu"
-            )
-        except hikari.ForbiddenError:
-            role = c.role_names[r_id]
-            await utils.report_errors(
-                bot=plugin.bot,
-                guild_id=event.guild_id,
-                error=(
-                    f"Unable to remove role: **{role}**, "
-                    "please check my permissions relative to that role."
-                ),
-            )
+        return False
+    return True
 
 
 @plugin.listener(event=hikari.GuildReactionDeleteEvent)
+@metrics.timed_handler("on_reaction_remove")
 async def on_reaction_remove(event: hikari.GuildReactionDeleteEvent):
     """Process a possible request for role removal."""
 
     assert isinstance(plugin.bot, DragonpawBot)
 
-    if event.user_id == plugin.bot.user_id:
+    if not plugin.bot.is_menu_reaction(event.guild_id, event.message_id):
         return
 
-    c = plugin.bot.state(event.guild_id)
-    if not c:
-        logger.error("Called on an unknown guild: %r", event.guild_id)
+    if not event.emoji_name:
+        logger.error("Reaction without an emoji?!: %r", event)
         return
 
-    if isinstance(event.emoji_name, hikari.UnicodeEmoji):
-        key = (event.message_id, event.emoji_name.name)
-    elif isinstance(event.emoji_name, str):
-        key = (event.message_id, event.emoji_name)
-    else:
-        logger.error("No idea what this emoji is: %r", event.emoji_name)
+    if event.user_id == plugin.bot.user_id:
+        return
+
+    routes = plugin.bot.routes(event.guild_id)
+    if not routes:
+        logger.error("Called on an unknown guild: %r", event.guild_id)
         return
 
-    if key not in c.role_emojis:
+    todo = routes.get(event.message_id, event.emoji_name)
+    if not todo:
         logger.debug(
             "Unknown emoji %r... Don't care that it is gone...", event.emoji_name
         )
         return
 
     # Is this user in the cache?
-    cached = plugin.bot.cache.get_member(event.guild_id, event.user_id)
+    cached = plugin.bot.members.get(event.guild_id, event.user_id)
     # If so, this makes the logs nicer
     if cached:
         username = cached.display_name
     else:
         username = str(event.user_id)
 
-    todo = c.role_emojis[key]
     logger.info(
         "G=%r U=%r: Role removed: %s",
-        c.name,
+        routes.name,
         username,
-        c.role_names[todo.add_role_id],
+        routes.role_name(todo.add_role_id),
+    )
+
+    plugin.bot.reconciler.reaction(
+        event.guild_id, event.message_id, event.emoji_name, event.user_id, added=False
+    )
+    mutator.submit(routes=routes, user_id=event.user_id, remove=(todo.add_role_id,))
+
+
+@plugin.listener(event=hikari.InteractionCreateEvent)
+@metrics.timed_handler("on_role_select")
+async def on_role_select(event: hikari.InteractionCreateEvent):
+    """Someone picked from a select menu: set everything they picked at once."""
+
+    interaction = event.interaction
+    if (
+        not isinstance(interaction, hikari.ComponentInteraction)
+        or interaction.custom_id != ROLE_SELECT_ID
+        or not interaction.guild_id
+        or not interaction.member
+    ):
+        return
+
+    bot = plugin.bot
+    assert isinstance(bot, DragonpawBot)
+    routes = bot.routes(interaction.guild_id)
+    options = routes.selects.get(interaction.message.id) if routes else None
+    if not routes or not options:
+        await interaction.create_initial_response(
+            hikari.ResponseType.MESSAGE_CREATE,
+            "Sorry, this menu is out of date. Please ask an admin to /config again.",
+            flags=hikari.MessageFlag.EPHEMERAL,
+        )
+        return
+
+    current: set[int] = set(interaction.member.role_ids)
+    # Whatever they didn't pick from this menu goes, whatever they did stays.
+    target = (current - {a.add_role_id for a in options.values()}) | {
+        options[value].add_role_id for value in interaction.values if value in options
+    }
+    added = [routes.role_name(r) for r in target - current]
+    removed = [routes.role_name(r) for r in current - target]
+    logger.info(
+        "G=%r U=%r: Picked from a menu, adding: %r, removing: %r",
+        routes.name,
+        interaction.member.display_name,
+        added or None,
+        removed or None,
     )
 
+    change = asyncio.create_task(
+        set_member_roles(
+            bot=bot,
+            routes=routes,
+            user_id=interaction.member.id,
+            current=current,
+            target=target,
+            naive_calls=len(added) + len(removed),
+            reason="Member picked from role menu",
+        )
+    )
+    done, _ = await asyncio.wait({change}, timeout=SELECT_RESPOND_WITHIN)
+    if not done:
+        # Discord only waits 3s for an answer, so say we're on it.
+        await interaction.create_initial_response(
+            hikari.ResponseType.DEFERRED_MESSAGE_CREATE,
+            flags=hikari.MessageFlag.EPHEMERAL,
+        )
     try:
-        await plugin.bot.rest.remove_role_from_member(
-            guild=c.id,
-            user=event.user_id,
-            role=todo.add_role_id,
-            reason="Member un-clicked the role menu.",
+        allowed = await change
+    except hikari.HTTPError as e:
+        # Anything but a reply leaves them looking at "interaction failed".
+        logger.error(
+            "G=%r U=%r: Error changing roles from a menu: %r",
+            routes.name,
+            interaction.member.display_name,
+            e,
         )
-    except hikari.ForbiddenError:
-        logger.error("G=%r Unable to remove role, got Forbidden", c.name)
-        role = c.role_names[todo.add_role_id]
-        await utils.report_errors(
-            bot=plugin.bot,
-            guild_id=event.guild_id,
-            error=(
-                f"Unable to remove role: **{role}**, "
-                "please check my permissions relative to that role."
-            ),
+        content = "Sorry, something went wrong changing your roles. Please try again."
+    else:
+        content = select_reply(allowed=allowed, added=added, removed=removed)
+    if done:
+        await interaction.create_initial_response(
+            hikari.ResponseType.MESSAGE_CREATE,
+            content,
+            flags=hikari.MessageFlag.EPHEMERAL,
+        )
+    else:
+        await interaction.edit_initial_response(content)
+
+
+def select_reply(allowed: bool, added: Sequence[str], removed: Sequence[str]) -> str:
+    if not allowed:
+        return "Sorry, I'm not allowed to change those roles. I've told the admins."
+    if not added and not removed:
+        return "No change, you already had exactly those."
+    return "\n".join(
+        f"{label}: " + ", ".join(f"**{r}**" for r in roles)
+        for label, roles in (("Added", added), ("Removed", removed))
+        if roles
+    )
+
+
+# ---------------------------------------------------------------------------- #
+#                   Catching up on reactions missed while away                 #
+# ---------------------------------------------------------------------------- #
+
+
+@plugin.listener(event=hikari.GuildAvailableEvent)
+async def on_guild_available(event: hikari.GuildAvailableEvent):
+    bot = plugin.bot
+    assert isinstance(bot, DragonpawBot)
+    state = bot.state(event.guild_id)
+    routes = bot.routes(event.guild_id)
+    if not state or not routes or not routes.actions or not state.role_channel_id:
+        return
+    bot.reconciler.submit(
+        state.id,
+        state.name,
+        run=lambda checkpoint, stats: reconcile_guild(bot, checkpoint, stats),
+    )
+
+
+async def reconcile_guild(
+    bot: DragonpawBot, checkpoint: Checkpoint, stats: ReconcileStats
+) -> None:
+    """Catch up on the reactions to a guild's menus that we missed.
+
+    Pages through who reacted to each option, then only touches members
+    whose roles don't match: a reaction without its role gets the role,
+    and a role whose reaction went away since the last pass is taken off.
+    Someone with a role they never reacted for got it some other way, so
+    it's left alone."""
+
+    guild_id = checkpoint.guild_id
+    state = bot.state(guild_id)
+    routes = bot.routes(guild_id)
+    if not state or not routes or not state.role_channel_id:
+        return
+    assert checkpoint.fetched is not None
+    fetched = checkpoint.fetched
+
+    menus: dict[int, list[tuple[str, RoleAction]]] = {}
+    for (message_id, emoji), action in routes.actions.items():
+        key = option_key(message_id, emoji)
+        menus.setdefault(message_id, []).append((key, action))
+        stats.options += 1
+        if key in fetched:
+            continue  # Done before we were interrupted.
+
+        custom = bot.custom_emojis.get(guild_id, {})
+        users: set[int] = set()
+        try:
+            async with bot.outbound.bulk(guild_id):
+                async for user in bot.rest.fetch_reactions_for_emoji(
+                    state.role_channel_id, message_id, custom.get(emoji, emoji)
+                ):
+                    users.add(int(user.id))
+        except hikari.NotFoundError:
+            logger.warning("G=%r Role menu %r is gone", routes.name, message_id)
+            continue
+        finally:
+            stats.rest_calls += len(users) // REACTIONS_PAGE + 1
+        users.discard(int(bot.user_id or 0))
+        fetched[key] = users
+        bot.reconciler.save(checkpoint)
+
+    # Everyone who reacted, and everyone who took a reaction off.
+    users = set().union(*fetched.values())
+    stats.reactors = len(users)
+    for key, reactors in fetched.items():
+        users |= checkpoint.known.get(key, set()) - reactors
+    roles = await reconcile_member_roles(bot, guild_id, users, stats)
+
+    for user_id, current in roles.items():
+        adds: set[int] = set()
+        removes: set[int] = set()
+        for options in menus.values():
+            picked = [a for key, a in options if user_id in fetched.get(key, ())]
+            for key, option in options:
+                if (
+                    key in fetched
+                    and user_id not in fetched[key]
+                    and user_id in checkpoint.known.get(key, ())
+                    and option.add_role_id in current
+                ):
+                    removes.add(option.add_role_id)
+            if len(picked) > 1 and any(a.remove_role_ids for a in picked):
+                # More than one pick on a pick-1 menu, no telling which was last.
+                continue
+            for pick in picked:
+                if pick.add_role_id not in current:
+                    adds.add(pick.add_role_id)
+                    removes |= set(pick.remove_role_ids) & current
+        removes -= adds
+
+        target = (current - removes) | adds
+        if target == current:
+            continue
+        logger.info(
+            "G=%r U=%r: Missed reactions, adding: %r, removing: %r",
+            routes.name,
+            user_id,
+            [routes.role_name(r) for r in target - current] or None,
+            [routes.role_name(r) for r in current - target] or None,
+        )
+        stats.added += len(target - current)
+        stats.removed += len(current - target)
+        stats.rest_calls += member_role_calls(current, target)
+        await set_member_roles(
+            bot=bot,
+            routes=routes,
+            user_id=hikari.Snowflake(user_id),
+            current=current,
+            target=target,
+            naive_calls=len(target ^ current),
+            reason="Catching up on role menu reactions",
+            interactive=False,
         )
+
+
+async def reconcile_member_roles(
+    bot: DragonpawBot,
+    guild_id: hikari.Snowflake,
+    users: Set[int],
+    stats: ReconcileStats,
+) -> dict[int, set[int]]:
+    """The roles of each of these members, the cheapest way we can get them."""
+
+    roles: dict[int, set[int]] = {}
+    missing: set[int] = set()
+    for user_id in users:
+        cached = bot.members.get(guild_id, user_id)
+        if cached:
+            roles[user_id] = set(cached.role_ids)
+        else:
+            missing.add(user_id)
+
+    guild = bot.cache.get_guild(guild_id)
+    member_count = getattr(guild, "member_count", None)
+    if member_count and member_count // MEMBERS_PAGE + 1 < len(missing):
+        # Fewer calls to list everyone than to fetch who we need one by one.
+        seen = 0
+        try:
+            async with bot.outbound.bulk(guild_id):
+                async for member in bot.rest.fetch_members(guild_id):
+                    seen += 1
+                    if member.id in missing:
+                        roles[member.id] = set(member.role_ids)
+        finally:
+            stats.rest_calls += seen // MEMBERS_PAGE + 1
+        return roles
+
+    for user_id in missing:
+        stats.rest_calls += 1
+        try:
+            async with bot.outbound.bulk(guild_id):
+                member = await bot.rest.fetch_member(guild_id, user_id)
+        except hikari.NotFoundError:
+            continue  # They left.
+        roles[user_id] = set(member.role_ids)
+    return roles
+
+
+@plugin.listener(event=hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent):
+    await mutator.flush()
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import logging
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import hikari
+import pydantic
+import safer
+
+from dragonpaw_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# How many guilds can be reconciled at once.
+RECONCILE_WORKERS = 2
+# Changed checkpoints are written together, at most this often, in seconds.
+CHECKPOINT_INTERVAL = 1.0
+
+RECONCILE_SECONDS = metrics.Histogram(
+    "dragonpaw_reconcile_seconds",
+    "How long catching up on missed role menu reactions took, per guild.",
+)
+RECONCILE_REST_CALLS = metrics.Counter(
+    "dragonpaw_reconcile_rest_calls_total",
+    "REST calls made catching up on missed role menu reactions.",
+)
+RECONCILE_CHANGES = metrics.Counter(
+    "dragonpaw_reconcile_changes_total",
+    "Roles added or removed catching up on missed role menu reactions.",
+    ("change",),
+)
+
+# ---------------------------------------------------------------------------- #
+#                  Catching up on reactions missed while offline               #
+# ---------------------------------------------------------------------------- #
+
+
+def option_key(message_id: int, emoji: str) -> str:
+    return f"{message_id}:{emoji}"
+
+
+class Checkpoint(pydantic.BaseModel):
+    """Who reacted to which menu option in a guild, saved between passes."""
+
+    guild_id: hikari.Snowflake
+    # Option -> who had reacted to it at the end of the last pass, kept up
+    # to date by reaction events since. Tells a missed un-react apart from
+    # someone who got the role some other way.
+    known: dict[str, set[int]] = {}
+    # The pass that's running, or was interrupted: what's been fetched so far.
+    fetched: dict[str, set[int]] | None = None
+
+
+@dataclasses.dataclass
+class ReconcileStats:
+    options: int = 0
+    reactors: int = 0
+    rest_calls: int = 0
+    added: int = 0
+    removed: int = 0
+    resumed: bool = False
+
+
+RunFunc = Callable[[Checkpoint, ReconcileStats], Awaitable[None]]
+
+
+class Reconciler:
+    """Runs a reconciliation pass per guild, a few guilds at a time.
+
+    Each guild's checkpoint is saved after every menu option it fetches,
+    so a pass cut short by a restart picks up where it stopped. Reaction
+    events go into the checkpoint as they happen, so the pass never undoes
+    a click it didn't see coming. Saving only marks it changed: they're
+    written from a thread every CHECKPOINT_INTERVAL, and on stop."""
+
+    def __init__(
+        self, checkpoint_dir: Path | None = None, workers: int = RECONCILE_WORKERS
+    ):
+        self.checkpoint_dir = checkpoint_dir
+        self._checkpoints: dict[int, Checkpoint] = {}
+        self._dirty: set[int] = set()
+        self._writer: asyncio.Task | None = None
+        self._writing = asyncio.Lock()
+        self._limit = asyncio.Semaphore(workers)
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    # ----------------------------- Checkpoints ------------------------------ #
+
+    def _path(self, guild_id: int) -> Path | None:
+        if not self.checkpoint_dir:
+            return None
+        return self.checkpoint_dir / f"{guild_id}.json"
+
+    def checkpoint(self, guild_id: int) -> Checkpoint:
+        if guild_id in self._checkpoints:
+            return self._checkpoints[guild_id]
+        checkpoint = None
+        filename = self._path(guild_id)
+        if filename and filename.exists():
+            try:
+                checkpoint = Checkpoint.parse_file(filename)
+            except Exception as e:
+                logger.warning("Ignoring broken checkpoint %s: %r", filename, e)
+        if checkpoint is None:
+            checkpoint = Checkpoint(guild_id=hikari.Snowflake(guild_id))
+        self._checkpoints[guild_id] = checkpoint
+        return checkpoint
+
+    def _take_dirty(self) -> list[tuple[Path, str]]:
+        # Turned into JSON here on the loop: the sets keep changing.
+        files = []
+        for guild_id in self._dirty:
+            filename = self._path(guild_id)
+            if filename:
+                files.append((filename, self._checkpoints[guild_id].json()))
+        self._dirty.clear()
+        return files
+
+    @staticmethod
+    def _write(files: list[tuple[Path, str]]) -> None:
+        for filename, text in files:
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            with safer.open(filename, "w") as f:
+                f.write(text)
+
+    async def write(self) -> None:
+        """Write every changed checkpoint, from a thread."""
+        files = self._take_dirty()
+        # One at a time, so an older write never lands on a newer one.
+        async with self._writing:
+            await asyncio.to_thread(self._write, files)
+
+    async def _write_soon(self) -> None:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        self._writer = None
+        await self.write()
+
+    def save(self, checkpoint: Checkpoint) -> None:
+        self._dirty.add(checkpoint.guild_id)
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_soon())
+
+    def flush(self) -> None:
+        """Write every changed checkpoint now, blocking."""
+        self._write(self._take_dirty())
+
+    def reaction(
+        self, guild_id: int, message_id: int, emoji: str, user_id: int, added: bool
+    ) -> None:
+        """Note a reaction we did see, if the guild has been reconciled."""
+        checkpoint = self._checkpoints.get(guild_id)
+        if not checkpoint:
+            return
+        key = option_key(message_id, emoji)
+        seen = [checkpoint.known.setdefault(key, set())]
+        if checkpoint.fetched is not None and key in checkpoint.fetched:
+            seen.append(checkpoint.fetched[key])
+        for users in seen:
+            if added:
+                users.add(user_id)
+            else:
+                users.discard(user_id)
+        self.save(checkpoint)
+
+    # -------------------------------- Passes -------------------------------- #
+
+    def submit(self, guild_id: int, name: str, run: RunFunc) -> None:
+        if guild_id in self._tasks:
+            return  # Already on it.
+        self._tasks[guild_id] = asyncio.create_task(self._pass(guild_id, name, run))
+
+    async def _pass(self, guild_id: int, name: str, run: RunFunc) -> None:
+        try:
+            async with self._limit:
+                checkpoint = self.checkpoint(guild_id)
+                stats = ReconcileStats(resumed=checkpoint.fetched is not None)
+                if checkpoint.fetched is None:
+                    checkpoint.fetched = {}
+                start = time.perf_counter()
+                try:
+                    await run(checkpoint, stats)
+                except Exception as e:
+                    logger.exception("G=%r Error reconciling reactions: %r", name, e)
+                    return
+                finally:
+                    RECONCILE_REST_CALLS.inc(amount=stats.rest_calls)
+                elapsed = time.perf_counter() - start
+
+                checkpoint.known = checkpoint.fetched
+                checkpoint.fetched = None
+                self._dirty.add(guild_id)
+                await self.write()
+            RECONCILE_SECONDS.observe(elapsed)
+            RECONCILE_CHANGES.inc("added", amount=stats.added)
+            RECONCILE_CHANGES.inc("removed", amount=stats.removed)
+            logger.info(
+                "G=%r Reconciled %d menu option(s), %d reactor(s)%s: "
+                "%d role(s) added, %d removed, %d REST call(s) in %.2fs",
+                name,
+                stats.options,
+                stats.reactors,
+                " (resumed)" if stats.resumed else "",
+                stats.added,
+                stats.removed,
+                stats.rest_calls,
+                elapsed,
+            )
+        finally:
+            del self._tasks[guild_id]
+
+    def stop(self) -> None:
+        """Stop every pass where it is. They resume from their checkpoints."""
+        for task in self._tasks.values():
+            task.cancel()
+        if self._writer:
+            self._writer.cancel()
+            self._writer = None
+        self.flush()
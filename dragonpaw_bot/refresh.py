@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import heapq
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
+from dragonpaw_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# Each check is this much either side of the interval, so guilds configured
+# at the same moment drift apart instead of all being checked together.
+REFRESH_JITTER = 0.1
+# How many configs can be fetched at once, and how many guilds set up again.
+POLL_WORKERS = 8
+RECONFIGURE_WORKERS = 2
+# However often a config has failed, it's still tried at least this often.
+MAX_BACKOFF = 24 * 60 * 60.0
+# Never sleep longer than this, in case the clock jumps.
+MAX_SLEEP = 600.0
+
+CONFIG_REFRESHES = metrics.Counter(
+    "dragonpaw_config_refreshes_total",
+    "Background config checks, by result.",
+    ("result",),
+)
+
+# ---------------------------------------------------------------------------- #
+#                         Checking configs for changes                         #
+# ---------------------------------------------------------------------------- #
+
+# The config's current text, or None if the guild isn't configured any more.
+PollFunc = Callable[[int], Awaitable[str | None]]
+ApplyFunc = Callable[[int, str], Awaitable[None]]
+
+
+def config_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ConfigRefresher:
+    """A min-heap of (when, guild), and a task that checks each guild's config.
+
+    `poll` fetches the config, which is a conditional GET thanks to the
+    HttpClient cache, so a config that hasn't changed is a 304. Only when
+    the text hashes differently from what the guild was last set up with
+    does it go to `apply`, and only RECONFIGURE_WORKERS of those run at
+    once. A guild with no hash yet only has its first one noted. A guild whose config fails to fetch is checked half as often
+    each time, up to MAX_BACKOFF. A config that was applied and failed
+    isn't applied again until it changes."""
+
+    def __init__(
+        self,
+        poll: PollFunc,
+        apply: ApplyFunc,
+        interval: float,
+        jitter: float = REFRESH_JITTER,
+        pollers: int = POLL_WORKERS,
+        reconfigures: int = RECONFIGURE_WORKERS,
+    ):
+        self.poll = poll
+        self.apply = apply
+        self.interval = interval
+        self.jitter = jitter
+        self._heap: list[tuple[float, int]] = []
+        # Guild -> when it's next due. Anything in the heap that doesn't
+        # match is stale, and gets skipped.
+        self._due: dict[int, float] = {}
+        # Guild -> the hash of the config it was last set up with.
+        self._hashes: dict[int, str | None] = {}
+        self._failures: dict[int, int] = {}
+        self._polls = asyncio.Semaphore(pollers)
+        self._reconfigures = asyncio.Semaphore(reconfigures)
+        self._checks: set[asyncio.Task] = set()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def _schedule(self, guild_id: int, delay: float) -> None:
+        when = time.time() + delay
+        self._due[guild_id] = when
+        heapq.heappush(self._heap, (when, guild_id))
+        if self._heap[0][0] == when:
+            self._wake.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _next_delay(self, guild_id: int) -> float:
+        failures = self._failures.get(guild_id, 0)
+        delay = min(self.interval * 2**failures, max(MAX_BACKOFF, self.interval))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def track(
+        self, guild_id: int, config_hash: str | None, delay: float | None = None
+    ) -> None:
+        """Start checking a guild's config, or note that it was just set up.
+
+        With no delay, a new guild is first checked at a random point in
+        the next interval, so a restart doesn't check everyone at once."""
+        self._hashes[guild_id] = config_hash
+        if delay is not None:
+            self._failures.pop(guild_id, None)
+            self._schedule(guild_id, delay)
+        elif guild_id not in self._due:
+            self._schedule(guild_id, random.uniform(0, self.interval))
+
+    def forget(self, guild_id: int) -> None:
+        self._due.pop(guild_id, None)
+        self._hashes.pop(guild_id, None)
+        self._failures.pop(guild_id, None)
+
+    async def _check(self, guild_id: int) -> None:
+        try:
+            text = await self.poll(guild_id)
+        except Exception as e:
+            failures = self._failures.get(guild_id, 0) + 1
+            self._failures[guild_id] = failures
+            logger.warning(
+                "G=%r Error fetching config (%d in a row): %r", guild_id, failures, e
+            )
+            CONFIG_REFRESHES.inc("error")
+            self._schedule(guild_id, self._next_delay(guild_id))
+            return
+        finally:
+            self._polls.release()
+        self._failures.pop(guild_id, None)
+
+        if text is None:
+            logger.debug("G=%r Not configured any more, no more refreshes", guild_id)
+            self.forget(guild_id)
+            return
+
+        new_hash = config_hash(text)
+        old_hash = self._hashes.get(guild_id)
+        if old_hash is None:
+            # Set up before we kept hashes, so we can't tell if it changed.
+            # Setting it up again would resend every role menu, so take
+            # what's there now as what it was set up with.
+            logger.debug("G=%r No config hash, starting from this one", guild_id)
+            CONFIG_REFRESHES.inc("baseline")
+            self._hashes[guild_id] = new_hash
+            self._schedule(guild_id, self._next_delay(guild_id))
+            return
+        if new_hash == old_hash:
+            CONFIG_REFRESHES.inc("unchanged")
+            self._schedule(guild_id, self._next_delay(guild_id))
+            return
+
+        logger.info("G=%r Config has changed, setting it up again", guild_id)
+        CONFIG_REFRESHES.inc("changed")
+        # Whatever happens, don't try this same text again.
+        self._hashes[guild_id] = new_hash
+        async with self._reconfigures:
+            try:
+                await self.apply(guild_id, text)
+            except Exception as e:
+                logger.exception("G=%r Error applying changed config: %r", guild_id, e)
+        if guild_id in self._hashes:
+            self._schedule(guild_id, self._next_delay(guild_id))
+
+    async def _sleep(self, delay: float) -> None:
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=min(delay, MAX_SLEEP))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                await self._sleep(MAX_SLEEP)
+                continue
+            when, guild_id = self._heap[0]
+            delay = when - time.time()
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            heapq.heappop(self._heap)
+            if self._due.get(guild_id) != when:
+                continue  # Forgotten, or moved.
+            del self._due[guild_id]
+            # Wait for a free slot here, so there's never a pile of checks.
+            await self._polls.acquire()
+            task = asyncio.create_task(self._check(guild_id))
+            self._checks.add(task)
+            task.add_done_callback(self._checks.discard)
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for task in self._checks:
+            task.cancel()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import array
+import logging
+from typing import Iterable, Mapping
+
+import hikari
+
+from dragonpaw_bot import structs
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+#               Reaction routing: what a click on a role menu does             #
+# ---------------------------------------------------------------------------- #
+# Reactions are the busiest events we get, so the handlers work off these plain
+# objects instead of the pydantic state. They're rebuilt whenever a guild's
+# state is loaded or replaced, and never saved anywhere.
+
+
+class RoleAction:
+    """The role to add for a reaction, and the ones it replaces."""
+
+    __slots__ = ("add_role_id", "remove_role_ids")
+
+    def __init__(self, add_role_id: int, remove_role_ids: Iterable[int] = ()):
+        self.add_role_id = add_role_id
+        self.remove_role_ids = array.array("Q", remove_role_ids)
+
+    def __repr__(self) -> str:
+        return f"RoleAction({self.add_role_id}, {list(self.remove_role_ids)})"
+
+
+class GuildRoutes:
+    """Every role menu reaction in one guild, keyed by (message_id, emoji).
+
+    Select menus are kept apart, by message and then by option value, so
+    a reaction on one of them is never taken for a click."""
+
+    __slots__ = ("guild_id", "name", "role_names", "actions", "message_ids", "selects")
+
+    def __init__(
+        self,
+        guild_id: int,
+        name: str,
+        role_names: Mapping[int, str],
+        actions: dict[tuple[int, str], RoleAction],
+        selects: dict[int, dict[str, RoleAction]] | None = None,
+    ):
+        self.guild_id = guild_id
+        self.name = name
+        self.role_names = role_names
+        self.actions = actions
+        self.message_ids = frozenset(message_id for message_id, _ in actions)
+        self.selects = selects or {}
+
+    @classmethod
+    def from_state(cls, state: structs.GuildState) -> GuildRoutes:
+        select_ids = set(state.role_select_ids)
+        actions: dict[tuple[int, str], RoleAction] = {}
+        selects: dict[int, dict[str, RoleAction]] = {}
+        for (message_id, emoji), option in state.role_emojis.items():
+            action = RoleAction(
+                add_role_id=option.add_role_id,
+                remove_role_ids=option.remove_role_ids,
+            )
+            if message_id in select_ids:
+                selects.setdefault(message_id, {})[emoji] = action
+            else:
+                actions[(message_id, emoji)] = action
+        logger.debug(
+            "G=%r Built %d reaction routes, %d select menus",
+            state.name,
+            len(actions),
+            len(selects),
+        )
+        return cls(
+            guild_id=state.id,
+            name=state.name,
+            role_names={int(k): v for k, v in state.role_names.items()},
+            actions=actions,
+            selects=selects,
+        )
+
+    def get(
+        self,
+        message_id: int,
+        emoji: hikari.UnicodeEmoji | str | None,
+    ) -> RoleAction | None:
+        # UnicodeEmoji is a str, and custom emojis are keyed by their name.
+        if not isinstance(emoji, str):
+            return None
+        return self.actions.get((message_id, emoji))
+
+    def role_name(self, role_id: int) -> str:
+        return self.role_names.get(role_id, str(role_id))
@@ -0,0 +1,584 @@
+from __future__ import annotations
+
+import abc
+import concurrent.futures
+import contextlib
+import datetime
+import gc
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Iterator, Sequence
+
+import hikari
+import safer
+
+from dragonpaw_bot import structs
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+#                        State stores: where GuildStates live                  #
+# ---------------------------------------------------------------------------- #
+
+
+class StateStore(abc.ABC):
+    """Somewhere to keep the state of every guild between restarts."""
+
+    @abc.abstractmethod
+    def load(self, guild_id: hikari.Snowflake) -> structs.GuildState | None:
+        ...
+
+    @abc.abstractmethod
+    def load_all(self) -> list[structs.GuildState]:
+        ...
+
+    @abc.abstractmethod
+    def save(self, state: structs.GuildState) -> None:
+        ...
+
+    @abc.abstractmethod
+    def guild_ids(self) -> list[hikari.Snowflake]:
+        ...
+
+    def load_many(
+        self, guild_ids: Sequence[hikari.Snowflake], workers: int = 8
+    ) -> list[structs.GuildState]:
+        """Load a batch of guilds, in a thread pool."""
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="state-load"
+        ) as pool:
+            states = pool.map(self.load, guild_ids)
+        return [s for s in states if s]
+
+    def close(self) -> None:
+        pass
+
+
+def open_store(
+    state_dir: Path, backend: str = "sqlite", url: str | None = None
+) -> StateStore:
+    if backend == "remote":
+        if not url:
+            raise ValueError("The remote state backend needs a STATE_URL")
+        return RemoteStore(url)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    if backend == "pickle":
+        return PickleStore(state_dir)
+    if backend == "sqlite":
+        return SqliteStore(state_dir / "state.sqlite3", migrate_from=state_dir)
+    raise ValueError(f"Unknown state backend: {backend!r}")
+
+
+# ---------------------------------------------------------------------------- #
+#                         Pickle: One file per guild                           #
+# ---------------------------------------------------------------------------- #
+
+
+class PickleStore(StateStore):
+    def __init__(self, state_dir: Path):
+        self.state_dir = state_dir
+
+    def path(self, guild_id: hikari.Snowflake) -> Path:
+        return Path(self.state_dir, str(guild_id) + ".pickle")
+
+    def save(self, state: structs.GuildState) -> None:
+        filename = self.path(state.id)
+        logger.info("G=%r Saving state to: %s", state.name, filename)
+        with safer.open(filename, "wb") as f:
+            pickle.dump(obj=state.dict(), file=f)
+
+    def load(self, guild_id: hikari.Snowflake) -> structs.GuildState | None:
+        return self._load_file(self.path(guild_id))
+
+    def load_all(self) -> list[structs.GuildState]:
+        states = [self._load_file(f) for f in self.files()]
+        return [s for s in states if s]
+
+    def files(self) -> list[Path]:
+        return sorted(self.state_dir.glob("*.pickle"))
+
+    def guild_ids(self) -> list[hikari.Snowflake]:
+        return [hikari.Snowflake(f.stem) for f in self.files() if f.stem.isdigit()]
+
+    def _load_file(self, filename: Path) -> structs.GuildState | None:
+        if not filename.exists():
+            logger.debug("No state file: %s", filename)
+            return None
+
+        logger.debug("Loading state from: %s", filename)
+        try:
+            with safer.open(filename, "rb") as f:
+                return structs.GuildState.parse_obj(pickle.load(f))
+        except Exception as e:
+            logger.exception("Error loading file: %r", e)
+            return None
+
+
+# ---------------------------------------------------------------------------- #
+#                        SQLite: All guilds, one database                      #
+# ---------------------------------------------------------------------------- #
+
+# Each entry moves the schema on by one version, never edit an old one.
+MIGRATIONS = [
+    """
+    CREATE TABLE guilds (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        config_url TEXT NOT NULL,
+        config_last TEXT NOT NULL,
+        lobby_role_id INTEGER,
+        lobby_welcome_message TEXT,
+        lobby_channel_id INTEGER,
+        lobby_click_for_rules INTEGER NOT NULL DEFAULT 0,
+        lobby_kick_days INTEGER NOT NULL DEFAULT 0,
+        lobby_rules TEXT NOT NULL DEFAULT '',
+        lobby_rules_message_id INTEGER,
+        role_channel_id INTEGER,
+        log_channel_id INTEGER
+    );
+    CREATE TABLE role_names (
+        guild_id INTEGER NOT NULL,
+        role_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        PRIMARY KEY (guild_id, role_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE role_options (
+        guild_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        emoji TEXT NOT NULL,
+        add_role_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, message_id, emoji)
+    ) WITHOUT ROWID;
+    CREATE TABLE role_option_removes (
+        guild_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        emoji TEXT NOT NULL,
+        role_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, message_id, emoji, role_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE tracked_messages (
+        guild_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, position)
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE guilds ADD COLUMN config_hash TEXT;
+    CREATE TABLE role_menus (
+        guild_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (guild_id, message_id)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE lobby_kicks (
+        guild_id INTEGER NOT NULL,
+        member_id INTEGER NOT NULL,
+        deadline TEXT NOT NULL,
+        PRIMARY KEY (guild_id, member_id)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE role_selects (
+        guild_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, message_id)
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE role_options ADD COLUMN position INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE role_option_removes ADD COLUMN position INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE guilds ADD COLUMN role_note_hash TEXT;
+    """,
+]
+
+GUILD_COLUMNS = (
+    "id",
+    "name",
+    "config_url",
+    "config_last",
+    "config_hash",
+    "lobby_role_id",
+    "lobby_welcome_message",
+    "lobby_channel_id",
+    "lobby_click_for_rules",
+    "lobby_kick_days",
+    "lobby_rules",
+    "lobby_rules_message_id",
+    "role_channel_id",
+    "role_note_hash",
+    "log_channel_id",
+)
+SNOWFLAKE_COLUMNS = {
+    "id",
+    "lobby_role_id",
+    "lobby_channel_id",
+    "lobby_rules_message_id",
+    "role_channel_id",
+    "log_channel_id",
+}
+
+# Table name -> (columns, how many of them make up the primary key)
+CHILD_TABLES = {
+    "role_names": (("guild_id", "role_id", "name"), 2),
+    "role_options": (
+        ("guild_id", "message_id", "emoji", "add_role_id", "position"),
+        3,
+    ),
+    "role_option_removes": (
+        ("guild_id", "message_id", "emoji", "role_id", "position"),
+        4,
+    ),
+    "tracked_messages": (("guild_id", "position", "message_id"), 2),
+    "role_menus": (("guild_id", "message_id", "digest"), 2),
+    "lobby_kicks": (("guild_id", "member_id", "deadline"), 2),
+    "role_selects": (("guild_id", "message_id"), 2),
+}
+
+Rows = dict[str, frozenset[tuple]]
+
+# SQLite only allows so many parameters in one query.
+LOAD_BATCH_SIZE = 500
+
+
+class SqliteStore(StateStore):
+    """Every guild in one SQLite database, in WAL mode.
+
+    The rows last written for each guild are remembered, so saving a guild
+    only touches the rows that actually changed."""
+
+    def __init__(self, filename: Path, migrate_from: Path | None = None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._saved: dict[int, Rows] = {}
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+        if migrate_from:
+            self._import_pickles(migrate_from)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _migrate(self) -> None:
+        (version,) = self._db.execute("PRAGMA user_version").fetchone()
+        for n, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("Migrating %s to schema version %d", self.filename, n)
+            with self._db:
+                self._db.executescript(script)
+                self._db.execute(f"PRAGMA user_version = {n}")
+
+    def _import_pickles(self, state_dir: Path) -> None:
+        """One-time import of the state files from before we used SQLite."""
+        pickles = PickleStore(state_dir)
+        for filename in pickles.files():
+            state = pickles._load_file(filename)
+            if not state:
+                continue
+            logger.info("G=%r Importing state from: %s", state.name, filename)
+            self.save(state)
+            filename.rename(filename.with_suffix(".pickle.migrated"))
+
+    # ------------------------------- Saving --------------------------------- #
+
+    def save(self, state: structs.GuildState) -> None:
+        rows = state_rows(state)
+        with self._lock, self._db:
+            saved = self._saved.get(state.id)
+            if saved is None:
+                # Never seen it, so we can't trust what's there to diff against.
+                self._db.execute("DELETE FROM guilds WHERE id = ?", (state.id,))
+                for table in CHILD_TABLES:
+                    self._db.execute(
+                        f"DELETE FROM {table} WHERE guild_id = ?", (state.id,)
+                    )
+                saved = {table: frozenset() for table in rows}
+
+            for table, new in rows.items():
+                self._write_changes(table, old=saved[table], new=new)
+            self._saved[state.id] = rows
+
+    def _write_changes(self, table: str, old: frozenset, new: frozenset) -> None:
+        columns: tuple[str, ...]
+        if table == "guilds":
+            columns, pk = GUILD_COLUMNS, 1
+        else:
+            columns, pk = CHILD_TABLES[table]
+
+        gone = old - new
+        if gone:
+            where = " AND ".join(f"{c} = ?" for c in columns[:pk])
+            self._db.executemany(
+                f"DELETE FROM {table} WHERE {where}", [r[:pk] for r in gone]
+            )
+        added = new - old
+        if added:
+            marks = ", ".join("?" for _ in columns)
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({marks})",
+                added,
+            )
+
+    # ------------------------------- Loading -------------------------------- #
+
+    def load(self, guild_id: hikari.Snowflake) -> structs.GuildState | None:
+        states = self._load(where="WHERE {} = ?", params=(guild_id,))
+        if not states:
+            logger.debug("No state for guild: %d", guild_id)
+            return None
+        return states[0]
+
+    def load_all(self) -> list[structs.GuildState]:
+        with gc_paused():
+            return self._load(where="", params=())
+
+    def load_many(
+        self, guild_ids: Sequence[hikari.Snowflake], workers: int = 8
+    ) -> list[structs.GuildState]:
+        # One connection, so threads wouldn't help. Big queries do instead.
+        states = []
+        with gc_paused():
+            for n in range(0, len(guild_ids), LOAD_BATCH_SIZE):
+                batch = tuple(guild_ids[n : n + LOAD_BATCH_SIZE])
+                marks = ", ".join("?" for _ in batch)
+                states += self._load(where=f"WHERE {{}} IN ({marks})", params=batch)
+        return states
+
+    def guild_ids(self) -> list[hikari.Snowflake]:
+        with self._lock:
+            rows = self._db.execute("SELECT id FROM guilds ORDER BY id").fetchall()
+        return [hikari.Snowflake(guild_id) for (guild_id,) in rows]
+
+    def _load(self, where: str, params: tuple) -> list[structs.GuildState]:
+        with self._lock:
+            guilds = self._db.execute(
+                f"SELECT {', '.join(GUILD_COLUMNS)} FROM guilds {where.format('id')}",
+                params,
+            ).fetchall()
+            children: dict[str, dict[int, set[tuple]]] = {}
+            for table, (columns, _) in CHILD_TABLES.items():
+                by_guild: dict[int, set[tuple]] = defaultdict(set)
+                for row in self._db.execute(
+                    f"SELECT {', '.join(columns)} FROM {table} "
+                    f"{where.format('guild_id')}",
+                    params,
+                ):
+                    by_guild[row[0]].add(row)
+                children[table] = by_guild
+
+            # Still under the lock, or a save from the persister could land
+            # in between, and we'd diff its next save against what we read.
+            loaded = []
+            for guild in guilds:
+                rows: Rows = {"guilds": frozenset([guild])}
+                for table in CHILD_TABLES:
+                    rows[table] = frozenset(children[table].get(guild[0], ()))
+                self._saved[guild[0]] = rows
+                loaded.append(rows)
+        return [rows_state(rows) for rows in loaded]
+
+
+@contextlib.contextmanager
+def gc_paused() -> Iterator[None]:
+    """Hold off the garbage collector while building lots of states.
+
+    None of the rows and tuples a big load makes are garbage, but there
+    are enough of them that the collector keeps going over them all, and
+    that was half the time it took to load every guild."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def state_rows(state: structs.GuildState) -> Rows:
+    """Flatten a GuildState into the rows of each table."""
+
+    guild = []
+    for column in GUILD_COLUMNS:
+        value = getattr(state, column)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, int):
+            value = int(value)  # Snowflakes
+        guild.append(value)
+
+    g = int(state.id)
+    # Options and their removes keep their order, as menus are in the config.
+    return {
+        "guilds": frozenset([tuple(guild)]),
+        "role_names": frozenset(
+            (g, int(role_id), name) for role_id, name in state.role_names.items()
+        ),
+        "role_options": frozenset(
+            (g, int(message_id), emoji, int(option.add_role_id), n)
+            for n, ((message_id, emoji), option) in enumerate(state.role_emojis.items())
+        ),
+        "role_option_removes": frozenset(
+            (g, int(message_id), emoji, int(role_id), n)
+            for (message_id, emoji), option in state.role_emojis.items()
+            for n, role_id in enumerate(option.remove_role_ids)
+        ),
+        "tracked_messages": frozenset(
+            (g, n, int(message_id))
+            for n, message_id in enumerate(state.role_message_ids)
+        ),
+        "role_menus": frozenset(
+            (g, int(message_id), digest)
+            for message_id, digest in state.role_menu_hashes.items()
+        ),
+        "lobby_kicks": frozenset(
+            (g, int(member_id), deadline.isoformat())
+            for member_id, deadline in state.lobby_kick_deadlines.items()
+        ),
+        "role_selects": frozenset(
+            (g, int(message_id)) for message_id in state.role_select_ids
+        ),
+    }
+
+
+def rows_state(rows: Rows) -> structs.GuildState:
+    """Put a GuildState back together from its rows.
+
+    This is data we wrote ourselves, so it skips pydantic's validation."""
+
+    (guild,) = rows["guilds"]
+    fields = dict(zip(GUILD_COLUMNS, guild))
+    for column in SNOWFLAKE_COLUMNS:
+        if fields[column] is not None:
+            fields[column] = hikari.Snowflake(fields[column])
+    fields["config_last"] = datetime.datetime.fromisoformat(fields["config_last"])
+    fields["lobby_click_for_rules"] = bool(fields["lobby_click_for_rules"])
+
+    removes: dict[tuple[int, str], list[hikari.Snowflake]] = defaultdict(list)
+    for _, message_id, emoji, role_id, _ in sorted(
+        rows["role_option_removes"], key=lambda r: (r[4], r[3])
+    ):
+        removes[(message_id, emoji)].append(hikari.Snowflake(role_id))
+
+    return structs.GuildState.construct(
+        **fields,
+        role_names={
+            hikari.Snowflake(role_id): name for _, role_id, name in rows["role_names"]
+        },
+        role_emojis={
+            (
+                hikari.Snowflake(message_id),
+                emoji,
+            ): structs.RoleMenuOptionState.construct(
+                add_role_id=hikari.Snowflake(add_role_id),
+                remove_role_ids=removes.get((message_id, emoji), []),
+            )
+            for _, message_id, emoji, add_role_id, _ in sorted(
+                rows["role_options"], key=lambda r: (r[4], r[1], r[2])
+            )
+        },
+        role_message_ids=[
+            hikari.Snowflake(message_id)
+            for _, _, message_id in sorted(rows["tracked_messages"])
+        ],
+        role_menu_hashes={
+            hikari.Snowflake(message_id): digest
+            for _, message_id, digest in rows["role_menus"]
+        },
+        lobby_kick_deadlines={
+            hikari.Snowflake(member_id): datetime.datetime.fromisoformat(deadline)
+            for _, member_id, deadline in rows["lobby_kicks"]
+        },
+        role_select_ids=[
+            hikari.Snowflake(message_id)
+            for _, message_id in sorted(rows["role_selects"])
+        ],
+    )
+
+
+def rows_json(rows: Rows) -> dict[str, list[list]]:
+    return {table: [list(r) for r in sorted(values)] for table, values in rows.items()}
+
+
+def json_rows(data: dict[str, list[list]]) -> Rows:
+    rows: Rows = {"guilds": frozenset(tuple(r) for r in data["guilds"])}
+    for table in CHILD_TABLES:
+        rows[table] = frozenset(tuple(r) for r in data.get(table, ()))
+    return rows
+
+
+# ---------------------------------------------------------------------------- #
+#                 Remote: one state server, shared by every shard              #
+# ---------------------------------------------------------------------------- #
+
+REMOTE_TIMEOUT = 10.0
+CLIENT_HEADER = "X-Dragonpaw-Client"
+
+
+class RemoteStore(StateStore):
+    """The states kept by a cluster.StateServer, over HTTP.
+
+    The rows go over the wire as JSON, the same rows the SQLite store
+    writes, so nothing is pickled. Calls block, like the other stores, and
+    are made from the persister's thread or asyncio.to_thread. Every save
+    is sent with our client id, so the server doesn't tell us about our
+    own changes."""
+
+    def __init__(self, url: str, timeout: float = REMOTE_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.client_id = uuid.uuid4().hex
+
+    def _call(self, method: str, path: str, body: Any = None) -> Any:
+        request = urllib.request.Request(
+            self.url + path,
+            method=method,
+            data=None if body is None else json.dumps(body).encode(),
+            headers={"Content-Type": "application/json", CLIENT_HEADER: self.client_id},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def save(self, state: structs.GuildState) -> None:
+        self._call("PUT", f"/guilds/{state.id}", rows_json(state_rows(state)))
+
+    def load(self, guild_id: hikari.Snowflake) -> structs.GuildState | None:
+        try:
+            return rows_state(json_rows(self._call("GET", f"/guilds/{guild_id}")))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                logger.debug("No state for guild: %d", guild_id)
+                return None
+            raise
+
+    def load_all(self) -> list[structs.GuildState]:
+        return self.load_many(self.guild_ids())
+
+    def load_many(
+        self, guild_ids: Sequence[hikari.Snowflake], workers: int = 8
+    ) -> list[structs.GuildState]:
+        states = []
+        for n in range(0, len(guild_ids), LOAD_BATCH_SIZE):
+            batch = [int(g) for g in guild_ids[n : n + LOAD_BATCH_SIZE]]
+            found = self._call("POST", "/guilds/load", {"ids": batch})
+            states += [rows_state(json_rows(data)) for data in found]
+        return states
+
+    def guild_ids(self) -> list[hikari.Snowflake]:
+        return [hikari.Snowflake(g) for g in self._call("GET", "/guilds")]
@@ -1,4 +1,5 @@
 import datetime
+from typing import Literal
 
 import hikari
 import pydantic
@@ -25,6 +26,8 @@ class RoleMenuOptionConfig(pydantic.BaseModel):
 class RoleMenuConfig(pydantic.BaseModel):
     name: str
     single: bool = False
+    # "select" sends a dropdown instead, one interaction for all your picks.
+    style: Literal["reactions", "select"] = "reactions"
     description: str | None
     options: list[RoleMenuOptionConfig]
 
@@ -55,6 +58,8 @@ class GuildState(pydantic.BaseModel):
     config_url: str
     # config_size: int
     config_last: datetime.datetime
+    # So we can tell when a config hasn't changed since last time.
+    config_hash: str | None = None
 
     lobby_role_id: hikari.Snowflake | None = None
     lobby_welcome_message: str | None = None
@@ -63,11 +68,22 @@ class GuildState(pydantic.BaseModel):
     lobby_kick_days: int = 0
     lobby_rules: str = ""
     lobby_rules_message_id: hikari.Snowflake | None = None
+    # Key is member.id, value is when they get kicked if they're still here.
+    lobby_kick_deadlines: dict[hikari.Snowflake, datetime.datetime] = {}
 
     # Role management
     role_channel_id: hikari.Snowflake | None = None
     # Key is (meddage.id,emoji)
     role_emojis: dict[tuple[hikari.Snowflake, str], RoleMenuOptionState]
     role_names: dict[hikari.Snowflake, str]
+    # Every menu I sent, and the note at the end, so they can be deleted later.
+    role_message_ids: list[hikari.Snowflake] = []
+    # Key is message.id, value is a hash of what the menu looks like.
+    role_menu_hashes: dict[hikari.Snowflake, str] = {}
+    # The menus that are a select component, not reactions. Their options
+    # are in role_emojis all the same, keyed by the value of each option.
+    role_select_ids: list[hikari.Snowflake] = []
+    # A hash of the note after the menus, which depends on all of them.
+    role_note_hash: str | None = None
 
     log_channel_id: hikari.Snowflake | None = None
@@ -1,73 +1,182 @@
 from __future__ import annotations
 
+import collections
+import contextlib
+import datetime
+import functools
 import logging
-from typing import TYPE_CHECKING, Mapping, Optional, Sequence, Union
+import time
+import types
+from typing import TYPE_CHECKING, Iterable, Iterator, Mapping, Optional, Sequence, Union
 
 import hikari
 import hikari.messages
-from emojis.db.db import EMOJI_DB
 
+from dragonpaw_bot import metrics
 from dragonpaw_bot.colors import SOLARIZED_RED
 
 if TYPE_CHECKING:
     from dragonpaw_bot.bot import DragonpawBot
+    from dragonpaw_bot.indexes import GuildIndex
 
 logger = logging.getLogger(__name__)
 
+# How far back to look for my own messages, when I don't know which they were.
+HISTORY_SCAN_LIMIT = 100
+# Discord's limit is 2 weeks, leave some slack for clock skew.
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+
 # ---------------------------------------------------------------------------- #
 #                           Discord utility functions                          #
 # ---------------------------------------------------------------------------- #
 
 
 async def delete_my_messages(
-    bot: DragonpawBot, guild_name: str, channel_id: hikari.Snowflake
+    bot: DragonpawBot,
+    guild: hikari.Guild,
+    channel_id: hikari.Snowflake,
+    message_ids: Sequence[hikari.Snowflake] = (),
 ):
-    logger.debug("Checking for old messages in channel: %r", channel_id)
+    """Delete messages I sent to a channel.
+
+    If we know which messages they were, only those get deleted. Otherwise we
+    have to go looking for them in the recent history of the channel."""
+
+    if not message_ids:
+        message_ids = await find_my_messages(
+            bot=bot, guild=guild, channel_id=channel_id
+        )
+
+    # Discord will only bulk delete messages less than 2 weeks old.
+    cutoff = datetime.datetime.now(tz=datetime.timezone.utc) - BULK_DELETE_MAX_AGE
+    one_by_one = [m for m in message_ids if m.created_at <= cutoff]
+    bulk = [m for m in message_ids if m.created_at > cutoff]
+
+    if len(bulk) > 1:
+        logger.debug("G=%r Bulk deleting %d messages", guild.name, len(bulk))
+        try:
+            async with bot.outbound.bulk(guild.id):
+                await bot.rest.delete_messages(channel_id, bulk)
+        except hikari.BulkDeleteError as e:
+            # Most likely, no MANAGE_MESSAGES permission. Do it the slow way.
+            logger.warning("G=%r Bulk delete failed: %r", guild.name, e.__cause__)
+            deleted = {int(m) for m in e.deleted_messages}
+            one_by_one += [m for m in bulk if m not in deleted]
+    else:
+        one_by_one += bulk
+
+    for message_id in one_by_one:
+        logger.debug("G=%r Deleting my message: %r", guild.name, message_id)
+        try:
+            async with bot.outbound.bulk(guild.id):
+                await bot.rest.delete_message(channel_id, message_id)
+        except hikari.NotFoundError:
+            logger.debug("G=%r Message was already gone: %r", guild.name, message_id)
+
+
+async def find_my_messages(
+    bot: DragonpawBot, guild: hikari.Guild, channel_id: hikari.Snowflake
+) -> list[hikari.Snowflake]:
+    """Look through the recent history of a channel for messages I sent."""
+    logger.debug(
+        "G=%r Checking for old messages in channel: %r", guild.name, channel_id
+    )
     assert bot.user_id
-    async for message in bot.rest.fetch_messages(channel=channel_id):
-        if message.author.id == bot.user_id:
-            logger.debug("G:%r: Deleting my message: %r", guild_name, message)
-            await message.delete()
+    async with bot.outbound.bulk(guild.id):
+        return [
+            message.id
+            async for message in bot.rest.fetch_messages(channel=channel_id).limit(
+                HISTORY_SCAN_LIMIT
+            )
+            if message.author.id == bot.user_id
+        ]
 
 
 async def guild_channel_by_name(
     bot: DragonpawBot, guild: hikari.Guild, name: str
 ) -> Optional[hikari.GuildTextChannel]:
     logger.debug("Finding channel: %s", name)
-    channels: Sequence[hikari.GuildChannel] = list(guild.get_channels().values())
-    if not channels:
-        channels = await bot.rest.fetch_guild_channels(guild=guild.id)
-    for channel in channels:
-        if channel.name == name:
-            assert isinstance(channel, hikari.GuildTextChannel)
-            return channel
-    return None
+    if guild.id not in bot.indexes:
+        await guild_index_fetch(bot=bot, guild_id=guild.id)
+    return bot.indexes.text_channel(guild.id, name)
+
+
+@functools.lru_cache(maxsize=None)
+def unicode_emojis() -> Mapping[str, hikari.UnicodeEmoji]:
+    """Every alias in the global emoji DB, built once and shared by all guilds."""
+    # The DB takes longer to import than the rest of the bot, so wait for it.
+    from emojis.db.db import EMOJI_DB
+
+    emoji_map = {
+        alias: hikari.UnicodeEmoji.parse(u.emoji)
+        for u in EMOJI_DB
+        for alias in u.aliases
+    }
+    logger.debug("Indexed %d unicode emoji aliases", len(emoji_map))
+    return types.MappingProxyType(emoji_map)
+
+
+def guild_emojis_update(
+    bot: DragonpawBot,
+    guild_id: hikari.Snowflake,
+    emojis: Iterable[hikari.KnownCustomEmoji],
+) -> Mapping[str, hikari.KnownCustomEmoji]:
+    """Replace the cached custom emojis for a guild."""
+    custom = {e.name: e for e in emojis}
+    bot.custom_emojis[guild_id] = custom
+    logger.debug("Cached %d custom emojis for guild: %r", len(custom), guild_id)
+    return custom
 
 
 async def guild_emojis(
     bot: DragonpawBot, guild: hikari.Guild
 ) -> Mapping[str, Union[hikari.KnownCustomEmoji, hikari.UnicodeEmoji]]:
-    emoji_map: dict[str, Union[hikari.KnownCustomEmoji, hikari.UnicodeEmoji]] = {}
-
-    # Load the custom emojis from the guild
-    custom_emojis = await bot.rest.fetch_guild_emojis(guild=guild.id)
-    for e in custom_emojis:
-        emoji_map[e.name] = e
-        logger.debug("Guild emoji: %s:%r", e.name, e)
-
-    # Shove the Global Emojis in there as well
-    for u in EMOJI_DB:
-        for alias in u.aliases:
-            emoji_map[alias] = hikari.UnicodeEmoji.parse(u.emoji)
+    # The custom emojis are kept up to date by events, so only fetch them if
+    # we somehow haven't seen this guild yet.
+    custom = bot.custom_emojis.get(guild.id)
+    if custom is None:
+        custom = guild_emojis_update(
+            bot=bot,
+            guild_id=guild.id,
+            emojis=await bot.rest.fetch_guild_emojis(guild=guild.id),
+        )
 
-    return emoji_map
+    # The global emojis win if a custom one has the same name.
+    return collections.ChainMap(unicode_emojis(), custom)  # type: ignore[arg-type]
 
 
 async def guild_roles(
     bot: DragonpawBot, guild: hikari.Guild
 ) -> Mapping[str, hikari.Role]:
-    roles = await bot.rest.fetch_roles(guild=guild.id)
-    return {r.name: r for r in roles}
+    # Kept up to date by events, like the emojis.
+    roles = bot.indexes.roles(guild.id)
+    if roles is None:
+        roles = (await guild_index_fetch(bot=bot, guild_id=guild.id)).role_names
+    return roles
+
+
+async def guild_index_fetch(
+    bot: DragonpawBot, guild_id: hikari.Snowflake
+) -> GuildIndex:
+    """Index a guild we somehow haven't had a GUILD_CREATE for."""
+    logger.debug("Fetching roles and channels for guild: %r", guild_id)
+    return bot.indexes.guild_set(
+        guild_id,
+        roles=await bot.rest.fetch_roles(guild=guild_id),
+        channels=await bot.rest.fetch_guild_channels(guild=guild_id),
+    )
+
+
+@contextlib.contextmanager
+def timed(guild_name: str, phase: str) -> Iterator[None]:
+    """Log how long a phase of setting up a guild took."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.CONFIGURE_SECONDS.observe(elapsed, phase)
+        logger.info("G=%r %s took %.2fs", guild_name, phase, elapsed)
 
 
 async def report_errors(
@@ -94,11 +203,12 @@ async def report_errors(
         return
 
     logger.error("G=%r %s", c.name, error)
-    await bot.rest.create_message(
-        channel=to,
-        embed=hikari.Embed(
-            color=SOLARIZED_RED,
-            title="🤯 Oh Snap!",
-            description=error,
-        ),
-    )
+    async with bot.outbound.bulk(guild_id):
+        await bot.rest.create_message(
+            channel=to,
+            embed=hikari.Embed(
+                color=SOLARIZED_RED,
+                title="🤯 Oh Snap!",
+                description=error,
+            ),
+        )